@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import os
 import binascii
+import datetime as dt
+import timeit
 import unittest
 
 from flask_assets import ManageAssets
@@ -10,8 +12,8 @@ from flask_script.commands import ShowUrls, Clean
 
 from flask_migrate import Migrate, MigrateCommand
 
-from server import create_app, generate
-from server.models import db, User, Course, Version
+from server import create_app, generate, jsoncodec
+from server.models import db, User, Course, Version, Assignment
 from server.extensions import assets_env, cache
 
 # default to dev config
@@ -118,6 +120,23 @@ def worker():
     """ Run RQ workers. """
     get_worker().work()
 
+@manager.option('-n', '--number', dest='number', type=int, default=200)
+def bench_json(number):
+    """ Time each JSON codec on generated analytics and file_contents payloads.
+    """
+    assignment = Assignment(due_date=dt.datetime.now(), uploads_enabled=True)
+    messages = generate.gen_messages(assignment, 0)
+    for kind in ('analytics', 'file_contents'):
+        payload = messages[kind]
+        size = len(jsoncodec.json_dumps(payload))
+        print('{} ({} bytes)'.format(kind, size))
+        for name, (dumps, loads) in sorted(jsoncodec.CODECS.items()):
+            data = dumps(payload)
+            encode = timeit.timeit(lambda: dumps(payload), number=number)
+            decode = timeit.timeit(lambda: loads(data), number=number)
+            print('  {:8} encode {:8.1f} MB/s  decode {:8.1f} MB/s'.format(
+                name, size * number / encode / 1e6, size * number / decode / 1e6))
+
 
 if __name__ == "__main__":
     manager.run()
@@ -6,6 +6,7 @@ from webassets.loaders import PythonLoader as PythonAssetsLoader
 from werkzeug.contrib.fixers import ProxyFix
 
 from server import assets, converters, logging, utils
+from server.ingest import admission, backup_writer
 from server.forms import CSRFForm
 from server.models import db
 from server.controllers.about import about
@@ -107,6 +108,11 @@ def create_app(environment_name=None):
 
     # initalize cloud storage
     storage.init_app(app)
+
+    # write-behind queue for backups
+    backup_writer.init_app(app)
+    admission.init_app(app)
+
     # Set up logging
     logging.init_app(app)
 
@@ -10,7 +10,9 @@ import json
 import logging
 import time
 
+from flask_rq import get_connection
 import oauthlib.common
+from redis.exceptions import RedisError
 import requests
 
 from server import constants, jobs, utils
@@ -118,6 +120,66 @@ def check_job_results(job_ids, autograder_url):
     """
     return send_autograder('/results', job_ids, autograder_url)
 
+def job_event_key(backup_id, job_id):
+    return 'autograder-job/{}/{}'.format(backup_id, job_id)
+
+def score_event_key(backup_id):
+    return 'autograder-score/{}'.format(backup_id)
+
+def record_job_status(backup_id, job_id, status):
+    """ Record a STATUS that the autograder pushed for JOB_ID, which grades
+    BACKUP_ID, for autograde_backups to pick up. A job that has ended is not
+    moved back to an earlier status by a late notification.
+
+    Events are kept in Redis, which the web workers that receive them share
+    with the RQ worker running autograde_backups. They only save polls, so
+    they are dropped if Redis cannot be reached.
+    """
+    key = job_event_key(backup_id, job_id)
+    try:
+        connection = get_connection()
+        if status in ('queued', 'started', 'deferred') and \
+                connection.get(key) in (b'finished', b'failed'):
+            return
+        connection.set(key, status, ex=EVENT_TIMEOUT)
+    except RedisError:
+        logger.warning('Could not record the status of autograder job %s', job_id)
+
+def record_score(backup_id):
+    """ Record that a score for BACKUP_ID was just created."""
+    try:
+        get_connection().set(score_event_key(backup_id), time.time(), ex=EVENT_TIMEOUT)
+    except RedisError:
+        logger.warning('Could not record the score of backup %s', backup_id)
+
+def pushed_events(keys):
+    """ Return the values stored under KEYS, as strings or None. Nothing was
+    pushed as far as we can tell if Redis cannot be reached.
+    """
+    if not keys:
+        return []
+    try:
+        values = get_connection().mget(keys)
+    except RedisError:
+        logger.warning('Could not read pushed autograder events')
+        return [None] * len(keys)
+    return [value and value.decode('utf-8') for value in values]
+
+def pushed_job_results(jobs):
+    """ Like check_job_results, but only with the statuses pushed for JOBS, a
+    list of (backup_id, job_id). Jobs without a pushed status are left out.
+    """
+    statuses = pushed_events([job_event_key(backup_id, job_id)
+                              for backup_id, job_id in jobs])
+    return {job_id: {'status': status}
+            for (_, job_id), status in zip(jobs, statuses) if status}
+
+def pushed_scores(backup_ids, since):
+    """ Return the set of BACKUP_IDS with a score recorded after SINCE."""
+    times = pushed_events([score_event_key(backup_id) for backup_id in backup_ids])
+    return {backup_id for backup_id, scored in zip(backup_ids, times)
+            if scored and float(scored) > since}
+
 GradingStatus = enum.Enum('GradingStatus', [
     'QUEUED',   # a job is queued
     'RUNNING',  # a job is running
@@ -148,7 +210,83 @@ MAX_RETRIES = 3           # maximum number of times to retry a score
 QUEUED_TIMEOUT = 30 * 60  # maximum time or an autograder job to be queued for, in seconds
 RUNNING_TIMEOUT = 5 * 60  # time to wait for an autograder job to run, in seconds
 WAITING_TIMEOUT = 2 * 60  # time to wait for a score, in seconds
-POLL_INTERVAL = 10        # how often to poll the autograder, in seconds
+# how often to check for pushed job statuses and scores, in seconds
+EVENT_INTERVAL = 2
+# how often to poll the autograder and scores for missed events, in seconds
+MIN_POLL_INTERVAL = 10
+# longest poll interval, backed off to while polls change nothing, in seconds
+MAX_POLL_INTERVAL = 60
+# how long pushed statuses and scores are kept, in seconds
+EVENT_TIMEOUT = QUEUED_TIMEOUT
+
+def next_poll_interval(interval, changed, pushed):
+    """ Return the interval until the next poll, after a poll at INTERVAL that
+    CHANGED the status of some task or not. Polls only back off once the
+    autograder has PUSHED some event, since otherwise polls are all we have.
+    """
+    if changed or not pushed:
+        return MIN_POLL_INTERVAL
+    return min(interval * 2, MAX_POLL_INTERVAL)
+
+def scored_backups(backup_ids, since):
+    """ Return the set of BACKUP_IDS with an active score created after
+    SINCE, in one query.
+    """
+    if not backup_ids:
+        return set()
+    scores = (db.session.query(Score.backup_id)
+                        .filter(Score.backup_id.in_(backup_ids),
+                                Score.archived == False,
+                                Score.created > datetime.datetime.fromtimestamp(since))
+                        .distinct())
+    return {backup_id for backup_id, in scores}
+
+def advance_job(task, result, retry_task, logger):
+    """ Advance a QUEUED or RUNNING TASK given the RESULT of its job. """
+    job = 'Autograder job {} for backup {}'.format(
+        task.job_id, utils.encode_id(task.backup_id))
+    if not result:
+        logger.warning('{} disappeared, retrying'.format(job))
+        retry_task(task)
+    elif task.status == GradingStatus.QUEUED:
+        if result['status'] != 'queued':
+            logger.debug('{} started'.format(job))
+            task.set_status(GradingStatus.RUNNING)
+        elif task.expired(QUEUED_TIMEOUT):
+            logger.warning('{} queued longer than {} seconds, retrying'.format(
+                job, QUEUED_TIMEOUT))
+            retry_task(task)
+    elif result['status'] == 'finished':
+        logger.debug('{} finished'.format(job))
+        task.set_status(GradingStatus.WAITING)
+    elif result['status'] == 'failed':
+        logger.warning('{} failed, retrying'.format(job))
+        retry_task(task)
+    elif task.expired(RUNNING_TIMEOUT):
+        logger.warning('{} running longer than {} seconds, retrying'.format(
+            job, RUNNING_TIMEOUT))
+        retry_task(task)
+
+def advance_task(task, results, scored, retry_task, logger):
+    """ Advance TASK through the grading state machine, given the job
+    RESULTS and the set of SCORED backup ids seen on this tick. Tasks that
+    time out or fail are handed to RETRY_TASK.
+    """
+    if task.status == GradingStatus.QUEUED:
+        result = results.get(task.job_id, {'status': 'queued'})
+        advance_job(task, result, retry_task, logger)
+    if task.status == GradingStatus.RUNNING:
+        result = results.get(task.job_id, {'status': 'started'})
+        advance_job(task, result, retry_task, logger)
+    if task.status == GradingStatus.WAITING:
+        hashid = utils.encode_id(task.backup_id)
+        if task.backup_id in scored:
+            logger.debug('Received score for backup {}'.format(hashid))
+            task.set_status(GradingStatus.DONE)
+        elif task.expired(WAITING_TIMEOUT):
+            logger.warning('Did not receive score for backup {} in {} seconds, retrying'
+                           .format(hashid, WAITING_TIMEOUT))
+            retry_task(task)
 
 def autograde_backups(assignment, user_id, backup_ids, logger):
     token = create_autograder_token(user_id)
@@ -178,61 +316,40 @@ def autograde_backups(assignment, user_id, backup_ids, logger):
             task.job_id = autograde_backup(token, assignment, task.backup_id)
             task.retries += 1
 
+    last_poll, poll_interval, pushed = time.time(), MIN_POLL_INTERVAL, False
     while True:
-        time.sleep(POLL_INTERVAL)
-        results = check_job_results([task.job_id for task in tasks], autograder_url)
-
+        time.sleep(EVENT_INTERVAL)
         graded = len([task for task in tasks
             if task.status in (GradingStatus.DONE, GradingStatus.FAILED)])
-        logger.info('Graded {:>4}/{} ({:>5.1f}%)'.format(
-            graded, num_tasks, 100 * graded / num_tasks))
         if graded == num_tasks:
             break
 
+        # Statuses and scores are pushed by the autograder as they happen.
+        # Polling only catches the ones that were missed.
+        pending = [(task.backup_id, task.job_id) for task in tasks
+                   if task.status in (GradingStatus.QUEUED, GradingStatus.RUNNING)]
+        waiting = [task.backup_id for task in tasks
+                   if task.status == GradingStatus.WAITING]
+        results = pushed_job_results(pending)
+        scored = pushed_scores(waiting, start_time)
+        pushed = pushed or bool(results or scored)
+        polled = time.time() >= last_poll + poll_interval
+        if polled:
+            last_poll = time.time()
+            logger.info('Graded {:>4}/{} ({:>5.1f}%)'.format(
+                graded, num_tasks, 100 * graded / num_tasks))
+            if pending:
+                results.update(check_job_results([job_id for _, job_id in pending],
+                                                 autograder_url))
+            scored |= scored_backups(waiting, start_time)
+        statuses = [(task.status, task.job_id) for task in tasks]
+
         for task in tasks:
-            hashid = utils.encode_id(task.backup_id)
-            if task.status == GradingStatus.QUEUED:
-                result = results[task.job_id]
-                if not result:
-                    logger.warning('Autograder job {} for backup {} disappeared, retrying'.format(task.job_id, hashid))
-                    retry_task(task)
-                elif result['status'] != 'queued':
-                    logger.debug('Autograder job {} for backup {} started'.format(
-                        task.job_id, hashid))
-                    task.set_status(GradingStatus.RUNNING)
-                elif task.expired(QUEUED_TIMEOUT):
-                    logger.warning('Autograder job {} for backup {} queued longer than {} seconds, retrying'.format(
-                        task.job_id, hashid, QUEUED_TIMEOUT))
-                    retry_task(task)
-            elif task.status == GradingStatus.RUNNING:
-                result = results[task.job_id]
-                if not result:
-                    logger.warning('Autograder job {} for backup {} disappeared, retrying'.format(task.job_id, hashid))
-                    retry_task(task)
-                elif result['status'] == 'finished':
-                    logger.debug('Autograder job {} for backup {} finished'.format(
-                        task.job_id, hashid))
-                    task.set_status(GradingStatus.WAITING)
-                elif result['status'] == 'failed':
-                    logger.warning('Autograder job {} for backup {} failed, retrying'.format(task.job_id, hashid))
-                    retry_task(task)
-                elif task.expired(RUNNING_TIMEOUT):
-                    logger.warning('Autograder job {} for backup {} running longer than {} seconds, retrying'.format(
-                        task.job_id, hashid, RUNNING_TIMEOUT))
-                    retry_task(task)
-            elif task.status == GradingStatus.WAITING:
-                score = Score.query.filter(
-                    Score.backup_id == task.backup_id,
-                    Score.archived == False,
-                    Score.created > datetime.datetime.fromtimestamp(start_time)
-                ).first()
-                if score:
-                    logger.debug('Received score for backup {}'.format(hashid))
-                    task.set_status(GradingStatus.DONE)
-                elif task.expired(WAITING_TIMEOUT):
-                    logger.warning('Did not receive score for backup {} in {} seconds, retrying'.format(
-                        hashid, WAITING_TIMEOUT))
-                    retry_task(task)
+            advance_task(task, results, scored, retry_task, logger)
+
+        if polled:
+            changed = statuses != [(task.status, task.job_id) for task in tasks]
+            poll_interval = next_poll_interval(poll_interval, changed, pushed)
 
     # report summary
     statuses = collections.Counter(task.status for task in tasks)
@@ -4,7 +4,7 @@ import requests.exceptions
 
 from server import constants, jobs
 from server.canvas import api
-from server.models import CanvasAssignment, CanvasCourse, Enrollment
+from server.models import CanvasAssignment, CanvasCourse, Enrollment, db
 from server.utils import encode_id
 
 @jobs.background_job
@@ -28,19 +28,24 @@ def upload_scores(canvas_assignment_id):
     row_format = '{!s:>10}  {!s:<55}  {!s:<6}  {!s:>9}  {!s:>9}'
     logger.info(row_format.format('STUDENT ID', 'EMAIL', 'BACKUP', 'OLD SCORE', 'NEW SCORE'))
 
+    enrollments_by_sid = collections.defaultdict(list)
+    for enrollment in (Enrollment.query
+                                 .options(db.joinedload('user'))
+                                 .filter_by(course_id=canvas_course.course_id,
+                                            role=constants.STUDENT_ROLE)):
+        enrollments_by_sid[enrollment.sid].append(enrollment)
+    scores_by_user = assignment.scores_many(
+        [e.user_id for enrollments in enrollments_by_sid.values() for e in enrollments],
+        only_published=False)
+
     for student in students:
         canvas_user_id = student['id']
         sid = student['sis_user_id']
-        enrollments = Enrollment.query.filter_by(
-            course_id=canvas_course.course_id,
-            sid=sid,
-            role=constants.STUDENT_ROLE,
-        ).all()
+        enrollments = enrollments_by_sid.get(sid, [])
         emails = ','.join(enrollment.user.email for enrollment in enrollments) or 'None'
         scores = []
         for enrollment in enrollments:
-            user_ids = assignment.active_user_ids(enrollment.user_id)
-            scores.extend(assignment.scores(user_ids, only_published=False))
+            scores.extend(scores_by_user[enrollment.user_id])
         scores = [s for s in scores if s.kind in canvas_assignment.score_kinds]
         old_score = old_scores.get(canvas_user_id)
         if not scores:
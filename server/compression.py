@@ -0,0 +1,79 @@
+""" Compression for JsonBlob columns.
+
+Blobs start with a header byte that names the codec used for the rest of the
+blob. Rows written before compression was added are plain JSON, which never
+starts with one of these bytes, so they are read as is.
+"""
+import logging
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from server.constants import BLOB_COMPRESSION, BLOB_COMPRESSION_MIN_SIZE
+
+logger = logging.getLogger(__name__)
+
+NONE = b'\x00'
+ZLIB = b'\x01'
+LZ4 = b'\x02'
+ZSTD = b'\x03'
+
+# Codec name -> (header, compress, decompress)
+CODECS = {
+    'none': (NONE, bytes, bytes),
+    'zlib': (ZLIB, zlib.compress, zlib.decompress),
+}
+if lz4:
+    CODECS['lz4'] = (LZ4, lz4.frame.compress, lz4.frame.decompress)
+if zstandard:
+    CODECS['zstd'] = (ZSTD, zstandard.ZstdCompressor().compress,
+                      zstandard.ZstdDecompressor().decompress)
+
+DECOMPRESSORS = {header: decompress for header, _, decompress in CODECS.values()}
+
+if BLOB_COMPRESSION not in CODECS:
+    logger.warning('Compression codec {} is not available, using zlib'
+                   .format(BLOB_COMPRESSION))
+    BLOB_COMPRESSION = 'zlib'
+
+
+def compress(data, codec=None):
+    """ Return DATA (bytes) with a header, compressed with CODEC (by default
+    BLOB_COMPRESSION). Data too small to benefit is stored uncompressed.
+    """
+    codec = codec or BLOB_COMPRESSION
+    if len(data) < BLOB_COMPRESSION_MIN_SIZE:
+        codec = 'none'
+    header, compressor, _ = CODECS[codec]
+    return header + compressor(data)
+
+
+def decompress(blob):
+    """ Return the data in BLOB, which may be a legacy uncompressed row."""
+    header = blob[:1]
+    if header not in (NONE, ZLIB, LZ4, ZSTD):
+        return bytes(blob)
+    if header not in DECOMPRESSORS:
+        raise ValueError('Cannot read blob compressed with an unavailable codec')
+    return DECOMPRESSORS[header](blob[1:])
+
+
+def is_current(blob):
+    """ Return whether BLOB is already stored as compress would store it now.
+    Uncompressed blobs are current only if they are too small to compress or
+    compression is turned off.
+    """
+    header = blob[:1]
+    if header == NONE:
+        if BLOB_COMPRESSION == 'none':
+            return True
+        return len(blob) - 1 < BLOB_COMPRESSION_MIN_SIZE
+    return header == CODECS[BLOB_COMPRESSION][0]
@@ -61,8 +61,20 @@ MICROSOFT = "MICROSOFT"
 
 # Maximum file size to show in browser, in characters
 DIFF_SIZE_LIMIT = 64 * 1024  # 64KB
-SOURCE_SIZE_LIMIT = 10 * 1024 * 1024 # 10MB
-MAX_UPLOAD_FILE_SIZE = 25 * 1024 * 1024 # 25MB
+SOURCE_SIZE_LIMIT = 10 * 1024 * 1024  # 10MB
+MAX_UPLOAD_FILE_SIZE = 25 * 1024 * 1024  # 25MB
+
+# Backup files are stored as diffs against the previous backup, with a full
+# snapshot after this many diffs
+BACKUP_SNAPSHOT_INTERVAL = 10
+
+# Codec for JsonBlob columns: none, zlib, lz4 or zstd (see server/compression.py)
+BLOB_COMPRESSION = os.getenv('BLOB_COMPRESSION', 'zlib')
+BLOB_COMPRESSION_MIN_SIZE = 256  # bytes
+
+# JSON library for Json and JsonBlob columns: json or orjson (see
+# server/jsoncodec.py). Defaults to orjson when it is installed.
+JSON_CODEC = os.getenv('JSON_CODEC')
 
 # Email client format for to field
 EMAIL_FORMAT = "{name} <{email}>"
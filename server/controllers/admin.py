@@ -35,7 +35,7 @@ import server.forms as forms
 import server.jobs as jobs
 from server.jobs import (assign_grading_queues, example, export, moss, scores_audit, github_search,
                          scores_notify, checkpoint, effort, upload_scores,
-                         export_grades, )
+                         export_grades, reencode_backups, recompress, )
 
 import server.highlight as highlight
 import server.utils as utils
@@ -583,9 +583,10 @@ def assignment_stats(cid, aid):
         flash('Insufficient permissions', 'error')
         return abort(401)
 
-    stats = Assignment.assignment_stats(assign.id)
+    detailed = request.args.get('detailed', False, type=bool)
+    stats = Assignment.assignment_stats(assign.id, detailed=detailed)
 
-    submissions = [d for d in stats.pop('raw_data')]
+    submissions = stats.pop('raw_data', None)
 
     pie_chart = pygal.Pie(half_pie=True, disable_xml_declaration=True,
                           style=CleanStyle,
@@ -778,46 +779,69 @@ def send_scores_job(cid, aid):
         )
 
 
-@admin.route("/course/<int:cid>/assignments/<int:aid>/scores.csv")
-@is_staff(course_arg='cid')
-def export_scores(cid, aid):
-    courses, current_course = get_courses(cid)
-    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
-    if not Assignment.can(assign, current_user, 'export'):
-        flash('Insufficient permissions', 'error')
-        return abort(401)
+def scores_csv_rows(assign, course, chunk_size=100):
+    """ Yield the scores of ASSIGN as CSV, a chunk of scores at a time.
+    Scores are paged through by id, so only one chunk is loaded at once.
+    Num Queries: 3 per chunk, plus one per grader.
+    """
     query = (Score.query.options(db.joinedload('backup'))
-                  .filter_by(assignment=assign, archived=False))
-
+             .filter_by(assignment=assign, archived=False)
+             .order_by(Score.id))
     custom_items = ('time', 'is_late', 'email', 'group')
     items = custom_items + Enrollment.export_items + Score.export_items
 
-    def generate_csv():
-        """ Generate csv export of scores for assignment.
-        Num Queries: ~2N queries for N scores.
-        """
-        # Yield Column Info as first row
-        yield ','.join(items) + '\n'
-        for score in query:
-            csv_file = StringIO()
-            csv_writer = csv.DictWriter(csv_file, fieldnames=items)
-            submitters = score.backup.enrollment_info()
+    csv_file = StringIO()
+    csv_writer = csv.DictWriter(csv_file, fieldnames=items)
+    # Yield Column Info as first row
+    yield ','.join(items) + '\n'
+    last_id = 0
+    while True:
+        scores = query.filter(Score.id > last_id).limit(chunk_size).all()
+        if not scores:
+            break
+        last_id = scores[-1].id
+        owners = assign.active_user_ids_many(
+            {score.backup.submitter_id for score in scores})
+        enrollments = Enrollment.lookup_many(
+            assign.course_id, set().union(*owners.values()))
+        for score in scores:
+            backup = score.backup
+            submitters = sorted(
+                (enrollments[uid] for uid in owners[backup.submitter_id]
+                 if uid in enrollments),
+                key=lambda e: e.user_id)
             group = [s.user.email for s in submitters]
-            time_str = utils.local_time(score.backup.created, current_course)
+            time_str = utils.local_time(backup.created, course)
+            score_data = score.export
             for submitter in submitters:
                 data = {'email': submitter.user.email,
                         'time': time_str,
-                        'is_late': score.backup.is_late,
+                        'is_late': backup.is_late,
                         'group': group}
                 data.update(submitter.export)
-                data.update(score.export)
+                data.update(score_data)
                 csv_writer.writerow(data)
-            yield csv_file.getvalue()
+        yield csv_file.getvalue()
+        csv_file.seek(0)
+        csv_file.truncate()
+        if len(scores) < chunk_size:
+            break
+
+
+@admin.route("/course/<int:cid>/assignments/<int:aid>/scores.csv")
+@is_staff(course_arg='cid')
+def export_scores(cid, aid):
+    courses, current_course = get_courses(cid)
+    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
+    if not Assignment.can(assign, current_user, 'export'):
+        flash('Insufficient permissions', 'error')
+        return abort(401)
 
     file_name = "{0}.csv".format(assign.name.replace('/', '-'))
     disposition = 'attachment; filename={0}'.format(file_name)
 
-    return Response(stream_with_context(generate_csv()), mimetype='text/csv',
+    return Response(stream_with_context(scores_csv_rows(assign, current_course)),
+                    mimetype='text/csv',
                     headers={'Content-Disposition': disposition})
 
 @admin.route("/course/<int:cid>/assignments/<int:aid>/queues")
@@ -946,6 +970,49 @@ def autograde(cid, aid):
         return redirect(url_for('.course_job', cid=cid, job_id=job.id))
     return redirect(url_for('.assignment', cid=cid, aid=aid))
 
+@admin.route("/course/<int:cid>/assignments/<int:aid>/reencode",
+             methods=["POST"])
+@is_staff(course_arg='cid')
+def reencode_backups_job(cid, aid):
+    courses, current_course = get_courses(cid)
+    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
+    if not assign or not current_user.is_admin:
+        flash('Only site administrators can re-encode backups', 'error')
+        return abort(404)
+    form = forms.CSRFForm()
+    if form.validate_on_submit():
+        job = jobs.enqueue_job(
+            reencode_backups.reencode_files,
+            description='Re-encode backups for {}'.format(assign.display_name),
+            timeout=2 * 60 * 60,  # 2 hours
+            course_id=cid,
+            user_id=current_user.id,
+            assign_id=assign.id)
+        return redirect(url_for('.course_job', cid=cid, job_id=job.id))
+    return redirect(url_for('.assignment', cid=cid, aid=aid))
+
+
+@admin.route("/course/<int:cid>/assignments/<int:aid>/recompress",
+             methods=["POST"])
+@is_staff(course_arg='cid')
+def recompress_backups_job(cid, aid):
+    courses, current_course = get_courses(cid)
+    assign = Assignment.query.filter_by(id=aid, course_id=cid).one_or_none()
+    if not assign or not current_user.is_admin:
+        flash('Only site administrators can recompress backups', 'error')
+        return abort(404)
+    form = forms.CSRFForm()
+    if form.validate_on_submit():
+        job = jobs.enqueue_job(
+            recompress.recompress_backups,
+            description='Recompress backups for {}'.format(assign.display_name),
+            timeout=2 * 60 * 60,  # 2 hours
+            course_id=cid,
+            user_id=current_user.id,
+            assign_id=assign.id)
+        return redirect(url_for('.course_job', cid=cid, job_id=job.id))
+    return redirect(url_for('.assignment', cid=cid, aid=aid))
+
 
 @admin.route("/course/<int:cid>/assignments/<int:aid>/upload",
             methods=["GET","POST"])
@@ -16,19 +16,24 @@ API.py - /api/{version}/endpoints
     api.add_resource(UserAPI, '/v3/user')
 """
 from functools import wraps
+import hashlib
+import json
+import random
 from datetime import datetime as dt
 import io, csv
 
-from flask import Blueprint, jsonify, request, url_for
+from flask import Blueprint, Response, jsonify, request, stream_with_context, url_for
 from flask_login import current_user
 import flask_restful as restful
-from flask_restful import reqparse, fields, marshal_with, inputs
+from flask_restful import reqparse, fields, marshal, marshal_with, inputs
 from flask_restful.representations.json import output_json
 
-from server import models, utils
-from server.autograder import submit_continuous
+from server import jsoncodec, models, utils
+from server.autograder import record_job_status, record_score, submit_continuous
 from server.constants import STAFF_ROLES, VALID_ROLES, STUDENT_ROLE
 from server.controllers import files
+from server.extensions import cache
+from server.ingest import admission, backup_writer
 from server.jobs import export_grades
 from server.utils import encode_id, decode_id
 
@@ -49,6 +54,15 @@ api = restful.Api(endpoints)
 
 API_VERSION = 'v3'
 
+# Largest number of backups accepted by a single batch request
+MAX_BACKUP_BATCH_SIZE = 100
+
+# How long the result of a backup with an Idempotency-Key is remembered, and
+# how long the key stays claimed while the backup is stored, in case the
+# worker storing it dies
+IDEMPOTENCY_KEY_TIMEOUT = 10 * 60  # seconds
+IDEMPOTENCY_PENDING_TIMEOUT = 60  # seconds
+
 class HashIDField(fields.Raw):
     def format(self, value):
         if type(value) == int:
@@ -127,6 +141,41 @@ def token_authenticate(func):
     return wrapper
 
 
+def server_busy():
+    response = custom_abort(503, 'The server is busy, retry this backup later',
+                            data={'retry_after': admission.retry_after})
+    response.headers['Retry-After'] = str(admission.retry_after)
+    return response
+
+
+def admission_controlled(func):
+    """ Turn away non-submission backups with a 503 and a Retry-After header
+    while the server is saturated or the write-behind queue is full (see
+    server/ingest.py). A request counts as a submission if it or any backup
+    in its batch has submit set.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            data = {}
+        items = data.get('backups')
+        queued = backup_writer.enabled and not isinstance(items, list)
+        if not isinstance(items, list):
+            items = [data]
+        submit = any(isinstance(item, dict) and item.get('submit') for item in items)
+        if not submit and queued and backup_writer.full():
+            return server_busy()
+        token = admission.enter(submit)
+        if token is None:
+            return server_busy()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            admission.exit(token)
+    return wrapper
+
+
 def check_scopes(func):
     """ Check scopes for route against user scopes (if using OAuth)
     """
@@ -156,7 +205,7 @@ def check_scopes(func):
         return func(*args, **kwargs)
     return wrapper
 
-def make_backup(user, assignment_id, messages, submit):
+def make_backup(user, assignment_id, messages, submit, commit=True):
     """
     Create backup with message objects.
 
@@ -164,14 +213,20 @@ def make_backup(user, assignment_id, messages, submit):
     :param assignment: (int) Assignment ID
     :param messages: Data content of backup/submission
     :param submit: Whether this backup is a submission to be graded
+    :param commit: Whether to commit, or only flush the current transaction
     :return: (Backup) backup
     """
     backup = models.Backup.create(submitter=user, assignment_id=assignment_id,
-                           submit=submit)
+                           submit=submit, commit=commit)
+    # Files are stored as a snapshot to keep requests fast. The write-behind
+    # queue and jobs/reencode_backups.py store them as diffs instead.
     backup.messages = [models.Message(kind=k, contents=m)
                        for k, m in messages.items()]
     models.db.session.add(backup)
-    models.db.session.commit()
+    if commit:
+        models.db.session.commit()
+    else:
+        models.db.session.flush()
     return backup
 
 
@@ -185,6 +240,7 @@ def make_score(user, backup, score, message, kind):
     models.db.session.add(score)
     models.db.session.commit()
     score.archive_duplicates()
+    record_score(backup.id)
     return score
 
 ###########
@@ -407,7 +463,8 @@ class BackupSchema(APISchema):
         'count': fields.Integer,
         'limit': fields.Integer,
         'offset': fields.Integer,
-        'has_more': fields.Boolean
+        'has_more': fields.Boolean,
+        'next_cursor': fields.String
     }
 
     full_export_list = {
@@ -415,7 +472,8 @@ class BackupSchema(APISchema):
         'count': fields.Integer,
         'limit': fields.Integer,
         'offset': fields.Integer,
-        'has_more': fields.Boolean
+        'has_more': fields.Boolean,
+        'next_cursor': fields.String
     }
 
     post_fields = {
@@ -434,9 +492,13 @@ class BackupSchema(APISchema):
         self.parser.add_argument('submit', type=bool, default=False,
                                  help='Flagged as a submission')
 
-    def store_backup(self, user):
-        args = self.parse_args()
-        assignment = models.Assignment.name_to_assign_info(args['assignment'])
+    def stage_backup(self, user, name, messages, submit):
+        """ Add a backup to the current transaction without committing it.
+        Returns a tuple of (backup, eligible_submit, error) where ERROR is a
+        message if a late submission was rejected (the backup is still kept).
+        Raises ValueError if the assignment does not exist.
+        """
+        assignment = models.Assignment.name_to_assign_info(name)
 
         if not assignment:
             raise ValueError('Assignment does not exist')
@@ -444,28 +506,126 @@ class BackupSchema(APISchema):
         past_due = dt.utcnow() > assignment['due_date']
 
         # Do not allow submissions after the lock date
-        eligible_submit = args['submit'] and not lock_flag
-        backup = make_backup(user, assignment['id'], args['messages'],
-                             eligible_submit)
-        if args['submit'] and past_due:
-            assign_obj = models.Assignment.by_name(args['assignment'])
-            extension = models.Extension.get_extension(user, assign_obj, time=backup.created)
+        eligible_submit = submit and not lock_flag
+        backup = make_backup(user, assignment['id'], messages,
+                             eligible_submit, commit=False)
+        error = None
+        if submit and past_due:
+            extension = models.Extension.lookup(user.id, assignment['id'])
             # Submissions after the deadline with an extension are allowed
             if extension:
                 backup.submit = True  # Need to set if the assignment is inactive
-                backup.custom_submission_time = extension.custom_submission_time or assign_obj.due_date
+                custom_time = extension.custom_submission_time or assignment['due_date']
+                backup.custom_submission_time = custom_time
                 eligible_submit = True
             elif lock_flag:
-                raise ValueError('Late Submission of {}'.format(args['assignment']))
+                error = 'Late Submission of {}'.format(name)
+        return backup, eligible_submit, error
+
+    def queue_backup(self, user, args):
+        """ Hand a non-submission backup to the write-behind queue.
+        Returns the assignment info, or None if the queue is full. The backup
+        has no ID until it is written.
+        """
+        assignment = models.Assignment.name_to_assign_info(args['assignment'])
+        if not assignment:
+            raise ValueError('Assignment does not exist')
+        if not backup_writer.enqueue(user.id, assignment['id'], args['messages']):
+            return None
+        return assignment
 
+    def store_backup(self, user, args=None):
+        if args is None:
+            args = self.parse_args()
+        backup, eligible_submit, error = self.stage_backup(
+            user, args['assignment'], args['messages'], args['submit'])
         models.db.session.commit()
+        if error:
+            raise ValueError(error)
 
-        if (eligible_submit and assignment['autograding_key']
-                and assignment['continuous_autograding']):
-            submit_continuous(backup)
+        if eligible_submit:
+            submit_continuous_if_enabled(backup)
         return backup
 
 
+def submit_continuous_if_enabled(backup):
+    assignment = backup.assignment
+    if assignment.autograding_key and assignment.continuous_autograding:
+        submit_continuous(backup)
+
+
+class BackupBatchSchema(APISchema):
+    """ Many backups posted at once by the ok client. Each item has the same
+    format as a single backup.
+    """
+    item_fields = {
+        'key': fields.String,
+        'assignment': fields.String,
+        'submit': fields.Boolean,
+        'error': fields.String,
+    }
+
+    post_fields = {
+        'backups': fields.List(fields.Nested(item_fields)),
+    }
+
+    def __init__(self):
+        APISchema.__init__(self)
+        self.parser.add_argument('backups', type=list, required=True,
+                                 location='json', help='List of backups as JSON')
+        self.backup_schema = BackupSchema()
+
+    def store_backups(self, user):
+        """ Stage every backup and commit them in a single transaction.
+        Returns one result per item, in order.
+        """
+        args = self.parse_args()
+        items = args['backups']
+        if len(items) > MAX_BACKUP_BATCH_SIZE:
+            restful.abort(400, message='At most {} backups may be sent at once'
+                                       .format(MAX_BACKUP_BATCH_SIZE))
+        if not all(self.well_formed(item) for item in items):
+            restful.abort(400, message='Each backup needs an assignment and messages')
+
+        try:
+            results = [self.stage_item(user, item) for item in items]
+            models.db.session.commit()
+        except Exception:
+            models.db.session.rollback()
+            raise
+
+        for result in results:
+            backup = result.pop('backup', None)
+            if result.pop('eligible_submit', False):
+                submit_continuous_if_enabled(backup)
+            if backup:
+                result['key'] = encode_id(backup.id)
+                result['submit'] = backup.submit
+        return {'backups': results}
+
+    @staticmethod
+    def well_formed(item):
+        if not isinstance(item, dict) or not isinstance(item.get('assignment'), str):
+            return False
+        return isinstance(item.get('messages'), dict)
+
+    def stage_item(self, user, item):
+        """ Stage the backup in ITEM, unless it is rejected (such as when it is
+        late). Returns its result, with the staged backup and whether it may
+        be autograded once it is committed.
+        """
+        result = {'assignment': item['assignment'], 'submit': False}
+        submit = bool(item.get('submit', False))
+        try:
+            backup, eligible_submit, error = self.backup_schema.stage_backup(
+                user, item['assignment'], item['messages'], submit)
+        except ValueError as e:
+            result['error'] = str(e)
+        else:
+            result.update(error=error, backup=backup, eligible_submit=eligible_submit)
+        return result
+
+
 class VersionSchema(APISchema):
 
     version_fields = {
@@ -529,6 +689,22 @@ class ScoreSchema(APISchema):
             return {'success': True, 'message': 'OK'}
         return {'success': False, 'message': "Permission error"}
 
+class AutograderJobSchema(APISchema):
+
+    post_fields = {
+        'success': fields.Boolean,
+        'message': fields.String
+    }
+
+    def __init__(self):
+        APISchema.__init__(self)
+        self.parser.add_argument('bid', type=str, required=True,
+                                 help='ID of the graded submission')
+        self.parser.add_argument('status', type=str, required=True,
+                                 choices=('queued', 'started', 'deferred',
+                                          'finished', 'failed'),
+                                 help='Status of the job')
+
 class CommentSchema(APISchema):
     post_fields = {}
     comment_fields = {
@@ -652,21 +828,52 @@ class Backup(Resource):
             return restful.abort(403)
         if not self.model.can(backup, user, 'view'):
             return restful.abort(403)
-        backup.group = [models.User.get_by_id(uid) for uid in backup.owners()]
+        owners = models.User.get_by_ids(backup.owners())
+        backup.group = [owners[uid] for uid in sorted(owners)]
         return backup
 
+    @admission_controlled
     @marshal_with(schema.post_fields)
     def post(self, user, key=None):
         if key is not None:
             restful.abort(405)
+        # Clients may retry a backup with the same Idempotency-Key header.
+        # The first request claims the key and later ones get its result.
+        request_key = request.headers.get('Idempotency-Key')
+        cache_key = request_key and 'backup-request/{}/{}'.format(user.id, request_key)
+        if cache_key and not self.claim(cache_key):
+            return self.replay(cache.get(cache_key))
         try:
-            backup = self.schema.store_backup(user)
+            result = self.store(user)
+        except Exception:
+            if cache_key:
+                cache.delete(cache_key)
+            raise
+        if cache_key:
+            cache.set(cache_key, result, timeout=IDEMPOTENCY_KEY_TIMEOUT)
+        return self.replay(result)
+
+    def store(self, user):
+        """ Store the backup in the request, or queue it for the write-behind
+        queue. Returns the result that replay responds with.
+        """
+        args = self.schema.parse_args()
+        try:
+            # Queue non-submission backups. If the queue filled up after
+            # admission_controlled checked it, store the backup directly.
+            queue = backup_writer.enabled and not args['submit']
+            if queue and self.schema.queue_backup(user, args):
+                return ('queued', args['assignment'])
+            backup = self.schema.store_backup(user, args)
         except ValueError as e:
             data = {'backup': True}
             if 'late' in str(e).lower():
                 data['late'] = True
-            return restful.abort(403, message=str(e), data=data)
+            # A late backup has been stored, so retries get the same answer
+            return ('rejected', str(e), data)
+        return backup.id
 
+    def created(self, backup):
         assignment = backup.assignment
         return {
             'email': current_user.email,
@@ -677,6 +884,58 @@ class Backup(Resource):
             'assignment': assignment.name
         }
 
+    def queued(self, assignment):
+        """ Acknowledge a backup that will be written by the write-behind
+        queue. It does not have a key yet.
+        """
+        return {
+            'email': current_user.email,
+            'key': None,
+            'course': models.Course.query.get(assignment['course_id']),
+            'assignment': assignment['name']
+        }
+
+    def claim(self, cache_key):
+        """ Claim the Idempotency-Key in CACHE_KEY for this request. Returns
+        False if another request holds it or has left its result there.
+        """
+        if cache.add(cache_key, 'pending', timeout=IDEMPOTENCY_PENDING_TIMEOUT):
+            return True
+        if cache.get(cache_key) is not None:
+            return False
+        # The key expired, but some caches (such as SimpleCache) still refuse
+        # to add it again
+        cache.delete(cache_key)
+        return cache.add(cache_key, 'pending', timeout=IDEMPOTENCY_PENDING_TIMEOUT)
+
+    def replay(self, result):
+        """ Respond with the RESULT of storing a backup. Retried requests get
+        the result of the original, without storing the backup again.
+        """
+        if result is None or result == 'pending':
+            return restful.abort(409, message='This backup is still being stored')
+        if isinstance(result, tuple) and result[0] == 'rejected':
+            _, message, data = result
+            return restful.abort(403, message=message, data=data)
+        if isinstance(result, tuple):
+            _, name = result
+            return self.queued(models.Assignment.name_to_assign_info(name))
+        return self.created(self.model.query.get(result))
+
+
+class BackupBatch(Resource):
+    """ Creation of many backups in one request and transaction
+        Authenticated. Permissions: >= User/Staff
+        Used by: Ok Client
+    """
+    schema = BackupBatchSchema()
+    model = models.Backup
+
+    @admission_controlled
+    @marshal_with(schema.post_fields)
+    def post(self, user):
+        return self.schema.store_backups(user)
+
 
 class Revision(Resource):
     """ Like Backup, but creates composition revisions backups post-deadline
@@ -740,6 +999,35 @@ class Revision(Resource):
         }
 
 
+def after_cursor(query, cursor):
+    """ Filter QUERY, ordered by (created, id) descending, to the backups
+    after the position in CURSOR (see utils.encode_cursor).
+    """
+    created, backup_id = cursor[:2]
+    # Compare against the stored row when it still exists, so that the
+    # comparison does not depend on how the database rounds timestamps
+    last_created = models.db.func.coalesce(
+        models.db.select([models.Backup.created])
+        .where(models.Backup.id == backup_id)
+        .as_scalar(),
+        created)
+    return query.filter(models.db.or_(
+        models.Backup.created < last_created,
+        models.db.and_(models.Backup.created == last_created,
+                       models.Backup.id < backup_id)))
+
+def parse_cursor():
+    """ Return the decoded cursor argument of the request, '' for the first
+    page, or None if the request uses offsets instead.
+    """
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return cursor
+    try:
+        return utils.decode_cursor(cursor)
+    except ValueError:
+        restful.abort(400, message='Invalid cursor')
+
 class ExportBackup(Resource):
     """ Export backup retreival resource without submitter information
         Authenticated. Permissions: >= Staff
@@ -755,6 +1043,7 @@ class ExportBackup(Resource):
 
         limit = request.args.get('limit', 150, type=int)
         offset = request.args.get('offset', 0, type=int)
+        cursor = parse_cursor()
 
         if not assign or not target:
             if user.is_admin:
@@ -767,18 +1056,31 @@ class ExportBackup(Resource):
         base_query = (models.Backup.query.filter(
             models.Backup.submitter_id == target.id,
             models.Backup.assignment_id == assign.id,
-        ).order_by(models.Backup.created.desc()))
-
-        backups = base_query.limit(limit).offset(offset)
-
-        num_backups = base_query.count()
-        has_more = ((num_backups - offset) - limit) > 0
+        ).order_by(models.Backup.created.desc(), models.Backup.id.desc()))
 
-        data = {'backups': backups.all(),
+        if cursor is None:
+            backups = base_query.limit(limit).offset(offset).all()
+            num_backups = base_query.count()
+            has_more = ((num_backups - offset) - limit) > 0
+        else:
+            # Keyset pagination: fetch one extra row to see if there are more
+            if cursor:
+                base_query = after_cursor(base_query, cursor)
+            backups = base_query.limit(limit + 1).all()
+            num_backups = None
+            has_more = len(backups) > limit
+            backups = backups[:limit]
+
+        next_cursor = None
+        if has_more and backups:
+            next_cursor = utils.encode_cursor(backups[-1].created, backups[-1].id)
+
+        data = {'backups': backups,
                 'count': num_backups,
                 'limit': limit,
                 'offset': offset,
-                'has_more':  has_more}
+                'has_more':  has_more,
+                'next_cursor': next_cursor}
         return data
 
 class ExportFinal(Resource):
@@ -789,6 +1091,37 @@ class ExportFinal(Resource):
     schema = BackupSchema()
     model = models.Assignment
 
+    # Seconds to keep the final submissions of an export that is being paged
+    snapshot_timeout = 600
+
+    @staticmethod
+    def final_keys(assign):
+        """ Return the (created, id) keys of the final submissions of ASSIGN,
+        ordered from most recent.
+        """
+        subms = assign.course_submissions(include_empty=False)
+        subm_keys = set(s['backup']['id'] for s in subms)
+        rows = (models.db.session.query(models.Backup.created, models.Backup.id)
+                .filter(models.Backup.id.in_(subm_keys)))
+        return sorted(((utils.timestamp_micros(created), backup_id)
+                       for created, backup_id in rows), reverse=True)
+
+    def snapshot(self, assign, snapshot_id=None):
+        """ Return the id of a snapshot of the final submissions of ASSIGN,
+        and its keys (see final_keys). The snapshot with SNAPSHOT_ID is reused
+        if it is still cached, so that later pages do not have to find every
+        final submission again.
+        """
+        if snapshot_id is not None:
+            keys = cache.get('export-final/{}/{}'.format(assign.id, snapshot_id))
+            if keys is not None:
+                return snapshot_id, keys
+        keys = self.final_keys(assign)
+        snapshot_id = random.randrange(1 << 31)
+        cache.set('export-final/{}/{}'.format(assign.id, snapshot_id), keys,
+                  timeout=self.snapshot_timeout)
+        return snapshot_id, keys
+
     @marshal_with(schema.full_export_list)
     def get(self, user, name):
         assign = models.Assignment.by_name(name)
@@ -800,44 +1133,139 @@ class ExportFinal(Resource):
 
         limit = request.args.get('limit', 150, type=int)
         offset = request.args.get('offset', 0, type=int)
+        cursor = parse_cursor()
 
         if not self.model.can(assign, user, 'export'):
             return restful.abort(403)
 
-        subms = assign.course_submissions(include_empty=False)
-
-        output = []
-        subm_keys = set(s['backup']['id'] for s in subms)
+        if cursor:
+            created, backup_id = cursor[:2]
+            snapshot_id = cursor[2] if len(cursor) > 2 else None
+            snapshot_id, keys = self.snapshot(assign, snapshot_id)
+            last = (utils.timestamp_micros(created), backup_id)
+            start = next((i for i, key in enumerate(keys) if key < last),
+                         len(keys))
+        elif cursor == '':
+            snapshot_id, keys = self.snapshot(assign)
+            start = 0
+        else:
+            # Offset pages are not snapshotted. Their next_cursor takes a
+            # snapshot if the client switches to cursors.
+            snapshot_id, keys = None, self.final_keys(assign)
+            start = offset
+        page = [backup_id for _, backup_id in keys[start:start + limit]]
+        num_subms = len(keys)
+        has_more = start + limit < num_subms
+
+        # Load everything the page needs in a fixed number of queries
         joined = models.db.joinedload
-        base_query = (models.Backup.query.options(joined('assignment'),
-                                                  joined('submitter'),
-                                                  joined('messages'))
-                            .filter(models.Backup.id.in_(subm_keys))
-                            .order_by(models.Backup.created.desc()))
-
-        num_subms = len(subm_keys)
-        output = base_query.limit(limit).offset(offset)
-        has_more = ((num_subms - offset) - limit) > 0
+        backups = {backup.id: backup for backup in
+                   models.Backup.query.options(joined('assignment'),
+                                               joined('submitter'),
+                                               joined('messages'),
+                                               models.db.selectinload('external_files'))
+                                      .filter(models.Backup.id.in_(page))}
+        owners = assign.active_user_ids_many(b.submitter_id for b in backups.values())
+        users = models.User.get_by_ids(uid for uids in owners.values() for uid in uids)
+        messages = [m for backup in backups.values() for m in backup.messages]
+        contents = dict(zip(messages, models.Message.decode_many(messages)))
 
         results = []
-        for backup in output:
+        for backup_id in page:
+            backup = backups[backup_id]
             data = backup.as_dict()
             data.update({
-                'group': [models.User.get_by_id(uid) for uid in backup.owners()],
+                'group': [users[uid] for uid in sorted(owners[backup.submitter_id])],
                 'assignment': assign,
                 'is_late': backup.is_late,
                 'external_files': backup.external_files,
                 'submission_time': backup.submission_time,
                 'submitter': backup.submitter,
-                'messages': backup.messages
+                'messages': [{'kind': m.kind, 'contents': contents[m],
+                              'created': m.created}
+                             for m in backup.messages]
             })
             results.append(data)
 
+        next_cursor = None
+        if has_more and page:
+            last = backups[page[-1]]
+            extra = [] if snapshot_id is None else [snapshot_id]
+            next_cursor = utils.encode_cursor(last.created, last.id, *extra)
+
         return {'backups': results,
                 'limit': limit,
                 'offset': offset,
                 'count': num_subms,
-                'has_more': has_more}
+                'has_more': has_more,
+                'next_cursor': next_cursor}
+
+class ExportFinalStream(Resource):
+    """ Stream every final submission of an assignment
+        Authenticated. Permissions: >= Staff
+        Used by: Grading pipelines
+    """
+    schema = None
+    model = models.Assignment
+
+    # Number of backups whose files are loaded at once
+    batch_size = 100
+
+    def get(self, user, name):
+        assign = models.Assignment.by_name(name)
+
+        if not assign:
+            if user.is_admin:
+                return restful.abort(404)
+            return restful.abort(403)
+
+        if not self.model.can(assign, user, 'export'):
+            return restful.abort(403)
+
+        subms = assign.course_submissions(include_empty=False)
+        emails = {s['user']['id']: s['user']['email'] for s in subms}
+        backup_ids = {s['backup']['id'] for s in subms}
+        return Response(stream_with_context(self.generate(assign, backup_ids, emails)),
+                        mimetype='application/x-ndjson')
+
+    def generate(self, assign, backup_ids, emails):
+        """ Yield a line of JSON for each backup in BACKUP_IDS, from most
+        recent. Backups and their files are loaded a batch at a time, and the
+        session only holds weak references to them, so memory stays bounded.
+        """
+        members = models.Group.assignment_members(assign.id)
+        order = [backup_id for backup_id, in
+                 models.db.session.query(models.Backup.id)
+                                  .filter(models.Backup.id.in_(backup_ids))
+                                  .order_by(models.Backup.created.desc(),
+                                            models.Backup.id.desc())]
+        for i in range(0, len(order), self.batch_size):
+            batch = order[i:i + self.batch_size]
+            backups = {b.id: b for b in
+                       models.Backup.query.filter(models.Backup.id.in_(batch))}
+            files = models.Backup.files_many(batch)
+
+            for backup_id in batch:
+                backup = backups[backup_id]
+                owners = members.get(backup.submitter_id, {backup.submitter_id})
+                record = {
+                    'id': backup.hashid,
+                    'created': backup.created.isoformat(),
+                    'submission_time': backup.submission_time.isoformat(),
+                    'submit': backup.submit,
+                    'flagged': backup.flagged,
+                    'is_late': backup.is_late,
+                    'submitter': self.email(emails, backup.submitter_id),
+                    'group': sorted(self.email(emails, uid) for uid in owners),
+                    'files': files.get(backup_id, {}),
+                }
+                yield jsoncodec.dumps(record) + b'\n'
+
+    @staticmethod
+    def email(emails, user_id):
+        if user_id not in emails:
+            emails[user_id] = models.User.email_by_id(user_id)
+        return emails[user_id]
 
 class Enrollment(Resource):
     """ View what courses an email is enrolled in
@@ -873,19 +1301,13 @@ class CourseEnrollment(Resource):
     model = models.Course
     schema = CourseEnrollmentSchema()
 
-    @marshal_with(schema.get_fields)
     def get(self, offering, user):
         course = self.model.by_name(offering)
         if course is None:
             restful.abort(404)
         if not self.model.can(course, user, 'staff'):
             restful.abort(403)
-        data = {}
-        for role in VALID_ROLES:
-            data[role] = []
-        for p in course.participations:
-            data[p.role].append(p.user)
-        return data
+        return course_enrollment_response(course)
 
 class CourseEnrollmentExport(TokenResource):
     """ Information about all people in a course
@@ -894,30 +1316,101 @@ class CourseEnrollmentExport(TokenResource):
     model = models.Course
     schema = CourseEnrollmentSchema()
 
-    @marshal_with(schema.get_fields)
     def get(self, offering):
         course = self.model.by_name(offering)
         if course is None:
             restful.abort(404)
-        data = {}
-        for role in VALID_ROLES:
-            data[role] = []
-        for p in course.participations:
-            data[p.role].append(p.user)
-        return data
+        return course_enrollment_response(course)
 
-def course_roster_helper(course):
+def version_etag(version, *keys):
+    """ Return an ETag for the response to KEYS at a VERSION from
+    Course.cache_version.
+    """
+    return hashlib.md5('/'.join((version,) + keys).encode()).hexdigest()
+
+def not_modified(etag):
+    """ Return an empty 304 response if the client already has ETAG."""
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+def stream_envelope(data, key, chunks, headers=None):
+    """ Return a streamed JSON response like envelope_api(DATA), in which
+    DATA[KEY] is the string made of CHUNKS.
+    """
+    fields = ''.join('{}: {}, '.format(json.dumps(k), json.dumps(v))
+                     for k, v in data.items())
+    head = '{' + fields + json.dumps(key) + ': "'
+    tail = '"}'
+    if request.args.get('envelope') != 'false':
+        head = '{"data": ' + head
+        tail += ', "code": 200, "message": "success"}'
+
+    def generate():
+        yield head
+        for chunk in chunks:
+            yield json.dumps(chunk)[1:-1]
+        yield tail
+
+    return Response(stream_with_context(generate()), mimetype='application/json',
+                    headers=headers)
+
+def course_enrollment_response(course):
+    """ Return the users in COURSE by role, or a 304 if the client already
+    has them.
+    """
+    etag = version_etag(models.Course.cache_version(course.id, 'roster'),
+                        'enrollment')
+    response = not_modified(etag)
+    if response:
+        return response
+    data = {role: [] for role in VALID_ROLES}
+    enrollments = (models.Enrollment.query.options(models.db.joinedload('user'))
+                   .filter_by(course_id=course.id))
+    for p in enrollments:
+        data[p.role].append(p.user)
+    return (marshal(data, CourseEnrollmentSchema.get_fields), 200,
+            {'ETag': '"{}"'.format(etag)})
+
+def course_roster_rows(course, chunk_size=500):
+    """ Yield the roster of COURSE as CSV, a chunk of rows at a time. The
+    ids of the students are read first, and then each chunk is loaded by id.
+    """
     query = (models.Enrollment.query.options(models.db.joinedload('user'))
-                    .filter_by(course_id=course.id)
-                    .filter(models.Enrollment.role.in_([STUDENT_ROLE]))
-                    .order_by(models.Enrollment.role))
+             .filter(models.Enrollment.course_id == course.id,
+                     models.Enrollment.role == STUDENT_ROLE)
+             .order_by(models.Enrollment.user_id))
+    user_ids = [user_id for user_id, in
+                query.with_entities(models.Enrollment.user_id)]
     items = models.User.export_items + models.Enrollment.export_items
 
-    def row_to_csv(row):
-        return [row.export, row.user.export]
+    f = io.StringIO()
+    writer = csv.DictWriter(f, fieldnames=items)
+    # Yield Column Info as first row
+    yield ','.join(items) + '\n'
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        for enrollment in query.filter(models.Enrollment.user_id.in_(chunk)):
+            data = dict(enrollment.export)
+            data.update(enrollment.user.export)
+            writer.writerow(data)
+        yield f.getvalue()
+        f.seek(0)
+        f.truncate()
 
-    csv_generator = utils.generate_csv(query, items, row_to_csv)
-    return ''.join(list(csv_generator))
+def course_roster_response(course, requester):
+    """ Return the roster of COURSE for REQUESTER, streamed, or a 304 if the
+    client already has it.
+    """
+    etag = version_etag(models.Course.cache_version(course.id, 'roster'),
+                        'roster', requester)
+    response = not_modified(etag)
+    if response:
+        return response
+    return stream_envelope({'requester': requester}, 'roster',
+                           course_roster_rows(course),
+                           headers={'ETag': '"{}"'.format(etag)})
 
 class CourseRosterExport(TokenResource):
     """ Information about all students in a course
@@ -927,14 +1420,9 @@ class CourseRosterExport(TokenResource):
     model = models.Course
     schema = CourseRosterSchema()
 
-    @marshal_with(schema.get_fields)
     def get(self, offering):
         course = self.model.by_name(offering)
-        csv_data = course_roster_helper(course)
-        return {
-            'requester': 'export_access_token',
-            'roster': csv_data
-        }
+        return course_roster_response(course, 'export_access_token')
 
 class CourseRoster(Resource):
     """ Information about all students in a course
@@ -943,19 +1431,13 @@ class CourseRoster(Resource):
     model = models.Course
     schema = CourseRosterSchema()
 
-    @marshal_with(schema.get_fields)
     def get(self, offering, user):
         course = self.model.by_name(offering)
         if course is None:
             restful.abort(404)
         if not self.model.can(course, user, 'staff'):
             restful.abort(403)
-
-        csv_data = course_roster_helper(course)
-        return {
-            'requester': user.email,
-            'roster': csv_data
-        }
+        return course_roster_response(course, user.email)
 
 class CourseAssignment(PublicResource):
     """ All assignments for a course
@@ -974,9 +1456,10 @@ class CourseAssignment(PublicResource):
 def course_grades_helper(course):
     assignments = course.assignments
     students = (models.Enrollment.query
-                    .options(models.db.joinedload('user'))
-                    .filter(models.Enrollment.role == STUDENT_ROLE, models.Enrollment.course == course)
-                    .all())
+                .options(models.db.joinedload('user'))
+                .filter(models.Enrollment.role == STUDENT_ROLE,
+                        models.Enrollment.course == course)
+                .all())
 
     headers, assignments = export_grades.get_headers(assignments)
 
@@ -997,6 +1480,26 @@ def course_grades_helper(course):
         csv_bytes = io.BytesIO(bytearray(f.read(), 'utf-8'))
     return csv_bytes
 
+def course_grades_response(course, requester):
+    """ Return the grades of COURSE for REQUESTER. The grade sheet is cached
+    until the grades of the course change, and clients that send the ETag of
+    the current sheet get an empty 304 response.
+    """
+    version = models.Course.cache_version(course.id, 'grades')
+    etag = version_etag(version, 'grades', requester)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    key = 'course-grades/{}/{}'.format(course.id, version)
+    grades = cache.get(key)
+    if grades is None:
+        grades = course_grades_helper(course).getvalue().decode('utf-8')
+        cache.set(key, grades, timeout=3600)
+    data = marshal({'requester': requester, 'grades': grades},
+                   CourseGradesSchema.get_fields)
+    return data, 200, {'ETag': '"{}"'.format(etag)}
+
 class CourseGradesExport(TokenResource):
     """ All grades for a given course
         Authenticated. Permissions: Export Token
@@ -1005,14 +1508,9 @@ class CourseGradesExport(TokenResource):
     model = models.Course
     schema = CourseGradesSchema()
 
-    @marshal_with(schema.get_fields)
     def get(self, offering):
         course = self.model.by_name(offering)
-        csv_bytes = course_grades_helper(course)
-        return {
-            "requester": "export_access_token",
-            "grades": csv_bytes.getvalue().decode('utf-8')
-        }
+        return course_grades_response(course, "export_access_token")
 
 class CourseGrades(Resource):
     """ All grades for a given course
@@ -1021,7 +1519,6 @@ class CourseGrades(Resource):
     schema = CourseGradesSchema()
     model = models.Course
 
-    @marshal_with(schema.get_fields)
     def get(self, offering, user):
         if offering is None:
             restful.abort(405)
@@ -1030,11 +1527,7 @@ class CourseGrades(Resource):
         if not self.model.can(course, user, 'export'):
             return restful.abort(403)
 
-        csv_bytes = course_grades_helper(course)
-        return {
-            "requester": user.email,
-            "grades": csv_bytes.getvalue().decode('utf-8')
-        }
+        return course_grades_response(course, user.email)
 
 
 class Score(Resource):
@@ -1056,6 +1549,29 @@ class Score(Resource):
         }
 
 
+class AutograderJob(Resource):
+    """ Notification that an autograder job changed status.
+        Authenticated. Permissions: >= Staff
+        Used by: Autograder.
+    """
+    schema = AutograderJobSchema()
+
+    @marshal_with(schema.post_fields)
+    def post(self, user, job_id):
+        args = self.schema.parse_args()
+        try:
+            bid = decode_id(args['bid'])
+        except (ValueError, TypeError):
+            restful.abort(404)
+        backup = models.Backup.query.get(bid)
+        if not backup:
+            restful.abort(404)
+        if not models.Backup.can(backup, user, 'grade'):
+            restful.abort(403)
+        record_job_status(backup.id, job_id, args['status'])
+        return {'success': True, 'message': 'OK'}
+
+
 class Version(PublicResource):
     """ Current version of a client
         Permissions: World Readable, Staff Writable
@@ -1275,6 +1791,7 @@ api.add_resource(V3Info, '/v3/')
 
 # Submission endpoints
 api.add_resource(Backup, '/v3/backups/', '/v3/backups/<string:key>/')
+api.add_resource(BackupBatch, '/v3/backups/batch/')
 api.add_resource(Revision, '/v3/revision/')
 
 # Backup Actions
@@ -1286,6 +1803,7 @@ api.add_resource(Assignment, ASSIGNMENT_BASE)
 api.add_resource(Group, ASSIGNMENT_BASE + '/group/<string:email>')
 api.add_resource(ExportBackup, ASSIGNMENT_BASE + '/export/<string:email>')
 api.add_resource(ExportFinal, ASSIGNMENT_BASE + '/submissions/')
+api.add_resource(ExportFinalStream, ASSIGNMENT_BASE + '/submissions/stream')
 
 # Course Info
 COURSE_BASE = '/v3/course/<offering:offering>'
@@ -1300,6 +1818,7 @@ api.add_resource(CourseGradesExport, COURSE_BASE + '/export/grades')
 # Other
 api.add_resource(Enrollment, '/v3/enrollment/<string:email>/')
 api.add_resource(Score, '/v3/score/')
+api.add_resource(AutograderJob, '/v3/autograder/jobs/<string:job_id>')
 api.add_resource(User, '/v3/user/', '/v3/user/<string:email>')
 api.add_resource(Version, '/v3/version/', '/v3/version/<string:name>')
 api.add_resource(File, '/v3/file/<hashid:file_id>')
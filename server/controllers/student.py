@@ -327,7 +327,7 @@ def download(name, submit, bid, file):
         return redirect(url_for('.download', name=name, submit=backup.submit,
                                 bid=bid, file=file))
     try:
-        contents = backup.files()[file]
+        contents = backup.file(file)
     except KeyError:
         abort(404)
     response = make_response(contents)
@@ -0,0 +1,311 @@
+""" Write-behind ingest of backups.
+
+Non-submission backups (autosaves) make up most of the write load near
+deadlines. When BACKUP_WRITE_BEHIND is enabled, the API acknowledges them right
+away and a background thread in each worker process writes the buffered
+backups in bulk. Submissions always take the synchronous path.
+
+The queue lives in process memory: a backup is acknowledged before it is
+durable, and backups still queued when a worker is killed (rather than shut
+down cleanly) are lost. Write-behind is therefore off by default; only enable
+it where losing the last few seconds of autosaves is acceptable. Backups that
+cannot be written after BACKUP_WRITE_BEHIND_MAX_ATTEMPTS tries are logged in
+full to the server.ingest.dead_letter logger so that they can be replayed.
+
+AdmissionController sheds non-submission backups when the site is saturated,
+so that submissions keep flowing near deadlines. Its signals are shared by
+every worker: Gunicorn's sync workers only ever handle one request each.
+"""
+import atexit
+import collections
+import datetime as dt
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import has_app_context
+from flask_rq import get_connection
+import redis.exceptions
+from sqlalchemy.exc import SQLAlchemyError
+
+from server.models import db, Backup, Extension, Message
+
+logger = logging.getLogger(__name__)
+dead_letter_logger = logging.getLogger(__name__ + '.dead_letter')
+
+PendingBackup = collections.namedtuple(
+    'PendingBackup',
+    ['submitter_id', 'assignment_id', 'messages', 'created', 'attempts'])
+
+
+def write_backups(pending):
+    """ Insert PENDING backups and their messages in one transaction.
+    Backups are flushed together and messages are inserted in bulk. Like
+    Backup.create, backups made by a student with an active extension are
+    marked as submissions.
+    """
+    backups = []
+    for item in pending:
+        backup = Backup(submitter_id=item.submitter_id,
+                        assignment_id=item.assignment_id,
+                        submit=False, created=item.created)
+        extension = Extension.lookup(item.submitter_id, item.assignment_id,
+                                     time=item.created)
+        if extension:
+            backup.submit = True
+            backup.custom_submission_time = extension.custom_submission_time
+        backups.append(backup)
+
+    # Files are stored against each submitter's latest files. Backups in this
+    # batch all use the same base since their messages have no ids yet.
+    bases = Message.latest_files_many([(p.submitter_id, p.assignment_id)
+                                       for p in pending])
+    base_files = dict(zip(bases.keys(),
+                          Message.decode_many(list(bases.values()))))
+
+    db.session.add_all(backups)
+    db.session.flush()
+    messages = []
+    for backup, item in zip(backups, pending):
+        key = (item.submitter_id, item.assignment_id)
+        messages.extend(Message(backup_id=backup.id, kind=kind, contents=contents,
+                                base=bases.get(key), base_files=base_files.get(key))
+                        for kind, contents in item.messages.items())
+    db.session.bulk_save_objects(messages)
+    db.session.commit()
+    return backups
+
+
+class BackupWriter:
+    """ Buffers backups in memory and drains them with write_backups.
+    The drain thread is started lazily so that each forked worker gets its own.
+    """
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.interval = 1.0
+        self.batch_size = 500
+        self.max_size = 10000
+        self.max_attempts = 5
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('BACKUP_WRITE_BEHIND', False)
+        self.interval = app.config.get('BACKUP_WRITE_BEHIND_INTERVAL', 1.0)
+        self.batch_size = app.config.get('BACKUP_WRITE_BEHIND_BATCH_SIZE', 500)
+        self.max_size = app.config.get('BACKUP_WRITE_BEHIND_MAX_QUEUE', 10000)
+        self.max_attempts = app.config.get('BACKUP_WRITE_BEHIND_MAX_ATTEMPTS', 5)
+        if self.enabled:
+            atexit.register(self.close)
+
+    def full(self):
+        return len(self.queue) >= self.max_size
+
+    def enqueue(self, submitter_id, assignment_id, messages):
+        """ Queue a backup to be written. Returns False if the queue is full,
+        in which case the backup was not queued.
+        """
+        if self.full():
+            return False
+        self.queue.append(PendingBackup(submitter_id, assignment_id, messages,
+                                        dt.datetime.utcnow(), 0))
+        self.start()
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+        return True
+
+    def start(self):
+        """ Start the drain thread if this process does not have one yet."""
+        if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name='backup-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not write queued backups')
+
+    def flush(self):
+        """ Write every queued backup. Returns the number of backups written.
+        Backups that fail are put back on the queue to be retried on the next
+        flush, until they run out of attempts and are dead-lettered.
+        """
+        if has_app_context():
+            return self._drain()
+        with self.app.app_context():
+            return self._drain()
+
+    def close(self):
+        """ Flush the queue on shutdown and dead-letter whatever is left."""
+        try:
+            self.flush()
+        finally:
+            while self.queue:
+                self.dead_letter(self.queue.popleft())
+
+    def _drain(self):
+        written = 0
+        with self.lock:
+            while self.queue:
+                size = min(len(self.queue), self.batch_size)
+                batch = [self.queue.popleft() for _ in range(size)]
+                try:
+                    write_backups(batch)
+                    written += len(batch)
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    logger.exception('Could not write a batch of %d backups',
+                                     len(batch))
+                    done, retry = self._write_each(batch)
+                    written += done
+                    if retry:
+                        # Wait for the next flush instead of retrying right away
+                        self.queue.extendleft(reversed(retry))
+                        break
+        return written
+
+    def _write_each(self, batch):
+        """ Write the backups of a failed BATCH one at a time, so that one bad
+        backup does not hold up the rest. Returns the number written and the
+        backups to retry.
+        """
+        written, retry = 0, []
+        for item in batch:
+            try:
+                write_backups([item])
+                written += 1
+            except SQLAlchemyError:
+                db.session.rollback()
+                item = item._replace(attempts=item.attempts + 1)
+                if item.attempts >= self.max_attempts:
+                    self.dead_letter(item)
+                else:
+                    retry.append(item)
+        return written, retry
+
+    def dead_letter(self, item):
+        """ Give up on writing ITEM and log it in full so it can be replayed."""
+        dead_letter_logger.error(json.dumps({
+            'submitter_id': item.submitter_id,
+            'assignment_id': item.assignment_id,
+            'messages': item.messages,
+            'created': item.created.isoformat(),
+            'attempts': item.attempts,
+        }))
+
+
+class AdmissionController:
+    """ Turns away non-submission backups while the site is saturated, so that
+    submissions keep getting through. Both signals are shared by every worker:
+    the backup writes in flight are kept in a sorted set in Redis, and the
+    number of connections to the database is read from MySQL.
+
+    Each write adds a token scored by the time it started and removes it when
+    it is done. Tokens older than IN_FLIGHT_TTL are dropped before counting, so
+    the slot of a worker that died mid-write frees up even while other writes
+    keep arriving.
+    """
+    in_flight_key = 'ok:backups-in-flight'
+    # Seconds a worker reuses the connection counts, and that a write counts
+    # as in flight, in case a worker died mid-write
+    status_ttl = 1
+    in_flight_ttl = 60
+
+    def __init__(self, app=None):
+        self.max_in_flight = 0
+        self.pool_reserve = 0
+        self.retry_after = 5
+        self.redis = None
+        self.status = (0, None)
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_in_flight = app.config.get('BACKUP_MAX_IN_FLIGHT', 0)
+        self.pool_reserve = app.config.get('BACKUP_POOL_RESERVE', 0)
+        self.retry_after = app.config.get('BACKUP_RETRY_AFTER', 5)
+
+    def connection(self):
+        if self.redis is None:
+            self.redis = get_connection()
+        return self.redis
+
+    def connection_counts(self):
+        """ Return the number of connections to the database and the most it
+        accepts, or None if the database does not say (such as SQLite).
+        """
+        if db.engine.dialect.name != 'mysql':
+            return None
+        with db.engine.connect() as conn:
+            connected = conn.execute("SHOW GLOBAL STATUS LIKE 'Threads_connected'")
+            limit = conn.execute('SELECT @@max_connections')
+            return int(connected.first()[1]), int(limit.scalar())
+
+    def database_saturated(self):
+        """ Whether at most POOL_RESERVE connections to the database are left."""
+        checked, counts = self.status
+        if time.time() - checked > self.status_ttl:
+            counts = self.connection_counts()
+            self.status = (time.time(), counts)
+        if not counts:
+            return False
+        connected, limit = counts
+        return connected >= limit - self.pool_reserve
+
+    def enter(self, submit):
+        """ Admit a write, unless it is not a submission and we are saturated.
+        Returns None if it was turned away. Otherwise returns a token to pass
+        to exit once the write is done.
+        """
+        if not submit and self.database_saturated():
+            return None
+        if not self.max_in_flight:
+            return ''
+        token = os.urandom(8).hex()
+        now = time.time()
+        try:
+            pipe = self.connection().pipeline()
+            pipe.zremrangebyscore(self.in_flight_key, '-inf', now - self.in_flight_ttl)
+            pipe.zadd(self.in_flight_key, **{token: now})
+            pipe.zcard(self.in_flight_key)
+            pipe.expire(self.in_flight_key, self.in_flight_ttl)
+            in_flight = pipe.execute()[2]
+        except redis.exceptions.RedisError:
+            logger.exception('Could not count backups in flight')
+            return ''
+        if not submit and in_flight > self.max_in_flight:
+            self.exit(token)
+            return None
+        return token
+
+    def exit(self, token):
+        if not token:
+            return
+        try:
+            self.connection().zrem(self.in_flight_key, token)
+        except redis.exceptions.RedisError:
+            logger.exception('Could not count backups in flight')
+
+    def in_flight(self):
+        return self.connection().zcount(self.in_flight_key,
+                                        time.time() - self.in_flight_ttl, '+inf')
+
+
+backup_writer = BackupWriter()
+admission = AdmissionController()
@@ -23,6 +23,9 @@ def grade_on_effort(assignment_id, full_credit, late_multiplier, required_questi
     for score in scores:
         db.session.delete(score)
 
+    backups = {backup.id: backup for backup in Backup.query.filter(
+        Backup.id.in_({subm['backup']['id'] for subm in submissions}))}
+
     seen = set()
     stats = Counter()
     manual, late, not_perfect = [], [], []
@@ -31,7 +34,7 @@ def grade_on_effort(assignment_id, full_credit, late_multiplier, required_questi
         if user_id in seen:
             continue
 
-        latest_backup = Backup.query.get(subm['backup']['id'])
+        latest_backup = backups[subm['backup']['id']]
         submission_time = get_submission_time(latest_backup, assignment)
         backup, submission_time = find_best_scoring(latest_backup,
                 submission_time, assignment, required_questions, full_credit)
@@ -130,7 +133,7 @@ def get_submission_time(backup, assignment):
     If the extension's ``custom_submission_time`` is None, assume it's right
     before the assignment's due date.
     """
-    extension = Extension.get_extension(backup.submitter, assignment, backup.created)
+    extension = Extension.lookup(backup.submitter_id, assignment.id, backup.created)
     if extension:
         return extension.custom_submission_time or assignment.due_date
     return backup.submission_time
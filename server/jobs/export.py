@@ -1,12 +1,11 @@
 import datetime as dt
 import hashlib
-import io
 import json
 import time
 import zipfile
 
 from server import jobs
-from server.models import Assignment, ExternalFile, Group, Backup, User
+from server.models import Assignment, ExternalFile, Group, Backup
 from server.utils import encode_id, local_time
 
 def student_hash(email):
@@ -20,15 +19,35 @@ def pii_present(files, email, course, logger):
             logger.warning("Found contact information in a submission. Ignoring".format(name))
             return True
 
-def write_final_submission(zf, logger, assignment, student, seen, anonymize):
-    """ Get the final submission STUDENT and write it into the zipfile ZF. """
+class ZipStream:
+    """ A write-only file for zipfile.ZipFile that holds what was written
+    until it is drained, so a zip can be uploaded while it is being built.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def write_final_submission(zf, logger, assignment, student, seen, anonymize,
+                           backup, group, scores, files):
+    """ Write BACKUP, the final submission of STUDENT's GROUP, with FILES into
+    the zipfile ZF.
+    """
     student_user = student.user
-    stats = assignment.user_status(student_user)
-    backup = stats.final_subm
     if not backup:
         return
-    if stats.group:
-        group_emails = [User.email_by_id(m.user_id) for m in stats.group.members]
+    if group:
+        group_emails = [m.user.email for m in group.members]
     else:
         group_emails = [student_user.email]
 
@@ -38,7 +57,6 @@ def write_final_submission(zf, logger, assignment, student, seen, anonymize):
     seen.add(group_str)
 
     course = assignment.course
-    files = backup.files()
 
     if anonymize:
         for email in group_emails:
@@ -51,9 +69,9 @@ def write_final_submission(zf, logger, assignment, student, seen, anonymize):
                                    group_str, backup.hashid)
         dump_info = {
             'group': group_emails,
-            'scores': [s.export for s in stats.scores],
-            'submitter': User.email_by_id(backup.submitter_id),
-            'subm_time_local': local_time(stats.subm_time, course)
+            'scores': [s.export for s in scores],
+            'submitter': backup.submitter.email,
+            'subm_time_local': local_time(backup.created, course)
         }
         if backup.custom_submission_time:
             dump_info['custom_time_local'] = local_time(backup.custom_submission_time,
@@ -62,22 +80,40 @@ def write_final_submission(zf, logger, assignment, student, seen, anonymize):
         zf.writestr("{}/info.json".format(folder), json.dumps(dump_info))
 
     for name, contents in files.items():
-        # Write the file to the in-memory zip
         zf.writestr("{}/{}".format(folder, name), contents)
 
-def export_loop(bio, zf, logger, assignment, anonymize):
-    course = assignment.course
-    enrollments = course.get_students()
+def export_zip(logger, assignment, anonymize, batch_size=100):
+    """ Yield the bytes of a zip of the final submissions of ASSIGNMENT.
+    Students are loaded and written a batch at a time, and each batch is
+    yielded as soon as it is compressed, so memory stays bounded.
+    """
+    enrollments = assignment.course.get_students()
     seen = set()
     num_students = len(enrollments)
-    for index, student in enumerate(enrollments):
-        write_final_submission(zf, logger, assignment, student, seen, anonymize)
-        # Rough progress report
-        percent_complete = ((index+1)/num_students) * 100
-        if round(percent_complete, 1) % 5 == 0:
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED, False) as zf:
+        for start in range(0, num_students, batch_size):
+            batch = enrollments[start:start + batch_size]
+            student_ids = [student.user_id for student in batch]
+            finals = assignment.final_submission_many(student_ids)
+            groups = Group.lookup_many(student_ids, assignment)
+            scores = assignment.scores_many(student_ids) if not anonymize else {}
+            files = Backup.files_many(backup.id for backup in finals.values())
+            for student in batch:
+                backup = finals.get(student.user_id)
+                write_final_submission(zf, logger, assignment, student, seen, anonymize,
+                                       backup, groups.get(student.user_id),
+                                       scores.get(student.user_id, []),
+                                       files.get(backup.id, {}) if backup else {})
+            yield stream.drain()
+
+            # Rough progress report
+            processed = start + len(batch)
             logger.info(("{}% complete ({} of {} students processed)"
-                         .format(round(percent_complete, 1), index+1,
-                                 num_students)))
+                         .format(round(processed / num_students * 100, 1),
+                                 processed, num_students)))
+    # Closing the zipfile writes its central directory
+    yield stream.drain()
 
 
 @jobs.background_job
@@ -106,20 +142,14 @@ def export_assignment(assignment_id, anonymized):
     else:
         logger.info("Starting final submission export")
     course = assignment.course
-    with io.BytesIO() as bio:
-        # Get a handle to the in-memory zip in append mode
-        with zipfile.ZipFile(bio, "w", zipfile.ZIP_DEFLATED, False) as zf:
-            zf.external_attr = 0o655 << 16
-            export_loop(bio, zf, logger, assignment, anonymized)
-            created_time = local_time(dt.datetime.now(), course, fmt='%m-%d-%I-%M-%p')
-            zip_name = '{}_{}.zip'.format(assignment.name.replace('/', '-'), created_time)
-
-        bio.seek(0)
-        # Close zf handle to finish writing zipfile
-        logger.info("Uploading...")
-        upload = ExternalFile.upload(bio, user_id=requesting_user.id, name=zip_name,
-                                     course_id=course.id,
-                                     prefix='jobs/exports/{}/'.format(course.offering))
+    created_time = local_time(dt.datetime.now(), course, fmt='%m-%d-%I-%M-%p')
+    zip_name = '{}_{}.zip'.format(assignment.name.replace('/', '-'), created_time)
+
+    # The zip is compressed a batch of students at a time, as it is uploaded
+    chunks = (chunk for chunk in export_zip(logger, assignment, anonymized) if chunk)
+    upload = ExternalFile.upload(chunks, user_id=requesting_user.id, name=zip_name,
+                                 course_id=course.id,
+                                 prefix='jobs/exports/{}/'.format(course.offering))
 
     logger.info("Saved as: {0}".format(upload.object_name))
     msg = "/files/{0}".format(encode_id(upload.id))
@@ -13,18 +13,9 @@ from server.constants import STUDENT_ROLE
 TOTAL_KINDS = 'effort total regrade'.split()
 COMP_KINDS = 'composition revision'.split()
 
-def score_grabber(scores, kinds):
-    return [scores.pop(kind.lower(), 0) for kind in kinds]
-
 def scores_checker(scores, kinds):
     return any(kind.lower() in scores for kind in kinds)
 
-def score_policy(scores):
-    if scores_checker(scores, TOTAL_KINDS):
-        total_score = max(score_grabber(scores, TOTAL_KINDS))
-        scores['total'] = total_score
-    return scores
-
 
 def get_score_types(assignment):
     types = []
@@ -52,61 +43,117 @@ def get_headers(assignments):
             headers.extend(new_headers)
     return headers, new_assignments
 
-def export_student_grades(student, assignments, all_scores):
-    student_row = [student.user.email, student.sid]
-    for assign in assignments:
-        scores = all_scores[assign.id][student.user.id]
-        scores = score_policy(scores)
-        score_types = get_score_types(assign)
+class ScoreMatrix:
+    """ The best scores of students by assignment and kind. Each column is a
+    list with an entry (None if the student has no such score) per student,
+    so policies are applied to whole columns at a time.
+    """
+    def __init__(self, user_ids):
+        self.rows = {user_id: i for i, user_id in enumerate(user_ids)}
+        self.columns = {}  # (assignment id, kind) -> list of scores
+        self.grades = {}  # assignment id -> list of grade columns
+
+    def column(self, assignment_id, kind):
+        """ Return the column of KIND scores for the assignment. Do not
+        modify it, since it may be shared.
+        """
+        return self.columns.get((assignment_id, kind), [None] * len(self.rows))
+
+    def add(self, assignment_id, user_id, kind, score):
+        key = (assignment_id, kind)
+        if key not in self.columns:
+            self.columns[key] = [None] * len(self.rows)
+        self.columns[key][self.rows[user_id]] = score
+
+    def merge_groups(self, assignment_id, groups):
+        """ Give each member of GROUPS (lists of user ids) the best score of
+        their group, of each kind that any member has.
+        """
+        groups = [[self.rows[uid] for uid in group if uid in self.rows]
+                  for group in groups]
+        for (aid, kind), column in self.columns.items():
+            if aid != assignment_id:
+                continue
+            for group in groups:
+                scores = [column[i] for i in group if column[i] is not None]
+                if scores:
+                    best = max(0, *scores)
+                    for i in group:
+                        column[i] = best
+
+    def grade_columns(self, assignment):
+        """ Return the columns of grades for ASSIGNMENT, one per score type
+        in get_score_types.
+        """
+        if assignment.id in self.grades:
+            return self.grades[assignment.id]
+
+        def merged(kinds):
+            """ The best of KINDS, or None where a student has none of them."""
+            columns = [self.column(assignment.id, kind.lower()) for kind in kinds]
+            return [max(score or 0 for score in scores)
+                    if any(score is not None for score in scores) else None
+                    for scores in zip(*columns)]
+
+        score_types = get_score_types(assignment)
+        policy = {'total': merged(TOTAL_KINDS)}
         if 'revision' in score_types:
-            scores['composition'] = max(scores.get('composition', 0), scores.get('revision', 0))
+            policy['composition'] = [max(c or 0, r or 0) for c, r in
+                                     zip(self.column(assignment.id, 'composition'),
+                                         self.column(assignment.id, 'revision'))]
+        columns = []
         for score_type in score_types:
-            if score_type in scores:
-                student_row.append(scores[score_type])
+            if score_type in policy:
+                column = policy[score_type]
             else:
-                student_row.append(0)
+                column = self.column(assignment.id, score_type)
+            columns.append([0 if score is None else score for score in column])
+        self.grades[assignment.id] = columns
+        return columns
+
+def export_student_grades(student, assignments, all_scores):
+    student_row = [student.user.email, student.sid]
+    i = all_scores.rows[student.user_id]
+    for assign in assignments:
+        student_row.extend(column[i] for column in all_scores.grade_columns(assign))
     return student_row
 
 
 def collect_all_scores(assignments, user_ids):
-    all_scores = {}
-
-    for assign in assignments:
-        scores = (
-            db.session.query(Score.user_id, Score.kind, func.max(Score.score))
-            .filter(
-                Score.user_id.in_(user_ids),
-                Score.assignment_id == assign.id,
-                Score.archived == False,
-            )
-            .group_by(Score.user_id, Score.kind)
-            .all()
+    """ Return a ScoreMatrix of the best scores of USER_IDS on ASSIGNMENTS,
+    shared within groups, in two queries.
+    """
+    assignment_ids = [assign.id for assign in assignments]
+    all_scores = ScoreMatrix(user_ids)
+    if not assignment_ids:
+        return all_scores
+
+    scores = (
+        db.session.query(Score.assignment_id, Score.user_id, Score.kind,
+                         func.max(Score.score))
+        .filter(
+            Score.user_id.in_(list(all_scores.rows)),
+            Score.assignment_id.in_(assignment_ids),
+            Score.archived == False,
         )
-
-        members = GroupMember.query.filter(
-            GroupMember.assignment_id == assign.id,
-            GroupMember.status == 'active'
-        ).all()
-
-        group_lookup = {}
-        for member in members:
-            if member.group_id not in group_lookup:
-                group_lookup[member.group_id] = []
-            group_lookup[member.group_id].append(member.user_id)
-
-        user_scores = defaultdict(lambda: defaultdict(int))
-        for user_id, kind, score in scores:
-            user_scores[user_id][kind] = score
-
-        for group in group_lookup.values():
-            best_scores = defaultdict(int)
-            for user_id in group:
-                for kind, score in user_scores[user_id].items():
-                    best_scores[kind] = max(best_scores[kind], score)
-            for user_id in group:
-                user_scores[user_id] = best_scores
-
-        all_scores[assign.id] = user_scores
+        .group_by(Score.assignment_id, Score.user_id, Score.kind)
+    )
+    for assignment_id, user_id, kind, score in scores:
+        all_scores.add(assignment_id, user_id, kind, score)
+
+    members = (
+        db.session.query(GroupMember.assignment_id, GroupMember.group_id,
+                         GroupMember.user_id)
+        .filter(
+            GroupMember.assignment_id.in_(assignment_ids),
+            GroupMember.status == 'active',
+        )
+    )
+    groups = defaultdict(lambda: defaultdict(list))
+    for assignment_id, group_id, user_id in members:
+        groups[assignment_id][group_id].append(user_id)
+    for assignment_id, assignment_groups in groups.items():
+        all_scores.merge_groups(assignment_id, assignment_groups.values())
     return all_scores
 
 
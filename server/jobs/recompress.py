@@ -0,0 +1,73 @@
+from sqlalchemy import bindparam, type_coerce
+
+from server import compression, jobs
+from server.models import Assignment, Backup, FileBlob, JsonBlob, Message, db
+
+BATCH_SIZE = 500
+
+def recompress_rows(table, key, rows):
+    """ Rewrite the (key, blob) ROWS of TABLE that are not stored with the
+    configured codec. Returns the decoded values by key and the number of
+    rows that were rewritten.
+    """
+    blob_type = JsonBlob()
+    values = {}
+    stale = []
+    for row_key, blob in rows:
+        value = blob_type.process_result_value(blob, None)
+        values[row_key] = value
+        if not compression.is_current(blob):
+            stale.append({'_key': row_key, '_value': value})
+    if stale:
+        update = (table.update()
+                       .where(table.c[key] == bindparam('_key'))
+                       .values(contents=bindparam('_value', type_=JsonBlob)))
+        db.session.execute(update, stale)
+        db.session.commit()
+    return values, len(stale)
+
+@jobs.background_job
+def recompress_backups(assign_id):
+    """ Recompress the messages of an assignment's backups, and the file
+    bodies they refer to, with BLOB_COMPRESSION.
+    """
+    logger = jobs.get_job_logger()
+    assignment = Assignment.query.get(assign_id)
+    logger.info('Recompressing backups for {} with {}'.format(
+        assignment.display_name, compression.BLOB_COMPRESSION))
+
+    raw_contents = type_coerce(Message._contents, db.LargeBinary)
+    digests = set()
+    last_id, messages, rewritten = 0, 0, 0
+    while True:
+        rows = (db.session.query(Message.id, raw_contents, Message.encoding)
+                  .join(Backup)
+                  .filter(Backup.assignment_id == assignment.id,
+                          Message.id > last_id)
+                  .order_by(Message.id)
+                  .limit(BATCH_SIZE)
+                  .all())
+        if not rows:
+            break
+        values, count = recompress_rows(Message.__table__, 'id',
+                                        [(id, blob) for id, blob, _ in rows])
+        for id, _, encoding in rows:
+            if encoding in ('dedup', 'delta'):
+                digests.update(values[id]['files'].values())
+        last_id = rows[-1][0]
+        messages += len(rows)
+        rewritten += count
+        logger.info('Recompressed {}/{} messages'.format(rewritten, messages))
+
+    raw_contents = type_coerce(FileBlob.contents, db.LargeBinary)
+    digests = sorted(digests)
+    blobs = 0
+    for i in range(0, len(digests), BATCH_SIZE):
+        rows = (db.session.query(FileBlob.digest, raw_contents)
+                  .filter(FileBlob.digest.in_(digests[i:i + BATCH_SIZE]))
+                  .all())
+        _, count = recompress_rows(FileBlob.__table__, 'digest', rows)
+        blobs += count
+    logger.info('Recompressed {}/{} file bodies'.format(blobs, len(digests)))
+
+    return 'Recompressed {} messages and {} file bodies'.format(rewritten, blobs)
@@ -0,0 +1,45 @@
+from server import jobs
+from server.models import Assignment, Backup, Message, db
+
+@jobs.background_job
+def reencode_files(assign_id):
+    """ Re-encode every file_contents message of an assignment in place as
+    diffs against the submitter's previous backup (see Message.store_files).
+
+    Diffs are otherwise only written by the write-behind queue (see
+    server/ingest.py). Backups stored synchronously by make_backup, such as
+    submissions, are snapshots until this job runs.
+    """
+    logger = jobs.get_job_logger()
+
+    assignment = Assignment.query.get(assign_id)
+    submitter_ids = [s for s, in (db.session.query(Backup.submitter_id)
+                                            .filter_by(assignment_id=assignment.id)
+                                            .distinct())]
+    logger.info('Re-encoding backups of {} submitters for {}'.format(
+        len(submitter_ids), assignment.display_name))
+
+    counts = {'dedup': 0, 'delta': 0}
+    for i, submitter_id in enumerate(submitter_ids, 1):
+        messages = (Message.query.join(Backup)
+                           .filter(Backup.submitter_id == submitter_id,
+                                   Backup.assignment_id == assignment.id,
+                                   Message.kind == 'file_contents')
+                           .order_by(Message.id)
+                           .all())
+        # Decode everything before the chains start changing
+        contents = Message.decode_many(messages)
+        base, base_files = None, None
+        for message, files in zip(messages, contents):
+            if not isinstance(files, dict):
+                continue
+            message.store_files(files, base, base_files)
+            counts[message.encoding] += 1
+            base, base_files = message, files
+        db.session.commit()
+        if i % 100 == 0:
+            logger.info('Re-encoded backups of {}/{} submitters'.format(
+                i, len(submitter_ids)))
+
+    logger.info('Stored {dedup} snapshots and {delta} diffs'.format(**counts))
+    return 'Re-encoded {} messages'.format(sum(counts.values()))
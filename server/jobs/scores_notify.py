@@ -22,17 +22,24 @@ def email_scores(assignment_id, score_tags, subject, body,
                                 Enrollment.course == assign.course)
                         .all())]
 
+    student_ids = [student.id for student in students]
+    groups = assign.active_user_ids_many(student_ids)
+    group_scores = assign.scores_many(student_ids)
+    member_ids = set().union(*groups.values())
+    emails = dict(db.session.query(User.id, User.email)
+                            .filter(User.id.in_(member_ids)))
+
     email_counter = 0
     seen_ids = set()
     for student in students:
         if student.id in seen_ids:
             continue
-        user_ids = assign.active_user_ids(student.id)
+        user_ids = groups[student.id]
         seen_ids |= user_ids
-        scores = [s for s in assign.scores(user_ids) if s.kind in score_tags]
+        scores = [s for s in group_scores[student.id] if s.kind in score_tags]
         if scores:
-            users = User.query.filter(User.id.in_(user_ids))
-            primary, cc = users[0].email, [u.email for u in users[1:]]
+            users = [emails[user_id] for user_id in sorted(user_ids)]
+            primary, cc = users[0], users[1:]
             if dry_run:
                 primary, cc = job_creator.email, []
 
@@ -0,0 +1,60 @@
+""" JSON serialization for the Json and JsonBlob column types.
+
+JSON_CODEC selects the library: orjson (used by default when installed) or the
+standard json module. Both read what the other writes. orjson cannot encode
+integers wider than 64 bits, so those values fall back to json.
+
+orjson is an optional dependency: it needs Python 3.6 and has no wheels for
+musl (such as the Alpine Docker image).
+
+The codecs differ in one way: json writes NaN and infinities as the
+non-standard NaN and Infinity, while orjson writes them as null. orjson reads
+rows with NaN through json. Datetimes cannot be stored with either codec.
+"""
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from server.constants import JSON_CODEC
+
+logger = logging.getLogger(__name__)
+
+
+def json_dumps(value):
+    return json.dumps(value).encode('utf-8')
+
+
+def orjson_dumps(value):
+    # Datetimes are passed through to json, which raises TypeError like before
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    try:
+        return orjson.dumps(value, option=option)
+    except TypeError:
+        return json_dumps(value)
+
+
+def orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+# Codec name -> (dumps, loads). dumps returns UTF-8 bytes, loads takes bytes
+# or a string.
+CODECS = {
+    'json': (json_dumps, json.loads),
+}
+if orjson:
+    CODECS['orjson'] = (orjson_dumps, orjson_loads)
+
+codec = JSON_CODEC or ('orjson' if orjson else 'json')
+if codec not in CODECS:
+    logger.warning('JSON codec {} is not available, using json'.format(codec))
+    codec = 'json'
+
+dumps, loads = CODECS[codec]
@@ -4,24 +4,23 @@ from werkzeug.exceptions import BadRequest
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 
-from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint, MetaData, types
-from sqlalchemy.dialects import mysql
+from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint, MetaData, event, types
+from sqlalchemy.dialects import mysql, postgresql
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import aliased, backref
-from sqlalchemy.sql import text
+from sqlalchemy.orm import backref
 
 from markdown import markdown
 import pytz
 
 import functools
 
-from collections import namedtuple, Counter
+from collections import namedtuple, Counter, defaultdict
 
 import contextlib
 import csv
 import datetime as dt
-import json
+import hashlib
 import os
 import logging
 import shlex
@@ -30,11 +29,13 @@ import mimetypes
 
 from server.constants import (VALID_ROLES, STUDENT_ROLE, STAFF_ROLES, TIMEZONE,
                               SCORE_KINDS, OAUTH_OUT_OF_BAND_URI,
-                              INSTRUCTOR_ROLE, ROLE_DISPLAY_NAMES, AUTOGRADER_URL)
+                              INSTRUCTOR_ROLE, ROLE_DISPLAY_NAMES, AUTOGRADER_URL,
+                              BACKUP_SNAPSHOT_INTERVAL, DIFF_SIZE_LIMIT)
 
+from server import compression, jsoncodec
 from server.extensions import cache, storage
-from server.utils import (encode_id, chunks, generate_number_table,
-                          humanize_name)
+from server.utils import (encode_id, chunks, humanize_name, diff_lines,
+                          patch_lines)
 
 logger = logging.getLogger(__name__)
 
@@ -68,11 +69,11 @@ class Json(types.TypeDecorator):
 
     def process_bind_param(self, value, dialect):
         # Python -> SQL
-        return json.dumps(value)
+        return jsoncodec.dumps(value).decode('utf-8')
 
     def process_result_value(self, value, dialect):
         # SQL -> Python
-        return json.loads(value)
+        return jsoncodec.loads(value)
 
 
 @compiles(mysql.MEDIUMBLOB, 'sqlite')
@@ -86,15 +87,16 @@ def ok_text(element, compiler, **kw):
 
 
 class JsonBlob(types.TypeDecorator):
+    """ JSON stored as compressed bytes. See server/compression.py."""
     impl = mysql.MEDIUMBLOB
 
     def process_bind_param(self, value, dialect):
         # Python -> SQL
-        return json.dumps(value).encode('utf-8')
+        return compression.compress(jsoncodec.dumps(value))
 
     def process_result_value(self, value, dialect):
         # SQL -> Python
-        return json.loads(value.decode('utf-8'))
+        return jsoncodec.loads(compression.decompress(value))
 
 
 class Timezone(types.TypeDecorator):
@@ -240,6 +242,11 @@ class User(Model, UserMixin):
         """ Performs .query.get; potentially can be cached."""
         return User.query.get(uid)
 
+    @staticmethod
+    def get_by_ids(uids):
+        """ Return a dictionary of ids to the users with ids in UIDS."""
+        return {user.id: user for user in User.query.filter(User.id.in_(set(uids)))}
+
     @staticmethod
     @cache.memoize(240)
     def email_by_id(uid):
@@ -340,6 +347,22 @@ class Course(Model):
     def get_students(self):
         return self.get_participants([STUDENT_ROLE])
 
+    @staticmethod
+    def cache_version(course_id, name):
+        """ Return a token that changes whenever the NAME ('grades' or
+        'roster') of the course may have changed, or at least once an hour.
+        """
+        key = 'course-{}-version/{}'.format(name, course_id)
+        version = cache.get(key)
+        if version is None:
+            version = os.urandom(8).hex()
+            cache.set(key, version, timeout=3600)
+        return version
+
+    @staticmethod
+    def clear_cache_version(course_id, name):
+        cache.delete('course-{}-version/{}'.format(name, course_id))
+
     def initialize_content(self, user):
         """ When a course is created, add the creating user as an instructor
         and then create an example assignment.
@@ -409,46 +432,91 @@ class Assignment(Model):
         return is_staff
 
     @staticmethod
-    @cache.memoize(180)
-    def assignment_stats(assign_id, detailed=True):
+    def assignment_stats(assign_id, detailed=False):
+        """ Return submission statistics for an assignment, computed from the
+        backup counts of each student (see BackupCount) and the final
+        submissions (see FinalSubmission). With DETAILED, also include the
+        course submissions of every student as raw_data.
+        """
         assignment = Assignment.query.get(assign_id)
-        base_query = Backup.query.filter_by(assignment=assignment)
+        counts = {user_id: (backups, submissions) for user_id, backups, submissions in
+                  db.session.query(BackupCount.user_id, BackupCount.backups,
+                                   BackupCount.submissions)
+                            .filter(BackupCount.assignment_id == assignment.id)}
+        submitted = {user_id for user_id, in
+                     db.session.query(FinalSubmission.user_id)
+                               .filter(FinalSubmission.assignment_id == assignment.id)}
         stats = {
-            'submissions': base_query.filter_by(submit=True).count(),
-            'backups': base_query.count(),
+            'submissions': sum(s for _, s in counts.values()),
+            'backups': sum(b for b, _ in counts.values()),
             'groups': Group.query.filter_by(assignment=assignment).count(),
         }
-        data = assignment.course_submissions()
-        submissions = [fs['backup'] for fs in data if fs['backup']]
-        submissions_id = set(fs['id'] for fs in submissions)
-
-        students_with_subms = set(s['user']['id'] for s in data
-                                  if s['backup'] and s['backup']['submit'])
-        students_with_backup = set(s['user']['id'] for s in data
-                                   if s['backup'] and not s['backup']['submit'])
-        students_without_subms = set(s['user']['id'] for s in data
-                                     if not s['backup'])
-        groups = [g['group'] for g in data if g['group']]
-        total_students = len(data)
+        students = [user_id for user_id, in
+                    db.session.query(Enrollment.user_id)
+                              .filter(Enrollment.course_id == assignment.course_id,
+                                      Enrollment.role == STUDENT_ROLE)]
+        membership = {}
+        group_users = defaultdict(list)
+        members = (db.session.query(GroupMember.user_id, GroupMember.group_id,
+                                    GroupMember.status)
+                             .filter(GroupMember.assignment_id == assignment.id))
+        for member in members:
+            membership[member.user_id] = member
+            group_users[member.group_id].append(member.user_id)
+
+        # Walk the students the same way as course_submissions
+        seen = set()
+        total_students = 0
+        started_owners = set()
+        active_groups = set()
+        students_with_subms = set()
+        students_with_backup = set()
+        students_without_subms = set()
+        for student_id in students:
+            if student_id in seen:
+                continue
+            member = membership.get(student_id)
+            if member and member.status == 'active':
+                group_members = [user_id for user_id in group_users[member.group_id]
+                                 if membership[user_id].status == 'active']
+                owner = (member.group_id, None)
+                if len(group_members) > 1:
+                    active_groups.add(member.group_id)
+            else:
+                group_members = [student_id]
+                owner = (None, student_id)
+            group_ids = set(group_members)
+            backups = sum(counts.get(user_id, (0, 0))[0] for user_id in group_ids)
+            if student_id in submitted:
+                status = students_with_subms
+            elif backups:
+                status = students_with_backup
+            else:
+                status = students_without_subms
+            if backups:
+                started_owners.add(owner)
+            status.update(group_members)
+            total_students += len(group_members)
+            seen |= group_ids
+
         percent_started = ((len(students_with_subms) + len(students_with_backup)) /
                            (total_students or 1)) * 100
         percent_finished = (len(students_with_subms) / (total_students or 1)) * 100
-        active_groups = len({g['group_id'] for g in groups if ',' in g['group_member']})
 
         stats.update({
-            'unique_submissions': len(submissions_id),
+            'unique_submissions': len(started_owners),
             'students_with_subm': len(students_with_subms),
             'students_with_backup': len(students_with_backup),
             'students_no_backup': len(students_without_subms),
             'percent_started': percent_started,
             'percent_finished': percent_finished,
-            'active_groups': active_groups,
-            'percent_groups_active': active_groups/(stats['groups'] or 1)
+            'active_groups': len(active_groups),
+            'percent_groups_active': len(active_groups)/(stats['groups'] or 1)
         })
 
         if detailed:
             stats.update({
-                'raw_data': data
+                'raw_data': assignment.course_submissions()
             })
         return stats
 
@@ -595,101 +663,113 @@ class Assignment(Model):
         """ Return data on all course submissions for all enrolled users
         List of dictionaries with user, group, backup dictionaries.
         Sample [ {'user': {}, 'group': {}, 'backup': {} }]
+
+        Final submissions are read from the final_submission table. Groups
+        without a submission get their latest backup, found in one more query.
         """
-        current_db = db.engine.name
-        if current_db != 'mysql':
-            return self.course_submissions_slow(include_empty=include_empty)
+        students = (db.session.query(Enrollment.user_id.label('id'),
+                                     User.name, User.email)
+                      .join(User, Enrollment.user_id == User.id)
+                      .filter(Enrollment.course_id == self.course_id,
+                              Enrollment.role == STUDENT_ROLE)
+                      .all())
+        users = {u.id: u for u in students}
+        membership = {}
+        group_users = defaultdict(list)
+        members = (db.session.query(GroupMember.user_id, GroupMember.group_id,
+                                    GroupMember.status, User.name, User.email)
+                     .join(User, User.id == GroupMember.user_id)
+                     .filter(GroupMember.assignment_id == self.id))
+        for member in members:
+            membership[member.user_id] = member
+            group_users[member.group_id].append(member.user_id)
+            users[member.user_id] = member
+        finals = self.final_submission_many(users)
+        latest = self.latest_backups([user_id for user_id in users
+                                      if user_id not in finals])
 
-        # Can only run the fast query on MySQL
+        seen = set()
         submissions = []
-
-        stats = self.mysql_course_submissions_query()
-        keys = stats.keys()
-        for r in stats:
-            user_info = {k: v for k, v in zip(keys[:3], r[:3])}
-            group_info = {k: v for k, v in zip(keys[3:6], r[3:6])}
-            if group_info['group_member_emails']:
-                group_info['group_member_emails'] = group_info['group_member_emails'].split(',')
-            backup_info = {k: v for k, v in zip(keys[6:], r[6:])}
-            if not include_empty and backup_info['id'] is None:
+        for student in students:
+            if student.id in seen:
                 continue
-            data = {'user': user_info,
-                    'group': group_info if group_info.get('group_id') else None,
-                    'backup': backup_info if backup_info.get('id') else None}
-            submissions.append(data)
+            member = membership.get(student.id)
+            if member and member.status != 'active':
+                # Pending invitees are listed on their own
+                member = None
+            if member:
+                group_members = [user_id for user_id in group_users[member.group_id]
+                                 if membership[user_id].status == 'active']
+            else:
+                group_members = [student.id]
+            group_ids = set(group_members)
+            fs = finals.get(student.id)
+            if not fs:
+                backups = [latest[user_id] for user_id in group_ids if user_id in latest]
+                fs = max(backups, key=lambda b: (b.created, b.id), default=None)
+            group_emails = [users[user_id].email for user_id in group_members]
+            group_member_ids = ','.join([str(u_id) for u_id in group_ids])
+
+            for user_id in group_members:
+                if not fs and not include_empty:
+                    continue
+                data = {
+                    'user': {
+                        'id': user_id,
+                        'name': users[user_id].name,
+                        'email': users[user_id].email,
+                    },
+                    'group': {
+                        'group_id': member.group_id,
+                        'group_member': group_member_ids,
+                        'group_member_emails': group_emails
+                    } if member else None,
+                    'backup': fs.as_dict() if fs else None
+                }
+                submissions.append(data)
+            seen |= group_ids
         return submissions
 
-    def mysql_course_submissions_query(self):
-        """ For MySQL Clients only. Returns a SQLAlchemy result proxy object
-        Contains all of the following fields.
-
-        id  email   name                  group_id group_member group_member_emails
-        5   dschmidt1@gmail.com 'david s' 3   5,15 dschmidt1@gmail.com, foo@bar.com
-
-        created id  id submitter_id assignment_id submit  flagged
-        2016-09-07 20:22:04 4790    15  1   1   1
+    def latest_backups(self, user_ids):
+        """ Return a dictionary of each of USER_IDS to the latest backup they
+        made for this assignment, in one query. Users without backups are left
+        out.
         """
-        giant_query = """SELECT * FROM
-              (SELECT u.id,
-                      u.email,
-                      u.name,
-                      gm.group_id,
-                      GROUP_CONCAT(IFNULL(gm2.user_id, u.id)) AS group_member,
-                      GROUP_CONCAT((SELECT partners.email from user as partners
-                                    where id = gm2.user_id AND partners.id != u.id)) AS group_member_emails
-               FROM
-                 (SELECT u.id,
-                         u.email,
-                         u.name
-                  FROM user AS u,
-                               enrollment AS e
-                  WHERE e.course_id = :course_id
-                    AND e.user_id = u.id
-                    AND e.role='student') AS u
-               LEFT JOIN
-                 (SELECT *
-                  FROM group_member
-                  WHERE status = 'active'
-                    AND assignment_id = :assign_id) AS gm ON u.id = gm.user_id
-               LEFT JOIN group_member AS gm2 ON gm2.group_id = gm.group_id
-               AND gm2.status = 'active'
-               GROUP BY u.id) AS members
-            LEFT JOIN backup AS b2 ON b2.id=
-              (SELECT id
-               FROM backup AS b3,
-                 ({group_number_table}) AS member_index_counter
-               WHERE assignment_id=:assign_id
-                 AND b3.submitter_id = CAST(NULLIF(SUBSTRING_INDEX(members.group_member, ',', -pos),
-                                                   SUBSTRING_INDEX(members.group_member, ',', 1 - pos))
-                                            AS UNSIGNED)
-               ORDER BY flagged DESC, submit DESC, created DESC LIMIT 1)
-               ORDER BY group_id DESC;
-        """.format(group_number_table=generate_number_table(self.max_group_size))
-
-        giant_query = text(giant_query)
-        giant_query = giant_query.bindparams(db.bindparam("course_id", db.Integer),
-                                             db.bindparam("assign_id", db.Integer))
-        result = db.session.execute(giant_query, {'course_id': self.course.id,
-                                                  'assign_id': self.id})
-        return result
+        if not user_ids:
+            return {}
+        latest = (db.session.query(db.func.max(Backup.id))
+                    .filter(Backup.assignment_id == self.id,
+                            Backup.submitter_id.in_(user_ids))
+                    .group_by(Backup.submitter_id))
+        return {backup.submitter_id: backup
+                for backup in Backup.query.filter(Backup.id.in_(latest))}
 
     def course_submissions_slow(self, include_empty=True):
         """ Return course submissions info with a slow set of queries."""
         seen = set()
         submissions = []
-        for student in self.course.participations:
-            if student.role == STUDENT_ROLE and student.user_id not in seen:
+        students = [student for student in self.course.participations
+                    if student.role == STUDENT_ROLE]
+        student_ids = [student.user_id for student in students]
+        active_ids = self.active_user_ids_many(student_ids)
+        groups = Group.lookup_many(student_ids, self)
+        finals = self.final_submission_many(student_ids)
+        for student in students:
+            if student.user_id not in seen:
                 student_user = student.user
-                group_ids = self.active_user_ids(student.user_id)
-                group_obj = Group.lookup(student_user, self)
+                group_ids = active_ids[student.user_id]
+                group_obj = groups.get(student.user_id)
                 if group_obj:
-                    group_members = [m.user for m in group_obj.members]
-                else:
+                    group_members = [m.user for m in group_obj.members
+                                     if m.status == 'active']
+                if not group_obj or student_user not in group_members:
+                    # Pending invitees are listed on their own
+                    group_obj = None
                     group_members = [student_user]
                 group_emails = [u.email for u in group_members]
                 group_member_ids = ','.join([str(u_id) for u_id in group_ids])
 
-                fs = self.final_submission(group_ids)
+                fs = finals.get(student.user_id)
                 if not fs:
                     fs = self.backups(group_ids).first()
 
@@ -718,19 +798,7 @@ class Assignment(Model):
         that our user is active in. If the user is not in a group, return just
         that user's id (i.e. as if they were in a 1-person group).
         """
-        user_member = aliased(GroupMember)
-        members = GroupMember.query.join(
-            user_member, GroupMember.group_id == user_member.group_id
-        ).filter(
-            user_member.user_id == user_id,
-            user_member.assignment_id == self.id,
-            user_member.status == 'active',
-            GroupMember.status == 'active'
-        ).all()
-        if not members:
-            return {user_id}
-        else:
-            return {member.user_id for member in members}
+        return set(Group.assignment_members(self.id).get(user_id, {user_id}))
 
     def backups(self, user_ids):
         """ Return a query for the backups that the list of users has for this
@@ -750,17 +818,18 @@ class Assignment(Model):
             Backup.submitter_id.in_(user_ids),
             Backup.assignment_id == self.id,
             Backup.submit == True
-        ).order_by(Backup.created.desc())
+        ).order_by(Backup.created.desc(), Backup.id.desc())
 
     def final_submission(self, user_ids):
         """ Return a final submission for a user, or None."""
         return (Backup.query
                       .options(db.joinedload(Backup.scores))
-                      .filter(Backup.submitter_id.in_(user_ids),
-                              Backup.assignment_id == self.id,
-                              Backup.submit == True)
+                      .join(FinalSubmission, FinalSubmission.backup_id == Backup.id)
+                      .filter(FinalSubmission.user_id.in_(user_ids),
+                              FinalSubmission.assignment_id == self.id)
                       .order_by(Backup.flagged.desc(),
-                                Backup.created.desc())
+                                Backup.created.desc(),
+                                Backup.id.desc())
                       .first())
 
     def revision(self, user_ids):
@@ -795,11 +864,61 @@ class Assignment(Model):
         if only_published:
             return [
                 score for score in max_scores
-                    if score.kind in self.published_scores
+                if score.kind in self.published_scores
             ]
         else:
             return max_scores
 
+    def active_user_ids_many(self, user_ids):
+        """ Like active_user_ids for each of USER_IDS. Returns a dictionary of
+        user ids to sets of user ids.
+        """
+        members = Group.assignment_members(self.id)
+        return {user_id: set(members.get(user_id, {user_id}))
+                for user_id in user_ids}
+
+    def final_submission_many(self, user_ids):
+        """ Like final_submission for the group of each of USER_IDS, in one
+        query. Returns a dictionary of user ids to backups. Users without a
+        final submission are left out.
+        """
+        finals = (db.session.query(FinalSubmission.user_id, Backup)
+                            .join(Backup, FinalSubmission.backup_id == Backup.id)
+                            .options(db.joinedload(Backup.scores))
+                            .filter(FinalSubmission.user_id.in_(set(user_ids)),
+                                    FinalSubmission.assignment_id == self.id))
+        return dict(finals)
+
+    def scores_many(self, user_ids, only_published=True):
+        """ Like scores for the group of each of USER_IDS, in two queries.
+        Returns a dictionary of user ids to lists of scores.
+        """
+        groups = self.active_user_ids_many(user_ids)
+        member_ids = set().union(*groups.values())
+        scores = Score.query.filter(
+            Score.user_id.in_(member_ids),
+            Score.assignment_id == self.id,
+            Score.archived == False,
+        ).order_by(Score.score.desc(), Score.created.desc()).all()
+
+        scores_by_user = defaultdict(list)
+        for rank, score in enumerate(scores):
+            scores_by_user[score.user_id].append((rank, score))
+        result = {}
+        for user_id, group_ids in groups.items():
+            group_scores = sorted(pair for member_id in group_ids
+                                  for pair in scores_by_user[member_id])
+            # keep only first score for each kind
+            scores_by_kind = {}
+            for _, score in group_scores:
+                if score.kind not in scores_by_kind:
+                    scores_by_kind[score.kind] = score
+            result[user_id] = [
+                score for score in scores_by_kind.values()
+                if not only_published or score.kind in self.published_scores
+            ]
+        return result
+
     @transaction
     def flag(self, backup_id, member_ids):
         """ Flag a submission. First unflags any submissions by one of
@@ -923,6 +1042,17 @@ class Enrollment(Model):
             db.session.delete(e)
         db.session.commit()
 
+    @staticmethod
+    def lookup_many(course_id, user_ids):
+        """ Return a dictionary of user ids to the enrollments of USER_IDS in
+        the course, with their users loaded. Users who are not enrolled are
+        left out.
+        """
+        enrollments = (Enrollment.query.options(db.joinedload(Enrollment.user))
+                                 .filter(Enrollment.user_id.in_(set(user_ids)))
+                                 .filter(Enrollment.course_id == course_id))
+        return {e.user_id: e for e in enrollments}
+
     @staticmethod
     @transaction
     def enroll_from_csv(cid, form):
@@ -975,6 +1105,67 @@ class Enrollment(Model):
         cache.delete_memoized(User.is_enrolled)
         return created, updated
 
+def insert_ignore(table):
+    """ Return an INSERT for TABLE that skips rows whose primary key exists."""
+    current_db = db.engine.name
+    if current_db == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    elif current_db == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    elif current_db == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return table.insert()
+
+
+class FileBlob(Model):
+    """ Content addressed storage for the files in file_contents messages.
+    Each distinct file body is stored once, keyed by its SHA-256 digest.
+    """
+    __tablename__ = 'file_blob'
+    __table_args__ = {'mysql_row_format': os.getenv('DB_ROW_FORMAT', 'COMPRESSED')}
+
+    digest = db.Column(db.String(64), primary_key=True)
+    contents = db.Column(JsonBlob, nullable=False)
+
+    @staticmethod
+    def digest_of(body):
+        return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def store(files):
+        """ Store the bodies of FILES, a dictionary of filenames to contents.
+        Returns the encoded form to keep in the message:
+            {'files': {filename: digest}, 'inline': {filename: value}}
+        Values that are not strings (such as the client's submit marker) are
+        kept inline. Only bodies that are not stored yet are sent to the DB.
+        """
+        encoded = {'files': {}, 'inline': {}}
+        bodies = {}
+        for name, body in files.items():
+            if isinstance(body, str):
+                digest = FileBlob.digest_of(body)
+                encoded['files'][name] = digest
+                bodies[digest] = body
+            else:
+                encoded['inline'][name] = body
+        if bodies:
+            existing = {d for d, in (db.session.query(FileBlob.digest)
+                                       .filter(FileBlob.digest.in_(bodies)))}
+            missing = [{'digest': d, 'contents': b}
+                       for d, b in bodies.items() if d not in existing]
+            if missing:
+                db.session.execute(insert_ignore(FileBlob.__table__), missing)
+        return encoded
+
+    @staticmethod
+    def bodies(digests):
+        """ Return a dictionary of DIGESTS to file bodies, using a single query."""
+        if not digests:
+            return {}
+        return dict(db.session.query(FileBlob.digest, FileBlob.contents)
+                              .filter(FileBlob.digest.in_(digests)))
+
+
 class Message(Model):
     __tablename__ = 'message'
     __table_args__ = {'mysql_row_format': os.getenv('DB_ROW_FORMAT', 'COMPRESSED')}
@@ -982,11 +1173,220 @@ class Message(Model):
     id = db.Column(db.Integer, primary_key=True)
     backup_id = db.Column(db.ForeignKey("backup.id"), nullable=False,
                           index=True)
-    contents = db.Column(JsonBlob, nullable=False)
+    # Use the contents property, which decodes the stored form
+    _contents = db.Column('contents', JsonBlob, nullable=False)
     kind = db.Column(db.String(255), nullable=False, index=True)
+    # How _contents is stored. NULL: as is. 'dedup': see FileBlob.store
+    encoding = db.Column(db.String(32), nullable=True)
 
     backup = db.relationship("Backup")
 
+    def __init__(self, kind=None, contents=None, base=None, base_files=None,
+                 **kwargs):
+        """ BASE is the submitter's previous file_contents message, if any.
+        Files are then stored as diffs against it. BASE_FILES are its decoded
+        contents, if the caller already has them.
+        """
+        # The kind must be set first since it decides how contents are stored
+        super().__init__(kind=kind, **kwargs)
+        if contents is not None:
+            if self.kind == 'file_contents' and isinstance(contents, dict):
+                self.store_files(contents, base, base_files)
+            else:
+                self.contents = contents
+
+    @property
+    def contents(self):
+        if self.encoding in ('dedup', 'delta'):
+            return Message.decode_many([self])[0]
+        return self._contents
+
+    @contents.setter
+    def contents(self, value):
+        if self.kind == 'file_contents' and isinstance(value, dict):
+            self.store_files(value)
+        else:
+            self._contents = value
+            self.encoding = None
+
+    def store_files(self, files, base=None, base_files=None):
+        """ Store FILES, a dictionary of filenames to contents.
+        Without a usable BASE, or once its chain of diffs is
+        BACKUP_SNAPSHOT_INTERVAL long, the files are stored as a snapshot
+        ('dedup', see FileBlob.store). Otherwise they are stored as
+            {'chain': [base id, its base id, ..., snapshot id],
+             'same': [filename], 'patches': {filename: edits},
+             'files': {filename: digest}, 'inline': {filename: value}}
+        where files listed in 'same' are unchanged from the base and 'patches'
+        are diff_lines edits against the base's version of the file.
+        """
+        chain = self._delta_chain(base)
+        if not chain:
+            self._contents = FileBlob.store(files)
+            self.encoding = 'dedup'
+            return
+        if base_files is None:
+            base_files = base.contents
+
+        same, patches, whole = [], {}, {}
+        for name, body in files.items():
+            old = base_files.get(name)
+            if isinstance(body, str) and body == old:
+                same.append(name)
+                continue
+            edits = self._diff_file(old, body)
+            if edits is None:
+                whole[name] = body
+            else:
+                patches[name] = edits
+        encoded = FileBlob.store(whole)
+        encoded.update(chain=chain, same=same, patches=patches)
+        self._contents = encoded
+        self.encoding = 'delta'
+
+    @staticmethod
+    def _delta_chain(base):
+        """ Return the chain of a delta against BASE, or None if the files
+        should be stored as a snapshot instead.
+        """
+        if base is None or base.id is None:
+            return None
+        if base.encoding == 'dedup':
+            chain = [base.id]
+        elif base.encoding == 'delta':
+            chain = [base.id] + base._contents['chain']
+        else:
+            return None
+        if len(chain) >= BACKUP_SNAPSHOT_INTERVAL:
+            return None
+        return chain
+
+    @staticmethod
+    def _diff_file(old, body):
+        """ Return the diff_lines edits from OLD to BODY, or None if BODY
+        should be stored whole.
+        """
+        if not isinstance(body, str) or not isinstance(old, str):
+            return None
+        if len(body) > DIFF_SIZE_LIMIT or len(old) > DIFF_SIZE_LIMIT:
+            return None
+        edits = diff_lines(old, body)
+        # Small edits are cheaper as a diff, rewrites as a blob
+        if len(jsoncodec.dumps(edits)) < len(body) // 2:
+            return edits
+        return None
+
+    @staticmethod
+    def load_chains(messages):
+        """ Return a dictionary of ids to MESSAGES and every message in their
+        chains. A chain is normally loaded in one query, but a base may have
+        been re-encoded (see jobs/reencode_backups.py) since the message was
+        stored, so bases that point outside the chain are loaded as well.
+        """
+        by_id = {m.id: m for m in messages if m.id is not None}
+        pending = list(messages)
+        while pending:
+            missing = {i for m in pending if m.encoding == 'delta'
+                       for i in m._contents['chain']} - set(by_id)
+            if not missing:
+                break
+            pending = Message.query.filter(Message.id.in_(missing)).all()
+            by_id.update((m.id, m) for m in pending)
+        return by_id
+
+    @staticmethod
+    def decode_many(messages):
+        """ Return the contents of each of MESSAGES. Messages that are diffs
+        are rebuilt from their chain, which is loaded along with every file
+        body they need in one query each.
+        """
+        by_id = Message.load_chains(messages)
+        encoded = [m for m in list(by_id.values()) + list(messages)
+                   if m.encoding in ('dedup', 'delta')]
+        bodies = FileBlob.bodies({d for m in encoded
+                                  for d in m._contents['files'].values()})
+        decoded = {}
+
+        def decode(message):
+            if message.encoding not in ('dedup', 'delta'):
+                return message._contents
+            if message.id in decoded:
+                return decoded[message.id]
+            stored = message._contents
+            files = dict(stored['inline'])
+            files.update((name, bodies[d]) for name, d in stored['files'].items())
+            if message.encoding == 'delta':
+                base = decode(by_id[stored['chain'][0]])
+                files.update((name, base[name]) for name in stored['same'])
+                files.update((name, patch_lines(base[name], edits))
+                             for name, edits in stored['patches'].items())
+            if message.id is not None:
+                decoded[message.id] = files
+            return files
+
+        return [decode(m) for m in messages]
+
+    def file(self, name):
+        """ Return the contents of file NAME in a file_contents message, or
+        raise KeyError. Only the diffs and the body for that file are loaded.
+        """
+        if self.encoding not in ('dedup', 'delta'):
+            return self.contents[name]
+        chain = Message.load_chains([self])
+        message, patches = self, []
+        while True:
+            stored = message._contents
+            if name in stored['inline']:
+                body = stored['inline'][name]
+                break
+            if name in stored['files']:
+                body = FileBlob.bodies([stored['files'][name]])[stored['files'][name]]
+                break
+            if message.encoding != 'delta':
+                raise KeyError(name)
+            if name in stored['patches']:
+                patches.append(stored['patches'][name])
+            elif name not in stored['same']:
+                raise KeyError(name)
+            message = chain[stored['chain'][0]]
+        for edits in reversed(patches):
+            body = patch_lines(body, edits)
+        return body
+
+    @staticmethod
+    def latest_files(submitter_id, assignment_id):
+        """ Return the newest file_contents message that SUBMITTER_ID backed
+        up for ASSIGNMENT_ID, or None. New files are stored against it.
+        """
+        return (Message.query.join(Backup)
+                       .filter(Backup.submitter_id == submitter_id,
+                               Backup.assignment_id == assignment_id,
+                               Message.kind == 'file_contents')
+                       .order_by(Message.id.desc())
+                       .first())
+
+    @staticmethod
+    def latest_files_many(pairs):
+        """ Like latest_files for each (submitter_id, assignment_id) in PAIRS.
+        Returns a dictionary of those pairs to messages.
+        """
+        pairs = set(pairs)
+        if not pairs:
+            return {}
+        submitter_ids = {s for s, _ in pairs}
+        assignment_ids = {a for _, a in pairs}
+        latest = (db.session.query(db.func.max(Message.id))
+                    .join(Backup)
+                    .filter(Backup.submitter_id.in_(submitter_ids),
+                            Backup.assignment_id.in_(assignment_ids),
+                            Message.kind == 'file_contents')
+                    .group_by(Backup.submitter_id, Backup.assignment_id))
+        messages = (Message.query.options(db.joinedload('backup'))
+                           .filter(Message.id.in_(latest)))
+        return {(m.backup.submitter_id, m.backup.assignment_id): m
+                for m in messages
+                if (m.backup.submitter_id, m.backup.assignment_id) in pairs}
+
 
 class Backup(Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -1014,7 +1414,10 @@ class Backup(Model):
 
     @classmethod
     def create(cls, submitter, assignment_id=None, assignment=None, submit=False,
-            creator=None, created=None, custom_submission_time=None):
+            creator=None, created=None, custom_submission_time=None, commit=True):
+        """ Create a backup. If COMMIT is False, the backup is only flushed
+        so that callers can stage several backups in a single transaction.
+        """
         created = created or db.func.now()
         assignment_id = assignment_id or assignment.id
         backup = cls(submitter=submitter, assignment_id=assignment_id,
@@ -1022,14 +1425,17 @@ class Backup(Model):
                 custom_submission_time=custom_submission_time)
         db.session.add(backup)
 
-        assignment = assignment or Assignment.query.get(assignment_id)
-        extension = Extension.get_extension(submitter or creator, assignment, time=created)
+        time = created if isinstance(created, dt.datetime) else None
+        extension = Extension.lookup((submitter or creator).id, assignment_id, time=time)
         # Submissions after the deadline with an extension are allowed
         if extension:
             backup.submit = True  # Need to set if the assignment is inactive
             backup.custom_submission_time = extension.custom_submission_time
 
-        db.session.commit()
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
         return backup
 
     @classmethod
@@ -1093,15 +1499,45 @@ class Backup(Model):
                                 .all())
         return submitters
 
+    def message(self, kind):
+        """ Return the message of KIND, or None. Unless the messages of this
+        backup are already loaded, only that message is fetched and decoded.
+        """
+        if 'messages' in self.__dict__:
+            return next((m for m in self.messages if m.kind == kind), None)
+        return Message.query.filter_by(backup_id=self.id, kind=kind).first()
+
     def files(self):
         """ Return a dictionary of filenames to contents."""
-        for message in self.messages:
-            if message.kind == 'file_contents':
-                contents = dict(message.contents)
-                # submit is not a real file, but the client sends it anyway
-                contents.pop('submit', None)
-                return contents
-        return {}
+        message = self.message('file_contents')
+        if not message:
+            return {}
+        contents = dict(message.contents)
+        # submit is not a real file, but the client sends it anyway
+        contents.pop('submit', None)
+        return contents
+
+    @staticmethod
+    def files_many(backup_ids):
+        """ Like files for each of BACKUP_IDS, in a fixed number of queries.
+        Returns a dictionary of backup ids to files. Backups without files are
+        left out.
+        """
+        messages = Message.query.filter(Message.backup_id.in_(set(backup_ids)),
+                                        Message.kind == 'file_contents').all()
+        files = {}
+        for message, contents in zip(messages, Message.decode_many(messages)):
+            contents = dict(contents)
+            contents.pop('submit', None)
+            files[message.backup_id] = contents
+        return files
+
+    def file(self, name):
+        """ Return the contents of file NAME, or raise KeyError."""
+        message = self.message('file_contents')
+        if not message or name == 'submit':
+            raise KeyError(name)
+        return message.file(name)
 
     def external_files_dict(self):
         """ Return a dictionary of filenames to ExternalFile objects """
@@ -1110,25 +1546,21 @@ class Backup(Model):
 
     def analytics(self):
         """ Return a dictionary of analytics."""
-        for message in self.messages:
-            if message.kind == 'analytics':
-                return dict(message.contents)
-        return {}
+        message = self.message('analytics')
+        return dict(message.contents) if message else {}
 
     def grading(self):
         """ Return a dictionary of grading stats."""
-        for message in self.messages:
-            if message.kind == 'grading':
-                return dict(message.contents)
-        return {}
+        message = self.message('grading')
+        return dict(message.contents) if message else {}
 
     def unlocking(self):
         """ Return a string for which question the student is unlocking."""
-        for message in self.messages:
-            if message.kind == 'unlock' and len(message.contents):
-                dict_form = dict(message.contents[0])
-                case = dict_form["case_id"]
-                return case
+        message = self.message('unlock')
+        if message and len(message.contents):
+            dict_form = dict(message.contents[0])
+            case = dict_form["case_id"]
+            return case
         return "Unknown Question"
 
     def moss_results(self):
@@ -1144,6 +1576,127 @@ class Backup(Model):
             ORDER BY date_trunc('hour', backup.created)""")).all()
 
 
+class FinalSubmission(Model):
+    """ The final submission of each student for an assignment, as picked by
+    Assignment.final_submission. Members of a group share the same backup, and
+    students without a submission have no row. The table is updated in the
+    same transaction whenever backups or group members are written (see
+    update_final_submissions).
+    """
+    __tablename__ = 'final_submission'
+    __table_args__ = (
+        PrimaryKeyConstraint('assignment_id', 'user_id'),
+    )
+
+    assignment_id = db.Column(db.ForeignKey("assignment.id"), nullable=False)
+    user_id = db.Column(db.ForeignKey("user.id"), nullable=False, index=True)
+    backup_id = db.Column(db.ForeignKey("backup.id"), nullable=False, index=True)
+
+    backup = db.relationship("Backup")
+
+    @staticmethod
+    def group_ids(connection, assignment_id, user_id):
+        """ Like Assignment.active_user_ids, using CONNECTION."""
+        member = GroupMember.__table__.alias('member')
+        partner = GroupMember.__table__.alias('partner')
+        query = (db.select([partner.c.user_id])
+                   .select_from(member.join(partner,
+                                            member.c.group_id == partner.c.group_id))
+                   .where(db.and_(member.c.user_id == user_id,
+                                  member.c.assignment_id == assignment_id,
+                                  member.c.status == 'active',
+                                  partner.c.status == 'active')))
+        return {user_id for user_id, in connection.execute(query)} or {user_id}
+
+    @staticmethod
+    def refresh(connection, pairs):
+        """ Recompute the final submission of the group of each
+        (assignment_id, user_id) in PAIRS, using CONNECTION.
+        """
+        table = FinalSubmission.__table__
+        backup = Backup.__table__
+        done = set()
+        for assignment_id, user_id in sorted(pairs):
+            if (assignment_id, user_id) in done:
+                continue
+            members = FinalSubmission.group_ids(connection, assignment_id, user_id)
+            final = connection.execute(
+                db.select([backup.c.id])
+                .where(db.and_(backup.c.assignment_id == assignment_id,
+                               backup.c.submitter_id.in_(members),
+                               backup.c.submit == True))
+                .order_by(backup.c.flagged.desc(), backup.c.created.desc(),
+                          backup.c.id.desc())
+                .limit(1)).scalar()
+            connection.execute(table.delete().where(db.and_(
+                table.c.assignment_id == assignment_id,
+                table.c.user_id.in_(members))))
+            if final:
+                connection.execute(table.insert(), [
+                    {'assignment_id': assignment_id, 'user_id': member,
+                     'backup_id': final} for member in members])
+            done.update((assignment_id, member) for member in members)
+
+
+class BackupCount(Model):
+    """ The number of backups and submissions each user has made for an
+    assignment. The counts are updated in the same transaction whenever
+    backups are written (see update_backup_counts), so that assignment stats
+    do not have to count the backup table.
+    """
+    __tablename__ = 'backup_count'
+    __table_args__ = (
+        PrimaryKeyConstraint('assignment_id', 'user_id'),
+    )
+
+    assignment_id = db.Column(db.ForeignKey("assignment.id"), nullable=False)
+    user_id = db.Column(db.ForeignKey("user.id"), nullable=False, index=True)
+    backups = db.Column(db.Integer, nullable=False, default=0)
+    submissions = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def add(connection, deltas):
+        """ Apply DELTAS, a dictionary of (assignment_id, user_id) to
+        (backups, submissions) changes, using CONNECTION. All the counts are
+        written with one upsert, or on SQLite with one INSERT and one UPDATE.
+        """
+        table = BackupCount.__table__
+        rows = [{'assignment_id': assignment_id, 'user_id': user_id,
+                 'backups': backups, 'submissions': submissions}
+                for (assignment_id, user_id), (backups, submissions) in deltas.items()
+                if backups or submissions]
+        if not rows:
+            return
+        current_db = db.engine.name
+        if current_db == 'mysql':
+            # insert.inserted does not render inside an expression here
+            values = db.literal_column
+            connection.execute(mysql.insert(table).on_duplicate_key_update(
+                backups=table.c.backups + values('VALUES(backups)'),
+                submissions=table.c.submissions + values('VALUES(submissions)')),
+                rows)
+        elif current_db == 'postgresql':
+            insert = postgresql.insert(table)
+            connection.execute(insert.on_conflict_do_update(
+                index_elements=[table.c.assignment_id, table.c.user_id],
+                set_={'backups': table.c.backups + insert.excluded.backups,
+                      'submissions': table.c.submissions + insert.excluded.submissions}),
+                rows)
+        else:
+            connection.execute(insert_ignore(table), [
+                dict(row, backups=0, submissions=0) for row in rows])
+            # Bound parameters cannot share the names of the updated columns
+            update = table.update().where(db.and_(
+                table.c.assignment_id == db.bindparam('key_assignment'),
+                table.c.user_id == db.bindparam('key_user'),
+            )).values(backups=table.c.backups + db.bindparam('add_backups'),
+                      submissions=table.c.submissions + db.bindparam('add_submissions'))
+            connection.execute(update, [
+                {'key_assignment': row['assignment_id'], 'key_user': row['user_id'],
+                 'add_backups': row['backups'], 'add_submissions': row['submissions']}
+                for row in rows])
+
+
 class GroupMember(Model):
     """ A member of a group must accept the invite to join the group.
     Only members of a group can view each other's submissions.
@@ -1184,6 +1737,26 @@ class Group(Model):
 
     assignment = db.relationship("Assignment")
 
+    @staticmethod
+    @cache.memoize(600)
+    def assignment_members(assignment_id):
+        """ Return a dictionary of the ids of users that are active in a group
+        for the assignment to frozensets of the ids of the active members of
+        their group. Cached until group membership changes.
+        """
+        members = (db.session.query(GroupMember.group_id, GroupMember.user_id)
+                             .filter(GroupMember.assignment_id == assignment_id,
+                                     GroupMember.status == 'active'))
+        groups = defaultdict(set)
+        for group_id, user_id in members:
+            groups[group_id].add(user_id)
+        return {user_id: frozenset(user_ids) for user_ids in groups.values()
+                for user_id in user_ids}
+
+    @staticmethod
+    def clear_cache(assignment_id):
+        cache.delete_memoized(Group.assignment_members, assignment_id)
+
     def size(self, status=None):
         return GroupMember.query.filter_by(group=self).count()
 
@@ -1214,6 +1787,20 @@ class Group(Model):
         if member:
             return member.group
 
+    @staticmethod
+    def lookup_many(user_ids, assignment):
+        """ Like lookup for each of USER_IDS, in one query. Returns a
+        dictionary of user ids to groups, with their members loaded. Users
+        without a group are left out.
+        """
+        members = (GroupMember.query
+                              .options(db.joinedload('group')
+                                         .joinedload('members')
+                                         .joinedload('user'))
+                              .filter(GroupMember.user_id.in_(set(user_ids)),
+                                      GroupMember.assignment_id == assignment.id))
+        return {member.user_id: member.group for member in members}
+
     @staticmethod
     @transaction
     def force_add(staff, sender, recipient, assignment):
@@ -1284,6 +1871,7 @@ class Group(Model):
             raise BadRequest('{0} is not invited to this group'.format(user.email))
         with self._log('accept', user.id, user.id):
             member.status = 'active'
+        Group.clear_cache(self.assignment_id)
         self.assignment._unflag_all([user.id])
 
     @transaction
@@ -1311,6 +1899,7 @@ class Group(Model):
             assignment=self.assignment,
             status=status)
         db.session.add(member)
+        Group.clear_cache(self.assignment.id)
 
     def _remove_member(self, user):
         member = GroupMember.query.filter_by(
@@ -1322,6 +1911,7 @@ class Group(Model):
         db.session.delete(member)
         if self.size() <= 1:
             db.session.delete(self)
+        Group.clear_cache(self.assignment_id)
 
     def serialize(self):
         """ Turn the group into a JSON object with:
@@ -1955,6 +2545,10 @@ class ExtensionRequest(Model):
         return user.is_enrolled(obj.assignment.course.id, STAFF_ROLES)
 
 
+ExtensionInfo = namedtuple('ExtensionInfo',
+                           ['id', 'user_id', 'expires', 'custom_submission_time'])
+
+
 class Extension(Model):
     """ Extensions allows students to submit after the deadline. """
     __tablename__ = 'extension'
@@ -1998,6 +2592,7 @@ class Extension(Model):
         ext = cls(staff=staff, assignment=assignment, user=user, message=message, expires=expires, custom_submission_time=custom_submission_time)
         db.session.add(ext)
         db.session.commit()
+        cls.clear_cache(assignment.id)
 
         # Retroactively change the submission times of all past late backups
         # that were created before the expiration time.
@@ -2015,6 +2610,37 @@ class Extension(Model):
             db.session.add(backup)
         db.session.delete(ext)
         db.session.commit()
+        cls.clear_cache(ext.assignment_id)
+
+    @staticmethod
+    @cache.memoize(600)
+    def assignment_extensions(assignment_id):
+        """ Return a list of ExtensionInfo for every extension on the
+        assignment. Cached until an extension is created or deleted.
+        """
+        return [ExtensionInfo(e.id, e.user_id, e.expires, e.custom_submission_time)
+                for e in Extension.query.filter_by(assignment_id=assignment_id)]
+
+    @staticmethod
+    def clear_cache(assignment_id):
+        cache.delete_memoized(Extension.assignment_extensions, assignment_id)
+
+    @staticmethod
+    def lookup(user_id, assignment_id, time=None):
+        """ Like get_extension, but returns an ExtensionInfo from the cached
+        extensions of the assignment. The database is only read to find the
+        user's group, when someone else in the assignment has an extension.
+        """
+        time = time or dt.datetime.utcnow()
+        extensions = [e for e in Extension.assignment_extensions(assignment_id)
+                      if e.expires and e.expires >= time]
+        if not extensions:
+            return None
+        for ext in extensions:
+            if ext.user_id == user_id:
+                return ext
+        group_members = Assignment.query.get(assignment_id).active_user_ids(user_id)
+        return next((e for e in extensions if e.user_id in group_members), None)
 
     @classmethod
     def get_extension(cls, student, assignment, time=None):
@@ -2033,3 +2659,198 @@ class Extension(Model):
         if user.is_admin:
             return True
         return user.is_enrolled(obj.course.id, STAFF_ROLES)
+
+
+@event.listens_for(Extension, 'after_insert')
+@event.listens_for(Extension, 'after_update')
+@event.listens_for(Extension, 'after_delete')
+def clear_extension_cache(mapper, connection, ext):
+    """ Extensions are also edited directly, so clear the cached extensions
+    of the assignment whenever one is written, and again once the change is
+    committed, so that a request that read the old extensions in the meantime
+    does not keep them cached.
+    """
+    assignment_ids = {ext.assignment_id}
+    assignment_ids.update(db.inspect(ext).attrs.assignment_id.history.deleted)
+    for assignment_id in assignment_ids:
+        Extension.clear_cache(assignment_id)
+    session = db.object_session(ext)
+    if session:
+        session.info.setdefault('extension_assignments', set()).update(assignment_ids)
+
+
+@event.listens_for(db.session, 'after_commit')
+def clear_committed_extension_cache(session):
+    for assignment_id in session.info.pop('extension_assignments', ()):
+        Extension.clear_cache(assignment_id)
+
+
+@event.listens_for(db.session, 'before_flush')
+def delete_final_submissions(session, flush_context, instances):
+    """ Drop the final submission rows of backups that this flush deletes, so
+    that the backups can be deleted. update_final_submissions then picks new
+    final submissions for their owners.
+    """
+    backup_ids = [obj.id for obj in session.deleted
+                  if isinstance(obj, Backup) and obj.id is not None]
+    if backup_ids:
+        table = FinalSubmission.__table__
+        session.connection().execute(
+            table.delete().where(table.c.backup_id.in_(backup_ids)))
+
+
+@event.listens_for(GroupMember, 'after_insert')
+@event.listens_for(GroupMember, 'after_update')
+@event.listens_for(GroupMember, 'after_delete')
+def clear_group_cache(mapper, connection, member):
+    """ Clear the cached group members of the assignment whenever a member is
+    written, and again once the change is committed, so that a request that
+    read the old members in the meantime does not keep them cached.
+    """
+    Group.clear_cache(member.assignment_id)
+    session = db.object_session(member)
+    if session:
+        session.info.setdefault('group_assignments', set()).add(member.assignment_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def clear_committed_group_cache(session):
+    for assignment_id in session.info.pop('group_assignments', ()):
+        Group.clear_cache(assignment_id)
+
+
+def course_version_changes(session):
+    """ Return the (course_id, name) versions that objects in this flush
+    change directly, and the ids of the assignments and users whose courses'
+    versions change.
+    """
+    changed = set()
+    assignment_ids, user_ids = set(), set()
+    for obj in session.new | session.dirty | session.deleted:
+        if obj in session.dirty and not session.is_modified(
+                obj, include_collections=False):
+            continue
+        if isinstance(obj, (Score, GroupMember)):
+            assignment_ids.add(obj.assignment_id)
+        elif isinstance(obj, Assignment):
+            changed.add((obj.course_id, 'grades'))
+        elif isinstance(obj, Enrollment):
+            changed.update([(obj.course_id, 'grades'), (obj.course_id, 'roster')])
+        elif isinstance(obj, User) and obj in session.dirty:
+            # Only emails and names are in the grades and rosters
+            state = db.inspect(obj)
+            if any(state.attrs[f].history.has_changes() for f in User.export_items):
+                user_ids.add(obj.id)
+    return changed, assignment_ids, user_ids
+
+
+@event.listens_for(db.session, 'after_flush')
+def clear_course_versions(session, flush_context):
+    """ Clear the version of the grades of the courses whose scores, groups,
+    students or assignments were written by this flush, and the version of
+    the roster of the courses whose students were written. Versions are
+    cleared again once the change is committed.
+    """
+    changed, assignment_ids, user_ids = course_version_changes(session)
+    connection = session.connection()
+    if assignment_ids:
+        table = Assignment.__table__
+        changed.update((course_id, 'grades') for course_id, in connection.execute(
+            db.select([table.c.course_id]).where(table.c.id.in_(assignment_ids))))
+    if user_ids:
+        table = Enrollment.__table__
+        for course_id, in connection.execute(
+                db.select([table.c.course_id]).where(table.c.user_id.in_(user_ids))):
+            changed.update([(course_id, 'grades'), (course_id, 'roster')])
+    for course_id, name in changed:
+        Course.clear_cache_version(course_id, name)
+    session.info.setdefault('course_versions', set()).update(changed)
+
+
+@event.listens_for(db.session, 'after_commit')
+def clear_committed_course_versions(session):
+    for course_id, name in session.info.pop('course_versions', ()):
+        Course.clear_cache_version(course_id, name)
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_final_submissions(session, flush_context):
+    """ Keep FinalSubmission up to date with the backups and group members
+    written by this flush.
+    """
+    pairs = set()
+    group_ids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Backup):
+            state = db.inspect(obj)
+            if obj in session.new and not obj.submit:
+                continue
+            fields = ('submit', 'flagged', 'created', 'submitter_id', 'assignment_id')
+            if obj in session.dirty and not any(
+                    state.attrs[f].history.has_changes() for f in fields):
+                continue
+            # Moving a backup also changes the old owners' final submission
+            pairs.add((obj.assignment_id, obj.submitter_id))
+            for assignment_id in state.attrs.assignment_id.history.sum():
+                for submitter_id in state.attrs.submitter_id.history.sum():
+                    pairs.add((assignment_id, submitter_id))
+        elif isinstance(obj, GroupMember):
+            pairs.add((obj.assignment_id, obj.user_id))
+            group_ids.add(obj.group_id)
+            group_ids.update(db.inspect(obj).attrs.group_id.history.deleted)
+    if not pairs:
+        return
+    connection = session.connection()
+    if group_ids:
+        # The other members of changed groups also get a new final submission
+        table = GroupMember.__table__
+        pairs.update(tuple(row) for row in connection.execute(
+            db.select([table.c.assignment_id, table.c.user_id])
+              .where(table.c.group_id.in_(group_ids))))
+    FinalSubmission.refresh(connection, pairs)
+
+
+def backup_count_key(backup, old=False):
+    """ Return the (assignment_id, submitter_id, submit) that BACKUP is
+    counted under, or with OLD, was counted under before this flush.
+    """
+    state = db.inspect(backup)
+    values = []
+    for field in ('assignment_id', 'submitter_id', 'submit'):
+        history = state.attrs[field].history
+        if old and history.deleted:
+            values.append(history.deleted[0])
+        else:
+            values.append(getattr(backup, field))
+    return tuple(values)
+
+
+def backup_count_deltas(session):
+    """ Return the changes to BackupCount made by the backups in a flush, as
+    a dictionary of (assignment_id, user_id) to [backups, submissions].
+    """
+    changes = []
+    for obj in session.new | session.deleted | session.dirty:
+        if not isinstance(obj, Backup):
+            continue
+        if obj in session.new:
+            changes.append((backup_count_key(obj), 1))
+        elif obj in session.deleted:
+            changes.append((backup_count_key(obj, old=True), -1))
+        elif backup_count_key(obj, old=True) != backup_count_key(obj):
+            changes.append((backup_count_key(obj, old=True), -1))
+            changes.append((backup_count_key(obj), 1))
+    deltas = defaultdict(lambda: [0, 0])
+    for (assignment_id, submitter_id, submit), sign in changes:
+        delta = deltas[assignment_id, submitter_id]
+        delta[0] += sign
+        delta[1] += sign if submit else 0
+    return deltas
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_backup_counts(session, flush_context):
+    """ Keep BackupCount up to date with the backups written by this flush."""
+    deltas = backup_count_deltas(session)
+    if deltas:
+        BackupCount.add(session.connection(), deltas)
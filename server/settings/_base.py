@@ -32,6 +32,27 @@ class Config(object):
 
     APPINSIGHTS_INSTRUMENTATIONKEY = os.getenv('APPINSIGHTS_INSTRUMENTATIONKEY')
 
+    # Acknowledge non-submission backups immediately and write them in bulk
+    # from a background thread (see server/ingest.py). The queue is held in
+    # memory, so backups still queued when a worker is killed are lost.
+    BACKUP_WRITE_BEHIND = os.getenv('BACKUP_WRITE_BEHIND', 'false').lower() == 'true'
+    BACKUP_WRITE_BEHIND_INTERVAL = float(os.getenv('BACKUP_WRITE_BEHIND_INTERVAL', '1'))
+    BACKUP_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('BACKUP_WRITE_BEHIND_BATCH_SIZE',
+                                                   '500'))
+    # Backups are turned away with a 503 while this many are queued
+    BACKUP_WRITE_BEHIND_MAX_QUEUE = int(os.getenv('BACKUP_WRITE_BEHIND_MAX_QUEUE',
+                                                  '10000'))
+    BACKUP_WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('BACKUP_WRITE_BEHIND_MAX_ATTEMPTS',
+                                                     '5'))
+
+    # Turn away non-submission backups with a 503 when this many backup
+    # writes are in flight across every worker (0 for no limit, counted in
+    # Redis), or when at most BACKUP_POOL_RESERVE connections to the MySQL
+    # server are left
+    BACKUP_MAX_IN_FLIGHT = int(os.getenv('BACKUP_MAX_IN_FLIGHT', '0'))
+    BACKUP_POOL_RESERVE = int(os.getenv('BACKUP_POOL_RESERVE', '2'))
+    BACKUP_RETRY_AFTER = int(os.getenv('BACKUP_RETRY_AFTER', '5'))  # seconds
+
     APPLICATION_ROOT = constants.APPLICATION_ROOT
 
     # Service Keys
@@ -1,5 +1,6 @@
 import csv
 import datetime as dt
+import difflib
 import logging
 from io import StringIO
 import random
@@ -41,6 +42,33 @@ def decode_id(value):
     return numbers[0]
 
 
+EPOCH = dt.datetime(1970, 1, 1)
+
+def timestamp_micros(time):
+    """ Return TIME as microseconds since the epoch. Aware times are
+    converted to UTC, and naive times are taken to be in UTC.
+    """
+    if time.tzinfo:
+        time = time.astimezone(pytz.utc).replace(tzinfo=None)
+    return (time - EPOCH) // dt.timedelta(microseconds=1)
+
+
+def encode_cursor(created, id_number, *extra):
+    """ Return an opaque pagination token for the row (CREATED, ID_NUMBER),
+    with any EXTRA integers.
+    """
+    return hashids.encode(timestamp_micros(created), id_number, *extra)
+
+
+def decode_cursor(value):
+    """ Return the (created, id, *extra) in a token from encode_cursor."""
+    numbers = hashids.decode(value)
+    if len(numbers) < 2:
+        raise ValueError('Could not decode cursor {0}'.format(value))
+    created = EPOCH + dt.timedelta(microseconds=numbers[0])
+    return (created,) + numbers[1:]
+
+
 def convert_markdown(text):
     # https://pythonadventures.wordpress.com/tag/markdown/
     allowed_tags = [
@@ -137,6 +165,24 @@ def is_safe_redirect_url(request, target):
         host_url.netloc == redirect_url.netloc
 
 
+def diff_lines(old, new):
+    """ Return the edits that turn OLD into NEW as a list of
+    [start, end, lines] that replace old lines start:end. See patch_lines.
+    """
+    a, b = old.splitlines(keepends=True), new.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    return [[i1, i2, b[j1:j2]]
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def patch_lines(old, edits):
+    """ Apply EDITS from diff_lines to OLD."""
+    lines = old.splitlines(keepends=True)
+    for start, end, replacement in reversed(edits):
+        lines[start:end] = replacement
+    return ''.join(lines)
+
+
 def random_row(query):
     count = query.count()
     if not count:
@@ -301,9 +347,7 @@ def generate_secret_key(length=31):
 
 
 def generate_number_table(num):
-    """ Generate a table of number with column name pos.
-    Used in models.Assignment.mysql_course_submissions_query
-    """
+    """ Generate a table of number with column name pos."""
     return ' UNION '.join('SELECT {} as pos'.format(i) for i in range(1, num + 1))
 
 
@@ -2,12 +2,21 @@ import datetime as dt
 import dateutil.parser
 import json
 import random
-
-from server.models import (Client, db, Assignment, Backup, Course, User,
-                           Version, Group, )
+import time
+from unittest import mock
+import uuid
+
+from sqlalchemy import event
+
+from server.models import (Client, db, Assignment, Backup, Course, Message,
+                           Score, User, Version, Group, )
+from server import ingest
+from server.controllers import api
+from server.extensions import cache
+from server.ingest import admission, backup_writer
 from server.utils import encode_id
 
-from tests import OkTestCase
+from tests import OkTestCase, skipUnlessRedisIsAvailable
 
 class TestApi(OkTestCase):
     def _test_backup(self, submit, delay=10, success=True):
@@ -87,6 +96,313 @@ class TestApi(OkTestCase):
     def test_submit_after_deadline(self):
         self._test_backup(True, delay=-2, success=False)
 
+    def test_backup_batch(self):
+        self.setup_course()
+        self.login(self.user1.email)
+
+        def make_item(assignment, submit=False):
+            return {
+                'assignment': assignment.name,
+                'messages': {
+                    'file_contents': {'hog.py': 'print("Hello world!")'}
+                },
+                'submit': submit,
+            }
+
+        data = {'backups': [
+            make_item(self.assignment),
+            make_item(self.assignment, submit=True),
+            {'assignment': 'cal/cs61a/sp16/doesnotexist', 'messages': {}},
+        ]}
+        response = self.client.post('/api/v3/backups/batch/',
+            data=json.dumps(data),
+            headers=[('Content-Type', 'application/json')])
+        self.assert_200(response)
+
+        results = response.json['data']['backups']
+        self.assertEqual(len(results), 3)
+        backups = Backup.query.filter_by(submitter_id=self.user1.id).all()
+        self.assertEqual(len(backups), 2)
+        self.assertEqual([r['key'] for r in results[:2]],
+                         [b.hashid for b in sorted(backups, key=lambda b: b.id)])
+        self.assertEqual([r['submit'] for r in results[:2]], [False, True])
+        self.assertEqual(results[0]['error'], None)
+        self.assertEqual(results[2]['key'], None)
+        self.assertEqual(results[2]['error'], 'Assignment does not exist')
+        for backup in backups:
+            self.assertEqual(backup.files(), {'hog.py': 'print("Hello world!")'})
+
+        # Late submissions are stored as backups, like single backups
+        late_assignment = Assignment(
+            name='cal/cs61a/sp16/batch_late', creator_id=self.admin.id,
+            course=self.course, display_name='Late',
+            due_date=dt.datetime.utcnow() - dt.timedelta(days=2),
+            lock_date=dt.datetime.utcnow() - dt.timedelta(days=1))
+        db.session.add(late_assignment)
+        db.session.commit()
+        response = self.client.post('/api/v3/backups/batch/',
+            data=json.dumps({'backups': [make_item(late_assignment, submit=True)]}),
+            headers=[('Content-Type', 'application/json')])
+        self.assert_200(response)
+        result = response.json['data']['backups'][0]
+        self.assertEqual(result['submit'], False)
+        self.assertEqual(result['error'], 'Late Submission of {}'.format(late_assignment.name))
+        self.assertNotEqual(result['key'], None)
+
+        response = self.client.post('/api/v3/backups/batch/',
+            data=json.dumps({'backups': [{'assignment': self.assignment.name}]}),
+            headers=[('Content-Type', 'application/json')])
+        self.assert_400(response)
+
+    def test_backup_write_behind(self):
+        self.setup_course()
+        self.login(self.user1.email)
+
+        def post(submit):
+            data = {
+                'assignment': self.assignment.name,
+                'messages': {'file_contents': {'hog.py': 'print("Hello world!")'}},
+                'submit': submit,
+            }
+            return self.client.post('/api/v3/backups/',
+                data=json.dumps(data),
+                headers=[('Content-Type', 'application/json')])
+
+        with mock.patch.object(backup_writer, 'enabled', True), \
+                mock.patch.object(backup_writer, 'start'):
+            response = post(False)
+            self.assert_200(response)
+            self.assertEqual(response.json['data']['key'], None)
+            self.assertEqual(response.json['data']['assignment'], self.assignment.name)
+            self.assertEqual(Backup.query.count(), 0)
+
+            # Submissions are still written synchronously
+            response = post(True)
+            self.assert_200(response)
+            self.assertEqual(Backup.query.count(), 1)
+
+            self.assertEqual(backup_writer.flush(), 1)
+
+        backups = Backup.query.order_by(Backup.id).all()
+        self.assertEqual(len(backups), 2)
+        self.assertEqual([b.submit for b in backups], [True, False])
+        self.assertEqual(backups[1].submitter_id, self.user1.id)
+        self.assertEqual(backups[1].files(), {'hog.py': 'print("Hello world!")'})
+
+    def test_backup_write_behind_limits(self):
+        self.setup_course()
+        self.login(self.user1.email)
+        data = {
+            'assignment': self.assignment.name,
+            'messages': {'file_contents': {'hog.py': 'print("Hello world!")'}},
+            'submit': False,
+        }
+
+        with mock.patch.object(backup_writer, 'enabled', True), \
+                mock.patch.object(backup_writer, 'start'), \
+                mock.patch.object(backup_writer, 'max_size', 1), \
+                mock.patch.object(backup_writer, 'max_attempts', 2):
+            self.assert_200(self.client.post('/api/v3/backups/', data=json.dumps(data),
+                headers=[('Content-Type', 'application/json')]))
+            # The queue is full
+            response = self.client.post('/api/v3/backups/', data=json.dumps(data),
+                headers=[('Content-Type', 'application/json')])
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'],
+                             str(admission.retry_after))
+            self.assertEqual(len(backup_writer.queue), 1)
+            backup_writer.enqueue(self.user3.id, self.assignment.id,
+                                  data['messages'])
+            self.assertEqual(len(backup_writer.queue), 1)
+
+            # A backup that cannot be written does not hold up the others
+            backup_writer.queue.append(ingest.PendingBackup(
+                self.user3.id, self.assignment.id, data['messages'],
+                dt.datetime.utcnow(), 0))
+            write_backups = ingest.write_backups
+            def failing_write(pending):
+                if any(item.submitter_id == self.user3.id for item in pending):
+                    raise ingest.SQLAlchemyError('write failed')
+                return write_backups(pending)
+
+            with mock.patch.object(ingest, 'write_backups', failing_write), \
+                    mock.patch.object(ingest.dead_letter_logger, 'error') as error:
+                self.assertEqual(backup_writer.flush(), 1)
+                self.assertEqual(len(backup_writer.queue), 1)
+                self.assertEqual(backup_writer.queue[0].attempts, 1)
+                error.assert_not_called()
+
+                self.assertEqual(backup_writer.flush(), 0)
+                self.assertEqual(len(backup_writer.queue), 0)
+                dead = json.loads(error.call_args[0][0])
+                self.assertEqual(dead['submitter_id'], self.user3.id)
+                self.assertEqual(dead['messages'], data['messages'])
+
+        backups = Backup.query.all()
+        self.assertEqual([b.submitter_id for b in backups], [self.user1.id])
+
+    def _post_backup(self, submit):
+        data = {
+            'assignment': self.assignment.name,
+            'messages': {'file_contents': {'hog.py': 'print("Hello world!")'}},
+            'submit': submit,
+        }
+        return self.client.post('/api/v3/backups/',
+            data=json.dumps(data),
+            headers=[('Content-Type', 'application/json')])
+
+    @skipUnlessRedisIsAvailable
+    def test_backup_admission_control(self):
+        self.setup_course()
+        self.login(self.user1.email)
+        redis = admission.connection()
+
+        with mock.patch.object(admission, 'max_in_flight', 1):
+            # Another worker is writing a backup
+            redis.zadd(admission.in_flight_key, other=time.time())
+            try:
+                response = self._post_backup(False)
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers['Retry-After'],
+                                 str(admission.retry_after))
+                self.assertEqual(response.json['data']['retry_after'],
+                                 admission.retry_after)
+                self.assertEqual(Backup.query.count(), 0)
+
+                # Submissions are still accepted
+                self.assert_200(self._post_backup(True))
+                self.assertEqual(Backup.query.count(), 1)
+                self.assertEqual(admission.in_flight(), 1)
+            finally:
+                redis.zrem(admission.in_flight_key, 'other')
+
+            self.assert_200(self._post_backup(False))
+            self.assertEqual(admission.in_flight(), 0)
+
+    @skipUnlessRedisIsAvailable
+    def test_backup_admission_leaked_slot(self):
+        self.setup_course()
+        self.login(self.user1.email)
+        redis = admission.connection()
+
+        with mock.patch.object(admission, 'max_in_flight', 1):
+            # A worker died mid-write a few seconds ago and left its token behind
+            redis.zadd(admission.in_flight_key, leaked=time.time() - 5)
+            try:
+                self.assertEqual(self._post_backup(False).status_code, 503)
+                # Other writes keep arriving, which used to keep the slot alive
+                self.assert_200(self._post_backup(True))
+                self.assertEqual(self._post_backup(False).status_code, 503)
+
+                # Once the token is older than the TTL, the slot frees up
+                with mock.patch.object(admission, 'in_flight_ttl', 2):
+                    self.assert_200(self._post_backup(False))
+                    self.assertIsNone(redis.zscore(admission.in_flight_key, 'leaked'))
+                    self.assertEqual(admission.in_flight(), 0)
+            finally:
+                redis.delete(admission.in_flight_key)
+
+    def test_backup_admission_database(self):
+        self.setup_course()
+        self.login(self.user1.email)
+        # SQLite does not limit connections
+        self.assertIsNone(admission.connection_counts())
+
+        with mock.patch.object(admission, 'connection_counts', return_value=(98, 100)), \
+                mock.patch.object(admission, 'pool_reserve', 2), \
+                mock.patch.object(admission, 'status', (0, None)):
+            self.assertEqual(self._post_backup(False).status_code, 503)
+            self.assert_200(self._post_backup(True))
+            self.assertEqual(admission.connection_counts.call_count, 1)
+
+    def test_backup_idempotency_key(self):
+        self.setup_course()
+        self.login(self.user1.email)
+        request_key = str(uuid.uuid4())
+
+        def post():
+            data = {
+                'assignment': self.assignment.name,
+                'messages': {'file_contents': {'hog.py': 'print("Hello world!")'}},
+                'submit': True,
+            }
+            return self.client.post('/api/v3/backups/',
+                data=json.dumps(data),
+                headers=[('Content-Type', 'application/json'),
+                         ('Idempotency-Key', request_key)])
+
+        response = post()
+        self.assert_200(response)
+        key = response.json['data']['key']
+
+        # A retry gets the original backup back
+        response = post()
+        self.assert_200(response)
+        self.assertEqual(response.json['data']['key'], key)
+        self.assertEqual(Backup.query.count(), 1)
+        self.assertEqual(Message.query.count(), 1)
+
+        # Other keys still create backups
+        request_key = str(uuid.uuid4())
+        response = post()
+        self.assert_200(response)
+        self.assertNotEqual(response.json['data']['key'], key)
+        self.assertEqual(Backup.query.count(), 2)
+
+    def test_backup_idempotency_key_expired(self):
+        self.setup_course()
+        self.login(self.user1.email)
+        data = {
+            'assignment': self.assignment.name,
+            'messages': {'file_contents': {'hog.py': 'print("Hello world!")'}},
+            'submit': True,
+        }
+        headers = [('Content-Type', 'application/json'),
+                   ('Idempotency-Key', str(uuid.uuid4()))]
+
+        def post():
+            return self.client.post('/api/v3/backups/', data=json.dumps(data),
+                                    headers=headers)
+
+        with mock.patch.object(api, 'IDEMPOTENCY_PENDING_TIMEOUT', 1):
+            # The worker storing the backup is killed and never clears the key
+            with mock.patch.object(api.Backup.schema, 'store_backup',
+                                   side_effect=KeyboardInterrupt):
+                self.assertRaises(KeyboardInterrupt, post)
+            self.assertEqual(post().status_code, 409)
+            self.assertEqual(Backup.query.count(), 0)
+
+            # Once the placeholder expires, a retry stores the backup
+            time.sleep(1.5)
+            response = post()
+        self.assert_200(response)
+        self.assertEqual(Backup.query.count(), 1)
+        self.assertEqual(post().json['data']['key'], response.json['data']['key'])
+
+    def test_backup_idempotency_key_late(self):
+        self.setup_course()
+        self.assignment.due_date = dt.datetime.utcnow() - dt.timedelta(days=2)
+        self.assignment.lock_date = dt.datetime.utcnow() - dt.timedelta(days=1)
+        db.session.commit()
+        self.login(self.user1.email)
+        data = {
+            'assignment': self.assignment.name,
+            'messages': {'file_contents': {'hog.py': 'print("Hello world!")'}},
+            'submit': True,
+        }
+        headers = [('Content-Type', 'application/json'),
+                   ('Idempotency-Key', str(uuid.uuid4()))]
+
+        responses = [self.client.post('/api/v3/backups/', data=json.dumps(data),
+                                      headers=headers)
+                     for _ in range(2)]
+        for response in responses:
+            self.assert_403(response)
+            self.assertEqual(response.json['data'],
+                             {'data': {'backup': True, 'late': True}})
+        # The late backup was stored once
+        self.assertEqual(Backup.query.count(), 1)
+
     def test_api(self):
         response = self.client.get('/api/v3/')
         self.assert_200(response)
@@ -362,6 +678,129 @@ class TestApi(OkTestCase):
         self.assertEqual(response.json['data']['has_more'], False)
         self.assertEqual(response.json['data']['offset'], 1)
 
+    def test_export_cursor(self):
+        self.setup_course()
+        self.login(self.staff1.email)
+        time = dt.datetime(2016, 1, 1)
+        for i in range(5):
+            for user in (self.user1, self.user2, self.user3):
+                # Pairs of backups share a timestamp
+                backup = Backup(submitter=user, assignment=self.assignment,
+                                submit=i % 2 == 0, created=time + dt.timedelta(minutes=i // 2))
+                db.session.add(backup)
+        db.session.commit()
+
+        def walk(endpoint, limit):
+            ids, cursor, pages = [], '', 0
+            while cursor is not None:
+                response = self.client.get('{}?limit={}&cursor={}'.format(
+                    endpoint, limit, cursor))
+                self.assert_200(response)
+                data = response.json['data']
+                ids.extend(b['id'] for b in data['backups'])
+                cursor = data['next_cursor']
+                assert data['has_more'] == (cursor is not None)
+                pages += 1
+            return ids, pages
+
+        endpoint = '/api/v3/assignment/{0}/export/{1}'.format(
+            self.assignment.name, self.user1.email)
+        everything = self.client.get(endpoint).json['data']['backups']
+        ids, pages = walk(endpoint, 2)
+        self.assertEqual(ids, [b['id'] for b in everything])
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(pages, 3)
+
+        endpoint = '/api/v3/assignment/{0}/submissions/'.format(self.assignment.name)
+        everything = self.client.get(endpoint).json['data']['backups']
+        ids, pages = walk(endpoint, 2)
+        self.assertEqual(ids, [b['id'] for b in everything])
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(pages, 2)
+
+        response = self.client.get(endpoint + '?cursor=bogus')
+        self.assert_400(response)
+
+        # Offset pages do not store snapshots, but can be followed by cursor
+        with mock.patch.object(cache, 'set') as cache_set:
+            response = self.client.get(endpoint + '?limit=2')
+            self.assert_200(response)
+            assert not [c for c in cache_set.call_args_list
+                        if c[0][0].startswith('export-final/')]
+        data = response.json['data']
+        response = self.client.get('{}?limit=2&cursor={}'.format(
+            endpoint, data['next_cursor']))
+        self.assert_200(response)
+        ids = [b['id'] for b in data['backups'] + response.json['data']['backups']]
+        self.assertEqual(ids, [b['id'] for b in everything])
+
+    def test_export_final_queries(self):
+        self.setup_course()
+        students = [self.user1, self.user2, self.user3, self.user4, self.user5, self.user6]
+        for i in range(0, len(students), 2):
+            Group.force_add(self.staff1, students[i], students[i + 1], self.assignment)
+        for i, user in enumerate(students):
+            base = None
+            for j in range(3):
+                backup = Backup(submitter=user, assignment=self.assignment,
+                                submit=True, created=dt.datetime(2016, 1, 1, i, j))
+                base = Message(kind='file_contents', backup=backup, base=base,
+                               contents={'hog.py': 'x = {}\n'.format(j)})
+                db.session.add_all([backup, base])
+                db.session.flush()
+        db.session.commit()
+        self.login(self.staff1.email)
+        endpoint = '/api/v3/assignment/{0}/submissions/'.format(self.assignment.name)
+
+        def count_queries(limit):
+            statements = []
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                response = self.client.get('{}?limit={}'.format(endpoint, limit))
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            self.assert_200(response)
+            backups = response.json['data']['backups']
+            self.assertEqual(len(backups), limit)
+            for backup in backups:
+                self.assertEqual(len(backup['group']), 2)
+                self.assertEqual(backup['messages'][0]['contents'], {'hog.py': 'x = 2\n'})
+            return len(statements)
+
+        # The first request also fills the caches
+        count_queries(1)
+        self.assertEqual(count_queries(1), count_queries(3))
+
+    def test_export_final_stream(self):
+        self._test_backup(True)
+        Group.invite(self.user1, self.user2, self.assignment)
+        Group.lookup(self.user1, self.assignment).accept(self.user2)
+        backup = Backup(submitter=self.user3, assignment=self.assignment, submit=True)
+        db.session.add(Message(kind='file_contents', backup=backup,
+                               contents={'hog.py': 'x = 3', 'submit': True}))
+        db.session.add(backup)
+        db.session.commit()
+        endpoint = '/api/v3/assignment/{0}/submissions/stream'.format(self.assignment.name)
+
+        response = self.client.get(endpoint)
+        self.assert_403(response)
+
+        self.login(self.staff1.email)
+        response = self.client.get(endpoint)
+        self.assert_200(response)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        records = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['id'], encode_id(backup.id))
+        self.assertEqual(records[0]['group'], [self.user3.email])
+        self.assertEqual(records[0]['files'], {'hog.py': 'x = 3'})
+        self.assertEqual(records[1]['group'], sorted([self.user1.email, self.user2.email]))
+        self.assertEqual(records[1]['submitter'], self.user1.email)
+        self.assertEqual(records[1]['files'], {'hog.py': 'print("Hello world!")'})
+        self.assertTrue(records[1]['submit'])
+
     def test_assignment_api(self):
         self._test_backup(True)
         student = User.lookup(self.user1.email)
@@ -750,6 +1189,45 @@ class TestApi(OkTestCase):
         response = self.client.get(endpoint)
         self.assert_200(response)
     
+    def test_course_grades_etag(self):
+        self.setup_course()
+        self.assignment.published_scores = ['total']
+        db.session.commit()
+        self.login(self.staff1.email)
+        endpoint = '/api/v3/course/cal/cs61a/sp16/grades'
+
+        response = self.client.get(endpoint)
+        self.assert_200(response)
+        etag = response.headers['ETag']
+        grades = response.json['data']['grades']
+
+        response = self.client.get(endpoint, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # Another requester gets a different response
+        self.login(self.admin.email)
+        response = self.client.get(endpoint, headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.login(self.staff1.email)
+
+        backup = Backup(submitter=self.user1, assignment=self.assignment, submit=True)
+        score = Score(backup=backup, kind='total', score=5, message='',
+                      grader=self.staff1, user_id=self.user1.id,
+                      assignment=self.assignment)
+        db.session.add_all([backup, score])
+        db.session.commit()
+        response = self.client.get(endpoint, headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertNotEqual(response.json['data']['grades'], grades)
+        self.assertIn('{},,5.0'.format(self.user1.email),
+                      response.json['data']['grades'].splitlines())
+
+        score.archive()
+        response = self.client.get(endpoint)
+        self.assertEqual(response.json['data']['grades'], grades)
+
     def test_course_roster(self):
         self._test_backup(True)
         self.login(self.staff1.email)
@@ -757,12 +1235,14 @@ class TestApi(OkTestCase):
         endpoint = '/api/v3/course/cal/cs61a/sp16/roster'
         response = self.client.get(endpoint)
         self.assert_200(response)
+        self.assertIn(self.user1.email, response.json['data']['roster'])
         
         self.login(self.staff2.email)
 
         endpoint = '/api/v3/course/cal/cs61a/sp16/roster'
         response = self.client.get(endpoint)
         self.assert_200(response)
+        self.assertIn(self.user1.email, response.json['data']['roster'])
 
         self.login(self.user1.email)
 
@@ -781,3 +1261,68 @@ class TestApi(OkTestCase):
         endpoint = '/api/v3/course/cal/cs61a/sp16/roster'
         response = self.client.get(endpoint)
         self.assert_200(response)
+        self.assertIn(self.user1.email, response.json['data']['roster'])
+
+    def test_course_roster_etag(self):
+        self.setup_course()
+        self.user1.name = 'Doe, "Jane"'
+        db.session.commit()
+        self.login(self.staff1.email)
+        endpoint = '/api/v3/course/cal/cs61a/sp16/roster'
+
+        response = self.client.get(endpoint)
+        self.assert_200(response)
+        etag = response.headers['ETag']
+        roster = response.json['data']['roster']
+        self.assertEqual(response.json['data']['requester'], self.staff1.email)
+        self.assertTrue(roster.startswith('email,name,sid,class_account,section,role\n'))
+        self.assertIn('{},"Doe, ""Jane""",,,,Student'.format(self.user1.email),
+                      roster.splitlines())
+
+        response = self.client.get(endpoint + '?envelope=false')
+        self.assertEqual(response.json['roster'], roster)
+
+        response = self.client.get(endpoint, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        enrollment_endpoint = '/api/v3/course/cal/cs61a/sp16/enrollment'
+        response = self.client.get(enrollment_endpoint)
+        enrollment_etag = response.headers['ETag']
+        response = self.client.get(enrollment_endpoint,
+                                   headers={'If-None-Match': enrollment_etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Changing a student's email or enrollment changes the roster
+        self.user1.email = 'renamed@example.com'
+        db.session.commit()
+        response = self.client.get(endpoint, headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertIn('renamed@example.com', response.json['data']['roster'])
+        etag = response.headers['ETag']
+
+        self.user2.participations[0].section = '101'
+        db.session.commit()
+        response = self.client.get(endpoint, headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertIn('{},,,,101,Student'.format(self.user2.email),
+                      response.json['data']['roster'].splitlines())
+        response = self.client.get(enrollment_endpoint,
+                                   headers={'If-None-Match': enrollment_etag})
+        self.assert_200(response)
+        etag = response.headers['ETag']
+
+        # Columns that are not in the roster leave it unchanged, without
+        # looking up the user's courses
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.user1.is_admin = True
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertFalse([s for s in statements if 'FROM enrollment' in s])
+        response = self.client.get(enrollment_endpoint, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
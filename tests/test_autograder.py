@@ -0,0 +1,176 @@
+import datetime
+import logging
+from unittest import mock
+
+from flask_rq import get_connection
+from redis.exceptions import RedisError
+from sqlalchemy import event
+
+from server import autograder
+from server.models import db, Backup, Score
+from server.utils import encode_id
+
+from tests import OkTestCase, skipUnlessRedisIsAvailable
+
+class TestAutograder(OkTestCase):
+    def setUp(self):
+        super(TestAutograder, self).setUp()
+        self.setup_course()
+        self.assignment.autograding_key = 'key'
+        self.course.autograder_url = 'http://autograder'
+        self.backups = [Backup(submitter=user, assignment=self.assignment, submit=True)
+                        for user in (self.user1, self.user3)]
+        db.session.add_all(self.backups)
+        db.session.commit()
+        self.job_ids = {backup.id: 'job{}'.format(i)
+                        for i, backup in enumerate(self.backups)}
+        # Backup ids are reused by every test, so drop their old events
+        try:
+            get_connection().delete(*[autograder.job_event_key(backup_id, job_id)
+                                      for backup_id, job_id in self.job_ids.items()])
+            get_connection().delete(*[autograder.score_event_key(backup_id)
+                                      for backup_id in self.job_ids])
+        except RedisError:
+            pass
+
+    def _score(self, backup, created=None):
+        score = Score(backup=backup, kind='total', score=1, message='',
+                      grader=self.staff1, user_id=backup.submitter_id,
+                      assignment=self.assignment)
+        if created:
+            score.created = created
+        db.session.add(score)
+        db.session.commit()
+
+    def _autograde(self, events, results=None):
+        """ Autograde the backups. Before each tick, call the next function
+        in EVENTS. Return the job ids polled for each call to /results.
+        """
+        polls = []
+        def send_autograder(endpoint, data, autograder_url):
+            if endpoint == '/results':
+                polls.append(sorted(data))
+                return {job_id: (results or {}).get(job_id, {'status': 'queued'})
+                        for job_id in data}
+            return {'jobs': [self.job_ids[bid] for bid in
+                             [self.backups[0].id, self.backups[1].id]]}
+        def sleep(seconds):
+            if events:
+                events.pop(0)()
+
+        with mock.patch.object(autograder, 'send_autograder', send_autograder), \
+                mock.patch.object(autograder.time, 'sleep', sleep):
+            autograder.autograde_backups(
+                self.assignment, self.staff1.id,
+                [self.backups[0].id, self.backups[1].id], logging.getLogger())
+        return polls
+
+    @skipUnlessRedisIsAvailable
+    def test_job_notification(self):
+        endpoint = '/api/v3/autograder/jobs/job0'
+        bid = self.backups[0].id
+        data = {'bid': encode_id(bid), 'status': 'finished'}
+        self.login(self.staff1.email)
+        self.assert_200(self.client.post(endpoint, data=data))
+        self.assertEqual(autograder.pushed_job_results([(bid, 'job0')]),
+                         {'job0': {'status': 'finished'}})
+
+        # A late notification does not undo the end of a job
+        self.assert_200(self.client.post(endpoint, data=dict(data, status='started')))
+        self.assertEqual(autograder.pushed_job_results([(bid, 'job0')]),
+                         {'job0': {'status': 'finished'}})
+
+        # A job is only matched with the backup it was reported for
+        other = encode_id(self.backups[1].id)
+        self.assert_200(self.client.post('/api/v3/autograder/jobs/job1',
+                                         data=dict(data, bid=other)))
+        self.assertEqual(autograder.pushed_job_results([(bid, 'job1')]), {})
+
+        self.assert_400(self.client.post(endpoint, data=dict(data, status='done')))
+        self.assert_404(self.client.post(endpoint, data=dict(data, bid='xyz')))
+        self.login(self.user1.email)
+        self.assert_403(self.client.post(endpoint, data=data))
+
+    @skipUnlessRedisIsAvailable
+    def test_autograde_with_events(self):
+        def status(i, status):
+            backup_id = self.backups[i].id
+            autograder.record_job_status(backup_id, self.job_ids[backup_id], status)
+        def score(i):
+            self._score(self.backups[i])
+            autograder.record_score(self.backups[i].id)
+
+        events = [lambda: status(0, 'finished'),
+                  lambda: score(0),
+                  lambda: status(1, 'started'),
+                  lambda: status(1, 'finished'),
+                  lambda: score(1)]
+        polls = self._autograde(events)
+        # Every status came from a notification, so nothing was polled
+        self.assertEqual(polls, [])
+        self.assertEqual(events, [])
+
+    def test_autograde_fallback(self):
+        # Scores are created without a notification
+        later = datetime.datetime.now() + datetime.timedelta(minutes=1)
+        results = {'job0': {'status': 'finished'}}
+        events = [lambda: self._score(self.backups[0], created=later),
+                  lambda: results.update(job1={'status': 'finished'}),
+                  lambda: self._score(self.backups[1], created=later)]
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with mock.patch.object(autograder, 'MIN_POLL_INTERVAL', 0), \
+                    mock.patch.object(autograder, 'MAX_POLL_INTERVAL', 0):
+                polls = self._autograde(events, results)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # Only jobs that are still running are polled
+        self.assertEqual(polls[0], ['job0', 'job1'])
+        self.assertEqual(polls[-1], ['job1'])
+        self.assertEqual(events, [])
+        # One query for the scores of all waiting backups on each tick
+        score_queries = [s for s in statements
+                         if s.startswith('SELECT') and 'FROM score' in s]
+        self.assertEqual(len(score_queries), 2)
+
+    def test_poll_backoff(self):
+        interval = autograder.MIN_POLL_INTERVAL
+        intervals = []
+        for changed in [False, False, False, False, True, False]:
+            interval = autograder.next_poll_interval(interval, changed, True)
+            intervals.append(interval)
+        self.assertEqual(intervals, [20, 40, 60, 60, 10, 20])
+        # Polls do not back off for an autograder that does not push events
+        self.assertEqual(autograder.next_poll_interval(20, False, False),
+                         autograder.MIN_POLL_INTERVAL)
+
+    def test_advance_task(self):
+        retried = []
+        def task(status):
+            return autograder.GradingTask(status=status, backup_id=self.backups[0].id,
+                                          job_id='job0', retries=0)
+        def advance(task, results, scored=()):
+            autograder.advance_task(task, results, set(scored), retried.append,
+                                    logging.getLogger())
+            return task.status
+
+        # A job that started and finished since the last tick is caught up on
+        finished = {'job0': {'status': 'finished'}}
+        self.assertEqual(advance(task(autograder.GradingStatus.QUEUED), finished),
+                         autograder.GradingStatus.WAITING)
+        self.assertEqual(advance(task(autograder.GradingStatus.QUEUED), {}),
+                         autograder.GradingStatus.QUEUED)
+        self.assertEqual(advance(task(autograder.GradingStatus.WAITING), {},
+                                 [self.backups[0].id]),
+                         autograder.GradingStatus.DONE)
+        self.assertEqual(retried, [])
+
+        # Failed and missing jobs are retried
+        failed = task(autograder.GradingStatus.RUNNING)
+        advance(failed, {'job0': {'status': 'failed'}})
+        missing = task(autograder.GradingStatus.QUEUED)
+        advance(missing, {'job0': None})
+        self.assertEqual(retried, [failed, missing])
@@ -1,5 +1,9 @@
 import datetime as dt
 import json
+import re
+from unittest import mock
+
+from sqlalchemy import event
 
 from server.models import db, Backup, Group, Extension
 from server.controllers import api
@@ -150,6 +154,39 @@ class TestExtension(OkTestCase):
         # But not after the extension has expired
         self._submit_to_api(self.user1, False)
 
+    def test_submit_with_cached_extension(self):
+        self.set_offset(-2) # Lock assignment
+        ext = self._make_ext(self.assignment, self.user1)
+        self._submit_to_api(self.user1, True)
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self._submit_to_api(self.user1, True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # The extension is found without reading the extension table
+        assert not [s for s in statements if re.search(r'FROM extension\b', s)]
+
+        Extension.delete(ext)
+        self._submit_to_api(self.user1, False)
+
+    def test_extension_cache_cleared_on_commit(self):
+        assert Extension.lookup(self.user1.id, self.assignment.id) is None
+        ext = Extension(assignment=self.assignment, user=self.user1,
+                        staff=self.staff1, custom_submission_time=dt.datetime.utcnow(),
+                        expires=dt.datetime.utcnow() + dt.timedelta(days=1))
+        db.session.add(ext)
+        db.session.flush()
+        # Another request reads the extensions before the commit
+        stale = mock.Mock(**{'filter_by.return_value': []})
+        with mock.patch.object(Extension, 'query', stale):
+            assert Extension.assignment_extensions(self.assignment.id) == []
+        db.session.commit()
+        assert Extension.lookup(self.user1.id, self.assignment.id).id == ext.id
+
     def test_submit_between_due_and_lock(self):
         """ Extensions should also change the custom submission time
         when submitted after the due date but before the lock date.
@@ -3,13 +3,16 @@ import datetime
 import random
 from io import StringIO
 
+from sqlalchemy import event
 import werkzeug.datastructures
 from werkzeug.exceptions import BadRequest
 
 from server.constants import SCORE_KINDS
-from server.models import db, Backup, Group, Message, GradingTask, Score
+from server.models import db, Assignment, Backup, Group, Message, GradingTask, Score
 import server.utils as utils
+from server.controllers import admin
 from server import generate
+from server.jobs import export_grades
 from server import constants
 
 from tests import OkTestCase
@@ -92,34 +95,119 @@ class TestGrading(OkTestCase):
         slow_submissions = [fs['backup']['id'] for fs in slow_course_subms if fs['backup']]
         self.assertEqual(len(submissions), len(course_subms_filtered))
         self.assertEqual(len(slow_submissions), len(course_subms_filtered))
-        print("Running with {}".format(db.engine.name))
-
-        if db.engine.name == 'mysql':
-            query = self.assignment.mysql_course_submissions_query()
-            mysql_data = [d for d in query]
-            self.assertEqual(len(course_submissions), len(mysql_data))
-
-            has_submission = sorted(list(fs['user']['id'] for fs in course_submissions
-                                 if fs['backup']))
-            has_submission_slow = sorted(list(fs['user']['id'] for fs in slow_course_subms
-                                      if fs['backup']))
-            self.assertEqual(has_submission, has_submission_slow)
-
-            no_subm = sorted(list(fs['user']['id'] for fs in course_submissions
-                                 if not fs['backup']))
-            no_subm_slow = sorted(list(fs['user']['id'] for fs in slow_course_subms
-                                      if not fs['backup']))
-            self.assertEqual(no_subm, no_subm_slow)
-
-            backup = sorted(list(fs['backup']['id'] for fs in course_submissions
-                                 if fs['backup']))
-            backup_slow = sorted(list(fs['backup']['id'] for fs in slow_course_subms
-                                      if fs['backup']))
-
-            self.assertEqual(backup, backup_slow)
-        else:
-            self.assertEqual(slow_course_subms, course_submissions)
+        self.assertEqual(slow_course_subms, course_submissions)
 
+    def test_course_submissions_queries(self):
+        # A pending invite, a flagged submission and a student with only backups
+        Group.invite(self.user1, self.user4, self.assignment)
+        submission = self.assignment.submissions(self.active_user_ids).all()[10]
+        self.assignment.flag(submission.id, self.active_user_ids)
+        backup = Backup(submitter_id=self.user5.id, assignment=self.assignment)
+        db.session.add(backup)
+        db.session.commit()
+        db.session.refresh(self.assignment)
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            fast = self.assignment.course_submissions()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), 4)
+        # Final submissions come from the final_submission table
+        self.assertEqual(len([s for s in statements if 'FROM final_submission' in s]), 1)
+
+        self.assertEqual(fast, self.assignment.course_submissions_slow())
+        self.assertEqual(self.assignment.course_submissions(include_empty=False),
+                         self.assignment.course_submissions_slow(include_empty=False))
+        backups = {fs['user']['id']: fs['backup']['id'] for fs in fast if fs['backup']}
+        self.assertEqual(backups[self.user1.id], submission.id)
+        self.assertEqual(backups[self.user5.id], backup.id)
+
+    def test_course_submissions_pending_invite(self):
+        Group.invite(self.user1, self.user4, self.assignment)
+        backup = Backup(submitter_id=self.user4.id, assignment=self.assignment)
+        db.session.add(backup)
+        db.session.commit()
+        db.session.refresh(self.assignment)
+        group_final = self.assignment.final_submission({self.user1.id, self.user2.id})
+
+        for submissions in (self.assignment.course_submissions(),
+                            self.assignment.course_submissions_slow()):
+            user_ids = [fs['user']['id'] for fs in submissions]
+            self.assertEqual(sorted(user_ids), sorted(set(user_ids)))
+            self.assertEqual(len(user_ids), len(self.assignment.course.get_students()))
+            rows = {fs['user']['id']: fs for fs in submissions}
+            self.assertEqual(rows[self.user1.id]['backup']['id'], group_final.id)
+            self.assertEqual(rows[self.user2.id]['backup']['id'], group_final.id)
+            group_member = rows[self.user1.id]['group']['group_member']
+            self.assertEqual(set(group_member.split(',')),
+                             {str(self.user1.id), str(self.user2.id)})
+            self.assertEqual(rows[self.user4.id]['backup']['id'], backup.id)
+            self.assertIsNone(rows[self.user4.id]['group'])
+
+    def test_assignment_stats(self):
+        Group.invite(self.user1, self.user4, self.assignment)
+        backup = Backup(submitter_id=self.user5.id, assignment=self.assignment)
+        db.session.add(backup)
+        db.session.commit()
+
+        stats = Assignment.assignment_stats(self.assignment.id, detailed=True)
+        data = stats.pop('raw_data')
+        self.assertEqual(data, self.assignment.course_submissions())
+
+        # The stats used to be recomputed from the course submissions
+        query = Backup.query.filter_by(assignment=self.assignment)
+        with_subm = {d['user']['id'] for d in data if d['backup'] and d['backup']['submit']}
+        with_backup = {d['user']['id'] for d in data if d['backup'] and not d['backup']['submit']}
+        active_groups = {d['group']['group_id'] for d in data
+                         if d['group'] and ',' in d['group']['group_member']}
+        self.assertEqual(stats, {
+            'submissions': query.filter_by(submit=True).count(),
+            'backups': query.count(),
+            'groups': 1,
+            'unique_submissions': len({d['backup']['id'] for d in data if d['backup']}),
+            'students_with_subm': len(with_subm),
+            'students_with_backup': len(with_backup),
+            'students_no_backup': len({d['user']['id'] for d in data if not d['backup']}),
+            'percent_started': (len(with_subm) + len(with_backup)) / len(data) * 100,
+            'percent_finished': len(with_subm) / len(data) * 100,
+            'active_groups': len(active_groups),
+            'percent_groups_active': len(active_groups),
+        })
+
+        # Counts follow submits and deletes
+        backup.submit = True
+        db.session.commit()
+        stats = Assignment.assignment_stats(self.assignment.id)
+        self.assertNotIn('raw_data', stats)
+        self.assertEqual(stats['submissions'], query.filter_by(submit=True).count())
+        self.assertEqual(stats['students_with_backup'], 0)
+
+        db.session.delete(backup)
+        db.session.commit()
+        stats = Assignment.assignment_stats(self.assignment.id)
+        self.assertEqual(stats['backups'], query.count())
+        self.assertEqual(stats['students_no_backup'], len(data) - len(with_subm))
+
+    def test_backup_counts_batched(self):
+        before = Assignment.assignment_stats(self.assignment.id)
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            db.session.add_all([Backup(submitter_id=user.id, assignment=self.assignment)
+                                for user in (self.user1, self.user5, self.user5)])
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # The counts of every user are written together, once per flush
+        self.assertEqual(len([s for s in statements if 'backup_count' in s]), 2)
+        stats = Assignment.assignment_stats(self.assignment.id)
+        self.assertEqual(stats['backups'], before['backups'] + 3)
 
     def test_flag(self):
         submission = self.assignment.submissions(self.active_user_ids).all()[10]
@@ -192,6 +280,104 @@ class TestGrading(OkTestCase):
 
         self.assertEqual(len(backup_creators), len(csv_rows) - 1)
 
+    def test_score_export_queries(self):
+        for user in [self.user1, self.user3]:
+            backup = Backup.query.filter_by(submitter_id=user.id,
+                                            assignment=self.assignment).first()
+            db.session.add(Score(backup_id=backup.id, kind="total", score=2.0,
+                                 message="Good work", assignment_id=self.assignment.id,
+                                 user_id=backup.submitter_id, grader=self.staff1))
+        db.session.commit()
+        self.login(self.staff1.email)
+
+        endpoint = '/admin/course/1/assignments/1/scores.csv'
+        self.client.get(endpoint)  # warm the caches
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get(endpoint)
+            csv_rows = list(csv.DictReader(StringIO(str(response.data, 'utf-8'))))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assert_200(response)
+        score_statements = [s for s in statements
+                            if 'FROM score' in s or 'enrollment.user_id IN' in s]
+        self.assertEqual(len(score_statements), 2)
+
+        # user1 and user2 are in a group, so each gets a row for user1's score
+        emails = sorted(row['email'] for row in csv_rows)
+        self.assertEqual(emails, sorted([self.user1.email, self.user2.email,
+                                         self.user3.email]))
+        for row in csv_rows:
+            self.assertEqual(row['grader'], self.staff1.email)
+
+    def test_score_export_batches(self):
+        for user in [self.user1, self.user3]:
+            backup = Backup.query.filter_by(submitter_id=user.id,
+                                            assignment=self.assignment).first()
+            db.session.add(Score(backup_id=backup.id, kind="total", score=2.0,
+                                 message="Good work", assignment_id=self.assignment.id,
+                                 user_id=backup.submitter_id, grader=self.staff1))
+        db.session.commit()
+        self.login(self.staff1.email)
+        endpoint = '/admin/course/1/assignments/1/scores.csv'
+        expected = str(self.client.get(endpoint).data, 'utf-8')
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with self.app.test_request_context():
+                chunks = list(admin.scores_csv_rows(self.assignment, self.course,
+                                                    chunk_size=1))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # The header, then one chunk per score
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks), expected)
+        # Each chunk of scores is loaded on its own, and one more finds the end
+        self.assertEqual(len([s for s in statements if 'FROM score' in s]), 3)
+
+
+    def test_export_grades(self):
+        self.assignment.published_scores = ['total', 'composition', 'revision']
+        self.assignment2.published_scores = ['total']
+        for user, assign, kind, value, archived in [
+                (self.user1, self.assignment, 'total', 5, False),
+                (self.user2, self.assignment, 'effort', 7, False),
+                (self.user2, self.assignment, 'total', 8, True),
+                (self.user3, self.assignment, 'composition', 3, False),
+                (self.user3, self.assignment, 'revision', 4, False),
+                (self.user3, self.assignment2, 'total', 9, False),
+                (self.user3, self.assignment2, 'total', 6, False)]:
+            backup = assign.submissions([user.id]).first()
+            db.session.add(Score(backup=backup, kind=kind, score=value, message='',
+                                 assignment=assign, user_id=user.id,
+                                 grader=self.staff1, archived=archived))
+        db.session.commit()
+
+        students = self.course.get_students()
+        headers, assignments = export_grades.get_headers(self.course.assignments)
+        all_scores = export_grades.collect_all_scores(
+            assignments, [student.user_id for student in students])
+        rows = {student.user.email: export_grades.export_student_grades(
+                    student, assignments, all_scores)[2:]
+                for student in students}
+
+        assert assignments == [self.assignment, self.assignment2]
+        assert headers[2:] == ['{} (Total)'.format(self.assignment.display_name),
+                               '{} (Composition)'.format(self.assignment.display_name),
+                               '{} (Revision)'.format(self.assignment.display_name),
+                               '{} (Total)'.format(self.assignment2.display_name)]
+        # user1 and user2 are a group, so they share their best scores
+        assert rows[self.user1.email] == [7, 0, 0, 0]
+        assert rows[self.user2.email] == [7, 0, 0, 0]
+        assert rows[self.user3.email] == [0, 4, 4, 9]
+        assert rows[self.user4.email] == [0, 0, 0, 0]
 
     def test_publish_grades(self):
         scores, users = {}, [self.user1, self.user3]
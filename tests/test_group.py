@@ -1,4 +1,5 @@
 import datetime
+from sqlalchemy import event
 from werkzeug.exceptions import BadRequest
 
 from server.models import db, Assignment, Group, GroupAction, User
@@ -172,6 +173,29 @@ class TestGroup(OkTestCase):
         self.assertRaises(BadRequest, group.remove, self.user2, self.user3)
         self.assertRaises(BadRequest, group.remove, self.user3, self.user2)
 
+    def test_active_user_ids_cached(self):
+        Group.invite(self.user1, self.user2, self.assignment)
+        group = Group.lookup(self.user1, self.assignment)
+        group.accept(self.user2)
+        members = {self.user1.id, self.user2.id}
+        assert self.assignment.active_user_ids(self.user1.id) == members
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        assignment, user2_id, user3_id = self.assignment, self.user2.id, self.user3.id
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            assert assignment.active_user_ids(user2_id) == members
+            assert assignment.active_user_ids(user3_id) == {user3_id}
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        assert statements == []
+
+        group.remove(self.user1, self.user2)
+        assert self.assignment.active_user_ids(self.user1.id) == {self.user1.id}
+        assert self.assignment.active_user_ids(self.user2.id) == {self.user2.id}
+
     def test_log(self):
         def latest_action():
             return GroupAction.query.order_by(GroupAction.id.desc()).first()
@@ -1,9 +1,21 @@
 import datetime
+import io
+import logging
+import zipfile
+from unittest import mock
 from werkzeug.exceptions import BadRequest
 
-from server.models import db, Backup, Group, Message
+import json
 
-from tests import OkTestCase
+from sqlalchemy import event, type_coerce
+
+from server import compression, ingest, jobs
+from server.constants import BACKUP_SNAPSHOT_INTERVAL
+from server.controllers.api import make_backup
+from server.jobs import export, recompress, reencode_backups
+from server.models import db, Backup, FileBlob, FinalSubmission, Group, Message, Job, Score
+
+from tests import OkTestCase, skipIfWindows, skipUnlessRedisIsAvailable
 
 class TestSubmission(OkTestCase):
     """Tests flagging submissions and final submissions."""
@@ -41,6 +53,65 @@ class TestSubmission(OkTestCase):
         assert self.assignment.active_user_ids(self.user3.id) == \
             {self.user3.id}
 
+    def test_bulk_lookups(self):
+        Group.invite(self.user1, self.user2, self.assignment)
+        Group.invite(self.user1, self.user3, self.assignment)
+        group = Group.lookup(self.user1, self.assignment)
+        group.accept(self.user2)
+        self.assignment.published_scores = ['total']
+        for user, kind, value in [(self.user1, 'total', 2), (self.user2, 'total', 3),
+                                  (self.user2, 'composition', 1), (self.user3, 'total', 1)]:
+            backup = self.assignment.submissions([user.id]).first()
+            db.session.add(Score(backup=backup, kind=kind, score=value, message='',
+                                 grader=self.staff1, user_id=user.id,
+                                 assignment=self.assignment))
+        db.session.commit()
+
+        users = [self.user1, self.user2, self.user3, self.user4]
+        user_ids = [user.id for user in users]
+        active_ids = self.assignment.active_user_ids_many(user_ids)
+        finals = self.assignment.final_submission_many(user_ids)
+        groups = Group.lookup_many(user_ids, self.assignment)
+        for user in users:
+            group_ids = self.assignment.active_user_ids(user.id)
+            assert active_ids[user.id] == group_ids
+            assert finals.get(user.id) == self.assignment.final_submission(group_ids)
+            assert groups.get(user.id) == Group.lookup(user, self.assignment)
+            for only_published in (True, False):
+                scores = self.assignment.scores_many(user_ids, only_published)
+                assert sorted(scores[user.id], key=lambda s: s.id) == sorted(
+                    self.assignment.scores(group_ids, only_published),
+                    key=lambda s: s.id)
+        assert self.user4.id not in finals
+        assert groups[self.user3.id] == group
+
+    def test_export_zip(self):
+        Group.invite(self.user1, self.user2, self.assignment)
+        group = Group.lookup(self.user1, self.assignment)
+        group.accept(self.user2)
+        finals = [self.assignment.final_submission(
+                      self.assignment.active_user_ids(user.id))
+                  for user in (self.user1, self.user3)]
+
+        logger = logging.getLogger(__name__)
+        chunks = list(export.export_zip(logger, self.assignment, False, batch_size=2))
+        # One chunk per batch of students, and one for the central directory
+        num_students = len(self.course.get_students())
+        assert len(chunks) == (num_students + 1) // 2 + 1
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zf:
+            assert zf.testzip() is None
+            folders = {name.rsplit('/', 1)[0] for name in zf.namelist()}
+            assert folders == {
+                '{}/{}/{}'.format(self.assignment.name.replace('/', '-'),
+                                  '-'.join(sorted(emails)), backup.hashid)
+                for emails, backup in zip([[self.user1.email, self.user2.email],
+                                           [self.user3.email]], finals)}
+            for folder in folders:
+                assert zf.read(folder + '/backup.py') == b'1'
+                info = json.loads(zf.read(folder + '/info.json').decode())
+                assert info['submitter'] in info['group']
+
     def test_no_flags(self):
         final = self.assignment.final_submission(self.active_user_ids)
         most_recent = self.assignment.submissions(self.active_user_ids).first()
@@ -131,6 +202,58 @@ class TestSubmission(OkTestCase):
         group.accept(self.user1)
         assert not submission.flagged
 
+    def test_final_submission_table(self):
+        def finals():
+            return {fs.user_id: fs.backup for fs in FinalSubmission.query.filter_by(
+                assignment_id=self.assignment.id)}
+
+        latest = {uid: self.assignment.submissions([uid]).first()
+                  for uid in self.active_user_ids}
+        assert finals() == latest
+
+        submission = self.assignment.submissions([self.user1.id]).all()[3]
+        self.assignment.flag(submission.id, [self.user1.id])
+        assert finals()[self.user1.id] == submission
+        assert finals()[self.user2.id] == latest[self.user2.id]
+        self.assignment.unflag(submission.id, [self.user1.id])
+        assert finals()[self.user1.id] == latest[self.user1.id]
+
+        # Group members share the group's final submission
+        Group.invite(self.user1, self.user2, self.assignment)
+        group = Group.lookup(self.user1, self.assignment)
+        group.accept(self.user2)
+        group_final = self.assignment.submissions(
+            [self.user1.id, self.user2.id]).first()
+        assert finals()[self.user1.id] == group_final
+        assert finals()[self.user2.id] == group_final
+        assert finals()[self.user3.id] == latest[self.user3.id]
+
+        backup = Backup(submitter_id=self.user2.id,
+            assignment=self.assignment, submit=True)
+        db.session.add(backup)
+        db.session.commit()
+        assert finals()[self.user1.id] == backup
+        assert self.assignment.final_submission([self.user1.id]) == backup
+
+        group.remove(self.user1, self.user2)
+        assert finals()[self.user1.id] == latest[self.user1.id]
+        assert finals()[self.user2.id] == backup
+
+        # Deleting a final submission picks the next one, and its row is
+        # removed before the backup so that the foreign key holds
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            db.session.delete(backup)
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        deletes = [s.split()[2] for s in statements if s.startswith('DELETE')]
+        assert deletes.index('final_submission') < deletes.index('backup')
+        assert finals()[self.user2.id] == latest[self.user2.id]
+
     def test_files(self):
         backup = Backup(
             submitter_id=self.user1.id,
@@ -152,6 +275,215 @@ class TestSubmission(OkTestCase):
             'hog.py': 'def foo():\n    return'
         }
 
+    def test_files_deduplicated(self):
+        # Every backup from setUp has the same file
+        assert FileBlob.query.count() == 1
+        message = Message.query.filter_by(kind='file_contents').first()
+        assert message.encoding == 'dedup'
+        assert message.contents == {'backup.py': '1'}
+
+        backup = Backup(
+            submitter_id=self.user1.id,
+            assignment=self.assignment,
+            submit=True)
+        message = Message(
+            kind='file_contents',
+            backup=backup,
+            contents={
+                'backup.py': '1',
+                'hog.py': 'def foo():\n    return',
+                'submit': True
+            })
+        db.session.add(backup)
+        db.session.commit()
+
+        assert FileBlob.query.count() == 2
+        assert message.contents == {
+            'backup.py': '1',
+            'hog.py': 'def foo():\n    return',
+            'submit': True
+        }
+        # Other kinds of messages are stored as is
+        analytics = Message.query.filter_by(kind='analytics').first()
+        assert analytics.encoding is None
+        assert analytics.contents == {}
+
+    def _make_versions(self, count):
+        lines = ['line {}\n'.format(i) for i in range(100)]
+        versions = []
+        for i in range(count):
+            lines[i] = 'changed {}\n'.format(i)
+            versions.append({
+                'hog.py': ''.join(lines),
+                'README': 'unchanged',
+                'submit': i % 2 == 0,
+            })
+        return versions
+
+    def _store_versions(self, versions, analytics=None):
+        """ Store each of VERSIONS through the write-behind queue, which stores
+        files as diffs against the previous backup.
+        """
+        backups = []
+        for files in versions:
+            messages = {'file_contents': files, 'analytics': analytics or {}}
+            backups.extend(ingest.write_backups([ingest.PendingBackup(
+                self.user4.id, self.assignment.id, messages,
+                datetime.datetime.utcnow(), 0)]))
+        db.session.expire_all()
+        return backups
+
+    def test_files_delta_encoded(self):
+        versions = self._make_versions(BACKUP_SNAPSHOT_INTERVAL + 2)
+        backups = self._store_versions(versions)
+
+        encodings = [m.encoding for b in backups for m in b.messages
+                     if m.kind == 'file_contents']
+        assert encodings == (['dedup'] + ['delta'] * (BACKUP_SNAPSHOT_INTERVAL - 1)
+                             + ['dedup', 'delta'])
+        last = [m for m in backups[-1].messages if m.kind == 'file_contents'][0]
+        assert last._contents['same'] == ['README']
+        assert list(last._contents['patches']) == ['hog.py']
+
+        for backup, files in zip(backups, versions):
+            assert backup.files() == {k: v for k, v in files.items() if k != 'submit'}
+        messages = (Message.query.join(Backup)
+                           .filter(Backup.submitter_id == self.user4.id,
+                                   Message.kind == 'file_contents')
+                           .order_by(Message.id).all())
+        assert Message.decode_many(messages) == versions
+
+    def test_files_snapshot_on_request(self):
+        versions = self._make_versions(2)
+        backups = [make_backup(self.user4, self.assignment.id,
+                               {'file_contents': files}, False)
+                   for files in versions]
+        db.session.expire_all()
+        assert [m.encoding for b in backups for m in b.messages] == ['dedup', 'dedup']
+
+    def test_decode_reencoded_chain(self):
+        versions = self._make_versions(3)
+        backups = self._store_versions(versions)
+        messages = [b.messages[0] if b.messages[0].kind == 'file_contents'
+                    else b.messages[1] for b in backups]
+        assert [m.encoding for m in messages] == ['dedup', 'delta', 'delta']
+
+        # The middle backup is re-encoded against a snapshot that is not in
+        # the chain of the last one
+        other = self._store_versions([versions[0]])[0]
+        snapshot = [m for m in other.messages if m.kind == 'file_contents'][0]
+        snapshot.store_files(versions[0])
+        messages[1].store_files(versions[1], snapshot, versions[0])
+        db.session.commit()
+        db.session.expire_all()
+        assert snapshot.id not in messages[2]._contents['chain']
+
+        last = Message.query.get(messages[2].id)
+        assert Message.decode_many([last]) == [versions[2]]
+        assert last.file('README') == 'unchanged'
+
+    def test_backup_file(self):
+        versions = self._make_versions(3)
+        backups = self._store_versions(versions, analytics={'q': 1})
+
+        for backup, files in zip(backups, versions):
+            backup = Backup.query.get(backup.id)
+            assert backup.file('hog.py') == files['hog.py']
+            assert backup.file('README') == 'unchanged'
+            self.assertRaises(KeyError, backup.file, 'submit')
+            self.assertRaises(KeyError, backup.file, 'missing.py')
+            assert backup.analytics() == {'q': 1}
+            # Only the requested kinds were loaded
+            assert 'messages' not in backup.__dict__
+
+    @skipIfWindows
+    @skipUnlessRedisIsAvailable
+    def test_reencode_files(self):
+        versions = self._make_versions(5)
+        for files in versions:
+            backup = Backup(submitter_id=self.user4.id,
+                            assignment=self.assignment)
+            db.session.add(Message(kind='file_contents', backup=backup,
+                                   contents=files))
+        db.session.commit()
+
+        job = jobs.enqueue_job(
+            reencode_backups.reencode_files,
+            description='Re-encode',
+            course_id=self.course.id,
+            user_id=self.admin.id,
+            assign_id=self.assignment.id)
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        assert not job.failed
+
+        messages = (Message.query.join(Backup)
+                           .filter(Backup.submitter_id == self.user4.id,
+                                   Message.kind == 'file_contents')
+                           .order_by(Message.id).all())
+        assert [m.encoding for m in messages] == ['dedup'] + ['delta'] * 4
+        assert [m.contents for m in messages] == versions
+
+    def _raw_contents(self, message):
+        return (db.session.query(type_coerce(Message._contents, db.LargeBinary))
+                          .filter(Message.id == message.id).scalar())
+
+    def _set_raw_contents(self, message, blob):
+        db.session.execute(Message.__table__.update()
+                                  .where(Message.id == message.id)
+                                  .values(contents=type_coerce(blob, db.LargeBinary)))
+        db.session.commit()
+        db.session.expire_all()
+
+    def test_blob_compression(self):
+        notebook = {'cells': ['print(1)\n' * 1000]}
+        backup = Backup(submitter_id=self.user4.id, assignment=self.assignment)
+        message = Message(kind='notebook', backup=backup, contents=notebook)
+        db.session.add(message)
+        db.session.commit()
+
+        blob = self._raw_contents(message)
+        assert blob[:1] == compression.ZLIB
+        assert len(blob) < len(json.dumps(notebook)) // 10
+        db.session.expire_all()
+        assert message.contents == notebook
+
+        # Rows written before compression are read as plain JSON
+        self._set_raw_contents(message, json.dumps(notebook).encode('utf-8'))
+        assert message.contents == notebook
+
+        # Only small blobs are left uncompressed by the recompress job
+        data = json.dumps(notebook).encode('utf-8')
+        assert compression.is_current(blob)
+        assert compression.is_current(compression.NONE + b'{}')
+        assert not compression.is_current(compression.NONE + data)
+        assert not compression.is_current(data)
+        with mock.patch.object(compression, 'BLOB_COMPRESSION', 'none'):
+            assert compression.is_current(compression.NONE + data)
+
+    @skipIfWindows
+    @skipUnlessRedisIsAvailable
+    def test_recompress_backups(self):
+        notebook = {'cells': ['print(1)\n' * 1000]}
+        backup = Backup(submitter_id=self.user4.id, assignment=self.assignment)
+        message = Message(kind='notebook', backup=backup, contents=notebook)
+        db.session.add(message)
+        db.session.commit()
+        self._set_raw_contents(message, json.dumps(notebook).encode('utf-8'))
+
+        job = jobs.enqueue_job(
+            recompress.recompress_backups,
+            description='Recompress',
+            course_id=self.course.id,
+            user_id=self.admin.id,
+            assign_id=self.assignment.id)
+        self.run_jobs()
+        job = Job.query.get(job.id)
+        assert not job.failed
+
+        assert self._raw_contents(message)[:1] == compression.ZLIB
+        assert message.contents == notebook
+
     def test_backup_owners(self):
         backup = Backup(
             submitter_id=self.user1.id,
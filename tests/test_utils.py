@@ -1,6 +1,7 @@
-from server import utils
+from server import jsoncodec, utils
 
 import datetime as dt
+import math
 import pytz
 
 from tests import OkTestCase
@@ -85,3 +86,26 @@ class TestUtils(OkTestCase):
         self.assertEqual(utils.humanize_name("mcDonald, ronald"), "ronald mcDonald")
         self.assertEqual(utils.humanize_name("Ronald McDonald"), "Ronald McDonald")
         self.assertEqual(utils.humanize_name("McDonald, Ronald"), "Ronald McDonald")
+
+    def test_json_codecs(self):
+        value = {'file_contents': {'hog.py': 'print("\u00e9")\n'},
+                 'analytics': {'time': '2016-01-01', 'attempts': 2 ** 70},
+                 'grading': [1.5, None, True]}
+        for dumps, loads in jsoncodec.CODECS.values():
+            assert loads(dumps(value)) == value
+            # Every codec reads what the others write
+            for _, other_loads in jsoncodec.CODECS.values():
+                assert other_loads(dumps(value)) == value
+
+    def test_json_codec_differences(self):
+        for name, (dumps, loads) in jsoncodec.CODECS.items():
+            # Neither codec stores datetimes
+            self.assertRaises(TypeError, dumps, {'time': dt.datetime.now()})
+            # json keeps NaN, which every codec reads, and orjson stores null
+            nan = loads(dumps({'score': float('nan')}))['score']
+            if name == 'orjson':
+                assert nan is None
+            else:
+                assert math.isnan(nan)
+                for _, other_loads in jsoncodec.CODECS.values():
+                    assert math.isnan(other_loads(dumps([nan]))[0])